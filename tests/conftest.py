@@ -0,0 +1,3 @@
+import os.path, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # timelapse modules, at the repo root
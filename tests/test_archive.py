@@ -0,0 +1,87 @@
+import os, tarfile
+
+from timelapse_archive import pack_day, read_index, archive_files, archived_frame, frame_bytes, frame_entry
+from timelapse_archive import frame_exists, list_archived, extract
+
+
+def pictures(folder, first, count):
+    paths = []
+    for i in range(first, first + count):
+        path = os.path.join(folder, f'picture_{i:05}.jpg')
+        with open(path, 'wb') as f:
+            f.write(bytes([i % 256]) * (700 + 300 * i))       # sizes not multiple of the tar blocks
+        os.utime(path, ns=(1_700_000_000_000_000_000 + i, 1_700_000_000_000_000_000 + i))
+        paths.append(path)
+    return paths
+
+
+def tar_content(tar_file):
+    with tarfile.open(tar_file) as tar:
+        return {m.name: tar.extractfile(m).read() for m in tar.getmembers()}
+
+
+def test_pack_day_makes_a_plain_tar_read_in_place(tmp_path):
+    folder = str(tmp_path)
+    paths = pictures(folder, 1, 5)
+    data = {os.path.basename(p): open(p, 'rb').read() for p in paths}
+    assert pack_day(folder, '20240101', paths, batch=2) == 5
+    tar_file, index_file = archive_files(folder, '20240101')
+
+    assert tar_content(tar_file) == data                      # any tar tool reads it
+    assert not any([os.path.exists(p) for p in paths])        # loose pictures removed
+    assert sorted(list_archived(folder, 'jpg')) == sorted(paths)
+    for path in paths:
+        assert frame_exists(path)
+        assert bytes(frame_bytes(path)) == data[os.path.basename(path)]
+        _, offset, size, mtime_ns = archived_frame(path)
+        assert frame_entry(path) == f"subfile,,start,{offset},end,{offset + size},,:{tar_file}"
+        assert mtime_ns == 1_700_000_000_000_000_000 + int(os.path.basename(path)[8:13])
+    assert read_index(index_file)['end'] % tarfile.BLOCKSIZE == 0
+
+
+def test_pack_day_appends_and_drops_the_data_not_indexed(tmp_path):
+    folder = str(tmp_path)
+    first = pictures(folder, 1, 3)
+    data = {os.path.basename(p): open(p, 'rb').read() for p in first}
+    pack_day(folder, '20240101', first)
+    tar_file, index_file = archive_files(folder, '20240101')
+    with open(tar_file, 'ab') as f:                           # batch appended, crash before its index
+        f.write(b'\x55' * 5000)
+
+    second = pictures(folder, 4, 2)
+    data.update({os.path.basename(p): open(p, 'rb').read() for p in second})
+    assert pack_day(folder, '20240101', second) == 2
+    assert tar_content(tar_file) == data
+    assert len(read_index(index_file)['frames']) == 5
+
+
+def test_pack_day_removes_the_pictures_indexed_before_a_crash(tmp_path):
+    folder = str(tmp_path)
+    paths = pictures(folder, 1, 3)
+    pack_day(folder, '20240101', paths, remove=False)         # crash before the loose pictures removal
+    size = os.path.getsize(archive_files(folder, '20240101')[0])
+    assert pack_day(folder, '20240101', paths) == 0           # only removed, not packed again
+    assert not any([os.path.exists(p) for p in paths])
+    assert os.path.getsize(archive_files(folder, '20240101')[0]) == size
+
+
+def test_pack_day_gate_stops_at_the_batch(tmp_path):
+    folder = str(tmp_path)
+    paths = pictures(folder, 1, 4)
+    calls = []
+    gate = lambda: calls.append(1) or len(calls) < 2          # second batch refused
+    assert pack_day(folder, '20240101', paths, batch=2, gate=gate) == 2
+    assert [os.path.exists(p) for p in paths] == [False, False, True, True]
+    assert pack_day(folder, '20240101', paths[2:]) == 2
+
+
+def test_extract_restores_the_pictures(tmp_path):
+    folder, dest = str(tmp_path / 'run'), str(tmp_path / 'out')
+    os.mkdir(folder)
+    paths = pictures(folder, 1, 3)
+    data = {os.path.basename(p): open(p, 'rb').read() for p in paths}
+    pack_day(folder, '20240101', paths)
+    assert extract(folder, dest, 'jpg') == 3
+    for name, content in data.items():
+        assert open(os.path.join(dest, name), 'rb').read() == content
+        assert os.stat(os.path.join(dest, name)).st_mtime_ns == 1_700_000_000_000_000_000 + int(name[8:13])
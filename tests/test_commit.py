@@ -0,0 +1,70 @@
+import os, stat
+import pytest
+
+import timelapse_commit
+from timelapse_commit import atomic_file, commit, temp_path, set_policy, sweep_temp, make_folder
+
+
+@pytest.fixture(autouse=True)
+def policy():
+    yield
+    set_policy('file')
+
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_temp_path_is_hidden_in_the_same_folder():
+    assert temp_path('/p/run/picture_00001.jpg') == '/p/run/.tmp.picture_00001.jpg'
+
+
+@pytest.mark.parametrize('policy', ['always', 'file', 'never'])
+def test_atomic_file_commits_with_the_permissions(tmp_path, policy):
+    set_policy(policy)
+    path = str(tmp_path / 'state.json')
+    with atomic_file(path) as f:
+        f.write('{"a": 1}')
+        assert not os.path.exists(path)                       # final name appears only at the commit
+    assert open(path).read() == '{"a": 1}'
+    assert mode(path) == 0o777
+    assert os.listdir(tmp_path) == ['state.json']
+
+
+def test_atomic_file_error_keeps_the_old_file(tmp_path):
+    path = str(tmp_path / 'state.json')
+    with open(path, 'w') as f:
+        f.write('old')
+    with pytest.raises(ValueError):
+        with atomic_file(path) as f:
+            f.write('new, partial')
+            raise ValueError('writer failure')
+    assert open(path).read() == 'old'
+    assert os.listdir(tmp_path) == ['state.json']             # temporary file removed
+
+
+def test_commit_of_another_writer_file(tmp_path):
+    path = str(tmp_path / 'picture_00001.jpg')
+    with open(temp_path(path), 'wb') as f:                    # i.e. the camera
+        f.write(b'\xff\xd8picture\xff\xd9')
+    files = timelapse_commit.counters['files']
+    commit(temp_path(path), path)
+    assert open(path, 'rb').read() == b'\xff\xd8picture\xff\xd9'
+    assert mode(path) == 0o777 and not os.path.exists(temp_path(path))
+    assert timelapse_commit.counters['files'] == files + 1
+
+
+def test_set_policy_rejects_unknown_policies():
+    with pytest.raises(ValueError):
+        set_policy('sometimes')
+
+
+def test_sweep_temp_removes_only_the_leftovers(tmp_path):
+    make_folder(str(tmp_path / 'run' / '00000'))
+    assert mode(tmp_path / 'run' / '00000') == 0o777
+    leftovers = [tmp_path / 'run' / '.tmp.picture_00001.jpg', tmp_path / 'run' / '00000' / '.tmp.frames.jsonl']
+    kept = [tmp_path / 'run' / 'picture_00002.jpg', tmp_path / 'run' / '.replicated.jsonl']
+    for path in leftovers + kept:
+        path.write_bytes(b'x')
+    assert sweep_temp(str(tmp_path)) == 2
+    assert [p.exists() for p in leftovers + kept] == [False, False, True, True]
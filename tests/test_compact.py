@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from timelapse_compact import compact_folder
+from timelapse_manifest import append_record, frame_index
+from timelapse_render import list_frames
+
+
+def pictures(folder, count):
+    for i in range(count):
+        name = f'picture_{i:05}.jpg'
+        gradient = np.add.outer(np.arange(48), np.arange(64)).astype(np.uint8) * 2 + i
+        Image.fromarray(np.dstack([gradient] * 3)).save(os.path.join(folder, name), quality=98)
+        append_record(folder, {'file': name, 'frame': i})
+
+
+def test_compact_folder_records_each_batch(tmp_path):
+    folder = str(tmp_path)
+    pictures(folder, 5)
+    report = compact_folder(folder, 'jpg', workers=2, min_psnr=20)
+    assert (report['frames'], report['failed']) == (5, 0)
+    assert sorted(os.listdir(folder)) == ['manifest.jsonl'] + [f'picture_{i:05}.webp' for i in range(5)]
+    assert list_frames(folder, 'jpg') == [os.path.join(folder, f'picture_{i:05}.webp') for i in range(5)]
+
+
+def test_compact_folder_gate_stops_before_the_next_batch(tmp_path):
+    folder = str(tmp_path)
+    pictures(folder, 5)
+    calls = []
+    gate = lambda: calls.append(1) or len(calls) < 2          # second batch refused
+    report = compact_folder(folder, 'jpg', workers=2, min_psnr=20, gate=gate)
+    assert report['frames'] == 2
+    names = sorted(os.listdir(folder))
+    assert [n for n in names if n.endswith('.webp')] == ['picture_00000.webp', 'picture_00001.webp']  # none left unindexed
+    assert [n for n in names if n.endswith('.jpg')] == [f'picture_{i:05}.jpg' for i in range(2, 5)]
+    assert sorted(frame_index(folder)) == list(range(5))
+
+    assert compact_folder(folder, 'jpg', workers=2, min_psnr=20)['frames'] == 3  # continues next time
@@ -0,0 +1,83 @@
+import os, zlib
+
+from PIL import Image
+
+from timelapse_integrity import check_frame, verify_folder, integrity_record
+from timelapse_manifest import append_record, read_manifest, skipped_frames
+from timelapse_render import list_frames
+
+
+def picture(path, fmt=None):
+    Image.new('RGB', (32, 24), (90, 120, 150)).save(path, fmt)
+    return open(path, 'rb').read()
+
+
+def test_check_frame_of_a_clean_picture(tmp_path):
+    for name in ('picture_00001.jpg', 'picture_00001.png'):
+        path = str(tmp_path / name)
+        picture(path)
+        assert check_frame(path) == ''                        # end marker only
+        assert check_frame(path, integrity_record(path)) == ''  # record of the shoot
+    assert check_frame(str(tmp_path / 'picture_00002.jpg')) == 'missing'
+
+
+def test_check_frame_of_a_jpeg_without_eoi(tmp_path):
+    path = str(tmp_path / 'picture_00001.jpg')
+    data = picture(path)
+    with open(path, 'wb') as f:
+        f.write(data[:-2] + b'\x00' * 8)                      # power outage: EOI never written, block padding
+    assert check_frame(path) == 'truncated'
+
+
+def test_check_frame_of_a_png_without_iend(tmp_path):
+    path = str(tmp_path / 'picture_00001.png')
+    data = picture(path)
+    with open(path, 'wb') as f:
+        f.write(data[:-12])                                   # IEND chunk missing
+    assert check_frame(path) == 'truncated'
+
+
+def test_check_frame_compares_the_record(tmp_path):
+    path = str(tmp_path / 'picture_00001.jpg')
+    data = picture(path)
+    record = integrity_record(path)
+    assert record == {'size': len(data), 'crc': zlib.crc32(data[-4096:])}
+    with open(path, 'r+b') as f:
+        f.seek(len(data) - 100)
+        f.write(b'\x55' * 10)                                 # same size, tail changed
+    assert check_frame(path, record) == 'crc'
+    with open(path, 'ab') as f:
+        f.write(b'\xff\xd9')
+    assert check_frame(path, record) == 'size'
+
+
+def test_verify_folder_marks_or_only_reports(tmp_path):
+    folder = str(tmp_path)
+    paths = [str(tmp_path / f'picture_{i:05}.jpg') for i in range(3)]
+    for i, path in enumerate(paths):
+        picture(path)
+        append_record(folder, dict(integrity_record(path), file=os.path.basename(path), frame=i))
+    with open(paths[1], 'r+b') as f:
+        f.truncate(os.path.getsize(paths[1]) - 50)            # truncated picture
+
+    manifest = open(os.path.join(folder, 'manifest.jsonl')).read()
+    report = verify_folder(folder, 'jpg', workers=2, mark=False)
+    assert (report['frames'], report['bad']) == (3, {paths[1]: 'size'})
+    assert open(os.path.join(folder, 'manifest.jsonl')).read() == manifest  # read-only check
+
+    assert verify_folder(folder, 'jpg', workers=2)['bad'] == {paths[1]: 'size'}
+    assert skipped_frames(folder) == {paths[1]: 'size'}
+    assert read_manifest(folder)['picture_00001.jpg']['frame'] == 1  # record updated, not replaced
+    assert list_frames(folder, 'jpg') == [paths[0], paths[2]]
+    assert verify_folder(folder, 'jpg', workers=2)['frames'] == 2  # skipped pictures aren't checked again
+
+
+def test_verify_folder_without_manifest(tmp_path):
+    folder = str(tmp_path)
+    paths = [str(tmp_path / f'picture_{i:05}.jpg') for i in range(2)]
+    for path in paths:
+        picture(path)
+    with open(paths[0], 'r+b') as f:
+        f.truncate(os.path.getsize(paths[0]) - 2)             # EOI missing
+    assert verify_folder(folder, 'jpg', mark=False)['bad'] == {paths[0]: 'truncated'}
+    assert 'manifest.jsonl' not in os.listdir(folder)        # nothing written
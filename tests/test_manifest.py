@@ -0,0 +1,54 @@
+import os
+
+from PIL import Image
+
+from timelapse_manifest import append_record, read_manifest, frame_index, frame_path, manifest_file, manifest_root
+from timelapse_integrity import verify_folder, resume_frames, integrity_record
+from timelapse_render import list_frames
+
+
+def shoot(folder, frames, shard=0):
+    paths = []
+    for n in frames:
+        path = frame_path(folder, 'picture', n, 'jpg', shard)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Image.new('RGB', (32, 24), (n, 100, 100)).save(path)
+        append_record(folder, dict(integrity_record(path), file=os.path.relpath(path, folder), frame=n))
+        paths.append(path)
+    return paths
+
+
+def test_frame_path_and_shards(tmp_path):
+    assert frame_path('/p/run', 'picture', 7, 'jpg') == '/p/run/picture_00007.jpg'
+    assert frame_path('/p/run', 'picture', 123456, 'jpg', shard=1000) == '/p/run/00123/picture_123456.jpg'
+    folder = str(tmp_path)
+    paths = shoot(folder, range(4), shard=2)
+    assert manifest_root(os.path.dirname(paths[3])) == folder   # shard subfolders use the parent manifest
+    assert frame_index(folder, 'jpg') == dict(enumerate(paths))
+    assert list_frames(folder, 'jpg') == paths
+
+
+def test_recovery_after_a_power_outage(tmp_path):
+    folder = str(tmp_path)
+    paths = shoot(folder, range(6))
+    with open(paths[4], 'r+b') as f:
+        f.truncate(os.path.getsize(paths[4]) - 40)           # picture 4 truncated by the outage
+    with open(manifest_file(folder), 'r+b') as f:
+        f.truncate(os.path.getsize(manifest_file(folder)) - 20)  # record of picture 5 truncated by the outage
+
+    assert sorted(read_manifest(folder)) == [os.path.basename(p) for p in paths[:5]]  # truncated line skipped
+    assert verify_folder(folder, 'jpg')['bad'] == {paths[4]: 'size'}  # skip record after the truncated line
+    assert frame_index(folder, 'jpg') == dict(enumerate(paths[:4]))  # skipped picture left out of the index
+
+    saved, last_frame = resume_frames(folder, 'jpg')
+    assert saved == dict(enumerate(paths[:4]))
+    assert last_frame == 5                                    # skipped and unrecorded pictures aren't overwritten
+
+
+def test_recovery_without_manifest(tmp_path):
+    folder = str(tmp_path)
+    for n in (1, 2, 10):
+        Image.new('RGB', (32, 24)).save(os.path.join(folder, f'picture_{n:05}.jpg'))
+    saved, last_frame = resume_frames(folder, 'jpg')
+    assert sorted(saved) == [1, 2, 10] and last_frame == 10
+    assert resume_frames(str(tmp_path / 'missing'), 'jpg') == ({}, 0)
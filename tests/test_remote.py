@@ -0,0 +1,85 @@
+import os, re, shutil, socket, subprocess
+from threading import Thread
+from time import sleep
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from timelapse_remote import serve, remote_render, shared_frame
+
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg not available')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_worker(parent_folder):
+    port = free_port()
+    Thread(target=serve, args=(port, parent_folder, '127.0.0.1'), daemon=True).start()
+    for _ in range(100):                                      # waits for the worker to listen
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return port
+        except OSError:
+            sleep(0.05)
+    raise RuntimeError('worker not started')
+
+
+def start_broken_worker():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    def close_all():
+        while True:
+            conn, _ = server.accept()
+            conn.makefile('rb').readline()                    # ping request
+            conn.sendall(b'"not a reply"\n')                  # malformed reply
+            conn.close()
+    Thread(target=close_all, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def movie_luma(movie):
+    raw = subprocess.run(f"ffmpeg -loglevel error -i '{movie}' -f rawvideo -pix_fmt gray -", shell=True,
+                         stdout=subprocess.PIPE, check=True).stdout
+    return np.frombuffer(raw, dtype=np.uint8).reshape(-1, 240 * 320).mean(axis=1)
+
+
+def test_shared_frame_refuses_paths_out_of_the_folder():
+    assert shared_frame('/p/run', '00000/picture_00001.jpg') == '/p/run/00000/picture_00001.jpg'
+    for name in ('/etc/passwd', '../other/picture_00001.jpg'):
+        with pytest.raises(OSError):
+            shared_frame('/p/run', name)
+
+
+def test_remote_render_on_localhost_workers(tmp_path, capsys):
+    folder = tmp_path / 'shared' / 'run'
+    folder.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    frames = []
+    for i in range(12):                                       # brightness grows with the frame number
+        pixels = np.clip(15 + 18 * i + rng.integers(-8, 8, (240, 320, 3)), 0, 255).astype(np.uint8)
+        frames.append(str(folder / f'picture_{i:05}.jpg'))
+        Image.fromarray(pixels).save(frames[-1], quality=95)
+    (tmp_path / 'elsewhere').mkdir()
+
+    shared = start_worker(str(tmp_path / 'shared'))           # reads the pictures from the shared folder
+    streamed = start_worker(str(tmp_path / 'elsewhere'))      # gets the pictures from the coordinator
+    broken = start_broken_worker()                            # malformed ping reply: dropped
+    workers = ','.join([f'127.0.0.1:{p}' for p in (broken, shared, streamed)])
+    out_file = str(tmp_path / 'movie.mp4')
+    assert remote_render(str(folder), frames, 10, '320x240', '', workers, out_file, chunk_frames=3, progress_cb=None) == 0
+
+    out = capsys.readouterr().out
+    assert f'127.0.0.1:{broken} not reachable (malformed message' in out
+    assert 'frames shared' in out and 'frames streamed' in out
+    assert sorted(re.findall(r'Segment (\d+) from', out), key=int) == ['0', '1', '2', '3']  # each chunk rendered once
+    luma = movie_luma(out_file)
+    assert len(luma) == 12
+    assert all(np.diff(luma) > 5)                             # segments joined in frame order
+    assert sorted(os.listdir(tmp_path)) == ['elsewhere', 'movie.mp4', 'shared']  # segment files removed
@@ -0,0 +1,207 @@
+import os, re, shutil, subprocess
+from fractions import Fraction
+from math import ceil
+
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+
+from timelapse_render import fit_to_time, select_filter, timing_filter, moving_average, deflicker_gains
+from timelapse_render import dark_frames, trim_cuts, fit_trimmed, image_input
+from timelapse_render import save_render_timing, render_speed, timings_file, pipe_render
+from timelapse_render import phase_shifts, frames_shifts, stabilize_boxes
+from timelapse_manifest import append_record
+
+
+def select_kept(expression, count):
+    """ Evaluates the ffmpeg select expression of select_filter, for the frame numbers n of count frames.
+    """
+    values = re.fullmatch(r"select='gt\(ceil\(\(n\+1\)\*(\d+)/(\d+)\),ceil\(n\*(\d+)/(\d+)\)\)'", expression).groups()
+    n_sel, count_sel = int(values[0]), int(values[1])
+    assert values[2:] == values[:2]
+    return [n for n in range(count) if ceil(Fraction((n + 1) * n_sel, count_sel)) > ceil(Fraction(n * n_sel, count_sel))]
+
+
+@pytest.mark.parametrize('count, movie_time_s, fps', [(1000, 10, 24), (721, 7, 25), (241, 1, 24), (100000, 60, 30)])
+def test_fit_to_time_and_select_filter_keep_the_same_frames(count, movie_time_s, fps):
+    frames = list(range(count))
+    kept, framerate, decimated = fit_to_time(frames, movie_time_s, fps)
+    assert decimated and framerate == fps
+    assert len(kept) == fps * movie_time_s                    # exact movie time
+    assert select_kept(select_filter(count, len(kept)), count) == kept
+
+
+def test_fit_to_time_keeps_all_the_frames_at_a_fractional_framerate():
+    frames = list(range(250))
+    kept, framerate, decimated = fit_to_time(frames, 12, fps=24, max_fps=30)
+    assert (kept, framerate, decimated) == (frames, Fraction(250, 12), False)
+    assert len(kept) / framerate == 12
+    assert timing_filter(framerate) == 'setpts=N*6/(125*TB)'
+
+
+def test_moving_average_pads_the_curve_ends():
+    assert list(moving_average([1, 2, 3, 4, 5], 3)) == pytest.approx([4/3, 2, 3, 4, 14/3])
+    assert list(moving_average([1, 2, 3, 4], 4)) == pytest.approx([4/3, 2, 3, 11/3])  # window forced to 3
+    assert list(moving_average([7], 15)) == [7]
+
+
+def test_deflicker_gains_flatten_the_flicker():
+    luma = np.array([100, 120] * 20, dtype=np.float64)       # frame to frame flicker
+    corrected = luma * deflicker_gains(luma, window=15)
+    assert np.ptp(corrected[8:-8]) < 0.1 * np.ptp(luma)       # flicker mostly removed
+    assert corrected.mean() == pytest.approx(luma.mean(), rel=0.01)  # exposure kept
+    assert list(deflicker_gains(np.full(30, 80.0))) == pytest.approx([1.0] * 30)  # steady light is untouched
+
+
+def test_deflicker_gains_are_limited():
+    gains = deflicker_gains([0, 200, 200, 200, 200], window=5, max_gain=2.0)  # black frame, no zero division
+    assert gains[0] == 2.0
+    assert min(deflicker_gains([10, 10, 1000, 10, 10], window=5, max_gain=2.0)) == 0.5
+
+
+def test_trim_cuts_after_the_dropped_frames():
+    all_frames = [f'picture_{i:05}.jpg' for i in range(10)]
+    dark = {all_frames[i] for i in (0, 3, 4, 8)}               # night at the start, in the middle and near the end
+    frames = [f for f in all_frames if f not in dark]
+    assert trim_cuts(frames, all_frames, dark) == {2, 5}      # first frame after each gap (a leading gap isn't a cut)
+    assert trim_cuts(all_frames, all_frames, set()) == set()
+
+
+def test_trim_cuts_of_a_decimated_subset():
+    all_frames = list(range(12))
+    dark = {5}
+    frames = [0, 2, 4, 6, 8, 10]                              # decimated frames skip frame 5 anyway
+    assert trim_cuts(frames, all_frames, dark) == {3}
+    assert trim_cuts([0, 4, 8], all_frames, set()) == set()   # decimation alone is not a cut
+
+
+def test_fit_trimmed_takes_the_crossfades_from_the_frames_budget():
+    all_frames = list(range(100))
+    dark = set(range(40, 50)) | set(range(70, 72))            # two nights
+    trimmed = [f for f in all_frames if f not in dark]
+    frames, framerate, decimated, cuts = fit_trimmed(trimmed, all_frames, dark, 2, fps=10, max_fps=30, fade=3)
+    assert decimated and framerate == 10 and len(cuts) == 2
+    assert len(frames) + 3 * len(cuts) == 20                  # exact movie time, crossfades included
+
+    frames, framerate, decimated, cuts = fit_trimmed(trimmed[:60], all_frames, dark, 4, fps=10, max_fps=30, fade=5)
+    assert not decimated and len(cuts) == 1
+    assert (len(frames) + 5 * len(cuts)) / framerate == 4     # all the frames, slower framerate
+
+    frames, _, _, cuts = fit_trimmed(trimmed, all_frames, dark, 2, fps=10, max_fps=30, fade=0)
+    assert len(frames) == 20 and cuts == set()
+
+
+def test_dark_frames_from_the_manifest(tmp_path):
+    folder = str(tmp_path)
+    records = [{'lux': 0.5, 'luma': 90}, {'lux': 50, 'luma': 10}, {'lux': 50, 'luma': 90}, {}]
+    frames = [os.path.join(folder, f'picture_{i:05}.jpg') for i in range(len(records))]
+    for frame, record in zip(frames, records):
+        append_record(folder, dict(record, file=os.path.basename(frame)))
+    assert dark_frames(frames, lux_min=1) == {frames[0]}
+    assert dark_frames(frames, luma_min=20) == {frames[1]}
+    assert dark_frames(frames, lux_min=1, luma_min=20) == {frames[0], frames[1]}  # frame without record is kept
+    assert dark_frames(frames) == set()
+
+
+def test_image_input_lists_the_frames_when_pictures_are_left_out(tmp_path):
+    frames = [str(tmp_path / f'picture_{i:05}.jpg') for i in range(4)]
+    for frame in frames:
+        open(frame, 'wb').close()
+    pic_files, list_file = str(tmp_path / '*.jpg'), str(tmp_path / 'frames.ffconcat')
+    assert image_input(frames, 24, pic_files, list_file, False).startswith('-f image2 ')  # glob pattern
+    assert image_input(frames[:1] + frames[2:], 24, pic_files, list_file, False).startswith('-f concat ')  # bad one left out
+    assert frames[1] not in open(list_file).read()
+
+
+def test_render_timings_next_to_the_scripts(tmp_path):
+    assert timings_file == os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'render_timings.jsonl')
+    fname = str(tmp_path / 'render_timings.jsonl')
+    assert render_speed('pictures', '1920x1080', fname) == 4.0  # default speed, no timings yet
+    save_render_timing('pictures', 100, '1920x1080', 10, fname)
+    save_render_timing('pictures', 100, '1920x1080', 20, fname)
+    assert render_speed('pictures', '1920x1080', fname) == 7.5  # median of the timings
+    assert render_speed('pictures', '960x540', fname) == 30.0   # scaled by the pixels
+
+
+ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg not available')
+
+
+def movie_frames(movie):
+    raw = subprocess.run(f"ffmpeg -loglevel error -i '{movie}' -f rawvideo -pix_fmt gray -", shell=True,
+                         stdout=subprocess.PIPE, check=True).stdout
+    return len(raw) // (64 * 48)
+
+
+def pictures(folder, count):
+    frames = [os.path.join(folder, f'picture_{i:05}.jpg') for i in range(count)]
+    for i, frame in enumerate(frames):
+        Image.new('RGB', (64, 48), (10 * i, 100, 100)).save(frame)
+    return frames
+
+
+@ffmpeg
+def test_pipe_render_stops_at_a_frame_not_decoded(tmp_path):
+    frames = pictures(str(tmp_path), 10)
+    with open(frames[5], 'wb') as f:
+        f.write(b'not a picture')
+    out_file = str(tmp_path / 'movie.partial.mp4')
+    assert pipe_render(frames, out_file, (64, 48), 10, workers=2, progress_cb=None) == -1
+    assert not os.path.exists(out_file)                       # no shorter movie left
+    assert pipe_render(frames[:5], out_file, (64, 48), 10, workers=2, progress_cb=None) == 0
+    assert movie_frames(out_file) == 5
+
+
+@ffmpeg
+def test_pipe_render_adds_the_crossfades_to_the_movie_and_the_progress(tmp_path):
+    frames = pictures(str(tmp_path), 6)
+    out_file = str(tmp_path / 'movie.mp4')
+    progress = []
+    assert pipe_render(frames, out_file, (64, 48), 10, workers=2, progress_cb=progress.append, period=0,
+                       cuts=[3, 0], fade=2) == 0
+    assert movie_frames(out_file) == 8                        # two blended frames at the cut (none before the first)
+    assert (progress[-1]['frame'], progress[-1]['total']) == (8, 8)
+
+
+def scene(seed=1):
+    rng = np.random.default_rng(seed)
+    noise = Image.fromarray(rng.integers(0, 255, (300, 300)).astype(np.uint8))
+    return np.asarray(noise.filter(ImageFilter.GaussianBlur(2)), dtype=np.float32)
+
+
+crops = [(50, 50), (53, 50), (53, 48), (49, 52), (49, 52)]   # crop origin (x, y) of each frame in the scene
+content_moves = [(-3, 0), (0, 2), (4, -4), (0, 0)]            # camera moving right: the content moves left
+
+
+def test_phase_shifts_recover_the_content_moves():
+    base = scene()
+    thumbs = np.stack([base[y:y+96, x:x+128] for x, y in crops])
+    assert phase_shifts(thumbs) == pytest.approx(np.array(content_moves), abs=0.1)
+
+
+def test_frames_shifts_as_fractions_of_the_frame(tmp_path):
+    base = scene()
+    frames = []
+    for i, (x, y) in enumerate(crops):
+        frames.append(str(tmp_path / f'picture_{i:05}.png'))
+        Image.fromarray(base[y:y+96, x:x+128].astype(np.uint8)).save(frames[-1])
+    shifts = frames_shifts(frames, thumb_w=128, workers=2, block=2)  # blocks linked by their last frame
+    assert shifts[0].tolist() == [0, 0]
+    assert shifts[1:] == pytest.approx(np.array(content_moves) / [128, 96], abs=0.002)
+
+
+def test_stabilize_boxes_follow_the_content_inside_the_frame():
+    shifts = np.zeros((31, 2))
+    shifts[15] = (0.02, -0.01)                                # jolt at frame 15, back at frame 16
+    shifts[16] = (-0.02, 0.01)
+    boxes, margin = stabilize_boxes(shifts, window=9, max_crop=0.1)
+    assert 0 < margin <= 0.1
+    for box in boxes:
+        assert 0 <= box[0] < box[2] <= 1 and 0 <= box[1] < box[3] <= 1
+        assert box[2] - box[0] == pytest.approx(1 - 2 * margin) and box[3] - box[1] == pytest.approx(1 - 2 * margin)
+    still = boxes[0]
+    assert boxes[15][0] > still[0] and boxes[15][1] < still[1]  # the crop moves with the content, cancelling the jolt
+    assert boxes[15][0] - boxes[14][0] == pytest.approx(0.02)
+
+    boxes, margin = stabilize_boxes(np.cumsum(np.full((30, 2), 0.05), axis=0), window=5, max_crop=0.05)
+    assert margin == 0.05                                     # large drifts are limited to max_crop
+    assert all([0 <= v <= 1 for box in boxes for v in box])
@@ -0,0 +1,71 @@
+import os, zlib
+
+from timelapse_replica import read_journal, append_journal, journal_file, replicated_paths, replicate_folder
+from timelapse_replica import copy_file, scan_files, Throttle
+
+
+def make_run(tmp_path):
+    run = tmp_path / 'local' / 'run'
+    (run / '00000').mkdir(parents=True)
+    files = {'00000/picture_00001.jpg': b'a' * 3000, 'picture_00002.jpg': b'b' * 10, 'movie.mp4': b'm' * 500,
+             'frames.jsonl': b'{}\n'}
+    for name, data in files.items():
+        (run / name).write_bytes(data)
+    (run / '.tmp.picture_00003.jpg').write_bytes(b'c')         # hidden: never replicated
+    (run / 'movie.partial.mp4').write_bytes(b'p')              # partial render: never replicated
+    (tmp_path / 'target').mkdir()
+    return str(run), str(tmp_path / 'target'), files
+
+
+def test_journal_skips_truncated_lines_and_keeps_the_last_record(tmp_path):
+    folder = str(tmp_path)
+    append_journal(folder, [{'file': 'a.jpg', 'size': 1}, {'file': 'b.jpg', 'size': 2}])
+    with open(journal_file(folder), 'a') as f:
+        f.write('{"file": "c.jpg", "si')                       # power outage while appending
+    append_journal(folder, [{'file': 'a.jpg', 'size': 3}])
+    assert read_journal(folder) == {'a.jpg': {'file': 'a.jpg', 'size': 3}, 'b.jpg': {'file': 'b.jpg', 'size': 2}}
+    assert read_journal(str(tmp_path / 'missing')) == {}
+
+
+def test_copy_file_returns_the_source_crc(tmp_path):
+    src, dst = tmp_path / 'src.jpg', tmp_path / 'dst.jpg'
+    src.write_bytes(os.urandom(600000))                        # several chunks
+    os.utime(src, ns=(1_000_000_000, 2_000_000_000))
+    assert copy_file(str(src), str(dst), Throttle()) == zlib.crc32(src.read_bytes())
+    assert dst.read_bytes() == src.read_bytes()
+    assert os.stat(dst).st_mtime_ns == 2_000_000_000
+
+
+def test_replicate_folder_copies_journals_and_resumes(tmp_path):
+    run, target, files = make_run(tmp_path)
+    assert sorted(scan_files(run)) == sorted(files)
+
+    calls = []
+    report = replicate_folder(run, target, batch=2, gate=lambda: calls.append(1) or len(calls) <= 2)  # interrupted
+    assert report['files'] == 2
+    assert len(read_journal(run)) == 2
+
+    report = replicate_folder(run, target, batch=2)            # resumed from the journal
+    assert (report['files'], report['failed']) == (2, 0)
+    journal = read_journal(run)
+    for name, data in files.items():
+        assert open(os.path.join(target, 'run', name), 'rb').read() == data
+        assert journal[name]['crc'] == zlib.crc32(data) and journal[name]['size'] == len(data)
+    assert not os.path.exists(os.path.join(target, 'run', '.tmp.picture_00003.jpg'))
+    assert not os.path.exists(os.path.join(target, 'run', 'movie.partial.mp4'))
+
+    assert replicate_folder(run, target)['files'] == 0         # nothing new
+    with open(os.path.join(run, 'frames.jsonl'), 'ab') as f:
+        f.write(b'{"file": "picture_00004.jpg"}\n')            # changed file
+    assert replicate_folder(run, target)['files'] == 1
+    paths = replicated_paths(os.path.dirname(run))
+    assert (os.path.join(run, 'picture_00002.jpg'), 10) in paths
+    assert (os.path.join(run, 'frames.jsonl'), len(files['frames.jsonl'])) not in paths  # size changed since
+
+
+def test_replicate_folder_waits_for_a_missing_target(tmp_path):
+    run, target, _ = make_run(tmp_path)
+    report = replicate_folder(run, os.path.join(target, 'not_mounted'))
+    assert report['failed'] == -1
+    assert not os.path.exists(os.path.join(target, 'not_mounted'))
+    assert read_journal(run) == {}
@@ -0,0 +1,63 @@
+import os
+
+from timelapse_render import partial_file, checkpoint_file, save_checkpoint, resume_jobs, partial_outputs
+from timelapse_render import write_concat_list
+
+
+def touch(path, data=b'x'):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def segmented_render(folder, segments=3):
+    """ Checkpoint of a render in segments, as render_jobs makes it: one job per segment, then the join job.
+    """
+    frames = [touch(os.path.join(folder, f'picture_{i:05}.jpg')) for i in range(6)]
+    out_file = os.path.join(folder, '20240101_120000.mp4')
+    base = out_file[:-4]
+    jobs, seg_files = [], []
+    for i in range(segments):
+        seg_file, seg_list = f'{base}_seg{i:03}.mp4', f'{base}_seg{i:03}.ffconcat'
+        write_concat_list(frames[2*i:2*i+2], seg_list)
+        jobs.append({'commit': [partial_file(seg_file), seg_file], 'temp_files': [seg_list], 'final': False,
+                     'label': f'segment {i+1}/{segments}'})
+        seg_files.append(seg_file)
+    concat_list = base + '_segments.ffconcat'
+    write_concat_list(seg_files, concat_list)
+    jobs.append({'commit': [partial_file(out_file), out_file], 'temp_files': seg_files + [concat_list], 'label': 'join'})
+    save_checkpoint(out_file, jobs, frames)
+    return out_file, frames, seg_files
+
+
+def test_resume_returns_only_the_missing_jobs(tmp_path):
+    folder = str(tmp_path)
+    out_file, frames, seg_files = segmented_render(folder)
+    touch(seg_files[0])                                       # first segment committed before the outage
+    touch(partial_file(seg_files[1]), b'half')                # second segment interrupted: stale partial
+
+    resumed_frames, jobs = resume_jobs(checkpoint_file(out_file))
+    assert resumed_frames == frames
+    assert [job['label'] for job in jobs] == ['segment 2/3', 'segment 3/3', 'join']  # stale partial isn't done
+
+    touch(os.path.join(folder, '20231231_120000_seg000.mp4'))  # segment of a render without checkpoint
+    partials, checkpoints = partial_outputs(folder)
+    assert partials == sorted([partial_file(seg_files[1]), os.path.join(folder, '20231231_120000_seg000.mp4')])
+    assert checkpoints == [checkpoint_file(out_file)]         # segments of the checkpoint are kept
+
+
+def test_resume_of_a_completed_or_unrecoverable_render(tmp_path):
+    folder = str(tmp_path)
+    out_file, frames, seg_files = segmented_render(folder)
+    os.remove(out_file[:-4] + '_seg002.ffconcat')             # list of a missing job lost
+    assert resume_jobs(checkpoint_file(out_file)) is None
+
+    out_file, frames, seg_files = segmented_render(folder)
+    for frame in frames:
+        os.remove(frame)                                      # pictures removed meanwhile
+    assert resume_jobs(checkpoint_file(out_file)) is None
+
+    out_file, frames, seg_files = segmented_render(folder)
+    touch(out_file)                                           # movie made, checkpoint not removed yet
+    assert resume_jobs(checkpoint_file(out_file)) is None
+    assert resume_jobs(os.path.join(folder, 'missing.render.json')) is None
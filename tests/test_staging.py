@@ -0,0 +1,54 @@
+import os
+
+from timelapse_staging import StagedWriter
+
+
+def stage(writer, final, data):
+    staged = writer.stage_path(final)
+    with open(staged, 'wb') as f:
+        f.write(data)
+    writer.commit(staged, final)
+    return staged
+
+
+def test_flush_writes_and_removes_the_staged_files(tmp_path):
+    (tmp_path / 'run').mkdir()
+    writer = StagedWriter(str(tmp_path / 'stage'), batch=2, flush_s=0.1)
+    finals = [str(tmp_path / 'run' / f'picture_{i:05}.jpg') for i in range(3)]
+    staged = [stage(writer, final, bytes([i]) * 10) for i, final in enumerate(finals)]
+    writer.flush()
+    assert [open(f, 'rb').read() for f in finals] == [bytes([i]) * 10 for i in range(3)]
+    assert not any([os.path.exists(f) for f in staged])
+    assert writer.staged_bytes == 0
+    writer.close()
+
+
+def test_failed_flush_keeps_the_staged_file_for_a_retry(tmp_path):
+    final = str(tmp_path / 'missing' / 'picture_00001.jpg')   # folder not there yet: the write fails
+    writer = StagedWriter(str(tmp_path / 'stage'), batch=1, flush_s=0.1, retry_s=30)
+    staged = stage(writer, final, b'picture')
+    writer.flush()                                            # returns after the failed attempt
+    assert os.path.exists(staged)
+    assert not writer.is_flushed(final) and writer.locate(final) == staged
+    assert writer.errors == 0
+
+    os.mkdir(tmp_path / 'missing')                            # i.e. space made by the cleanup
+    writer.flush()                                            # retried at the flush request
+    assert open(final, 'rb').read() == b'picture'
+    assert not os.path.exists(staged) and writer.is_flushed(final)
+    writer.close()
+
+
+def test_files_not_flushed_at_closing_are_recovered(tmp_path):
+    final = str(tmp_path / 'missing' / 'picture_00001.jpg')
+    writer = StagedWriter(str(tmp_path / 'stage'), batch=1, flush_s=0.1, retry_s=30)
+    staged = stage(writer, final, b'picture')
+    writer.close()                                            # doesn't wait for the storage
+    assert os.path.exists(staged)
+
+    os.mkdir(tmp_path / 'missing')
+    writer = StagedWriter(str(tmp_path / 'stage'), batch=1, flush_s=0.1)
+    writer.flush()
+    assert open(final, 'rb').read() == b'picture'
+    assert os.listdir(tmp_path / 'stage') == []
+    writer.close()
@@ -0,0 +1,105 @@
+import os
+
+from timelapse_storage import scan_tree, select_files, cleanup, picture_types, movie_types, StorageGovernor
+
+
+day = 86400
+now = 100 * day
+
+
+def names(remove, directory):
+    return sorted([name for name, _ in remove.get(directory, [])])
+
+
+def test_select_files_removes_all_by_default():
+    found = {'/p/run': [('picture_00001.jpg', 10, now - 5*day), ('20240101.mp4', 100, now - 4*day),
+                        ('frames.jsonl', 1, now - 5*day)]}
+    remove, kept = select_files(found, now=now)
+    assert names(remove, '/p/run') == ['20240101.mp4', 'frames.jsonl', 'picture_00001.jpg']
+    assert kept == 0
+
+
+def test_select_files_keep_days_and_movies():
+    found = {'/p/old': [('picture_00001.jpg', 10, now - 5*day), ('old.mp4', 100, now - 5*day)],
+             '/p/new': [('picture_00001.jpg', 10, now - day/2)]}
+    remove, kept = select_files(found, keep_days=2, keep_movies=True, now=now)
+    assert names(remove, '/p/old') == ['picture_00001.jpg']
+    assert '/p/new' not in remove
+    assert kept == 2
+
+
+def test_select_files_keep_unrendered_uses_the_latest_movie():
+    found = {'/p/run': [('picture_00001.jpg', 10, now - 3*day), ('picture_00002.jpg', 10, now - day),
+                        ('movie.mp4', 100, now - 2*day), ('movie.partial.mp4', 50, now)]}
+    remove, kept = select_files(found, keep_movies=True, keep_unrendered=True, now=now)
+    assert names(remove, '/p/run') == ['picture_00001.jpg']   # the partial movie doesn't count as rendered
+
+
+def test_select_files_shards_follow_the_parent_movie():
+    found = {'/p/run': [('movie.mp4', 100, now - day), ('frames.jsonl', 1, now)],
+             '/p/run/00000': [('picture_00001.jpg', 10, now - 2*day)],
+             '/p/run/00001': [('picture_10001.jpg', 10, now)]}
+    remove, kept = select_files(found, keep_movies=True, keep_unrendered=True, now=now)
+    assert names(remove, '/p/run/00000') == ['picture_00001.jpg']
+    assert '/p/run/00001' not in remove
+    assert '/p/run' not in remove                             # manifest kept, as pictures in a shard are kept
+
+
+def test_select_files_keeps_the_files_not_replicated():
+    found = {'/p/run': [('picture_00001.jpg', 10, now - day), ('picture_00002.jpg', 10, now - day),
+                        ('picture_00003.jpg', 10, now - day)]}
+    replicated = {('/p/run/picture_00001.jpg', 10), ('/p/run/picture_00002.jpg', 9)}  # second one changed size
+    remove, kept = select_files(found, now=now, replicated=replicated)
+    assert names(remove, '/p/run') == ['picture_00001.jpg']
+    assert kept == 2
+
+
+def test_cleanup_dry_run_and_removal(tmp_path):
+    run = tmp_path / 'run'
+    (run / '00000').mkdir(parents=True)
+    for name in ('00000/picture_00001.jpg', 'picture_00002.jpg', 'movie.mp4'):
+        (run / name).write_bytes(b'x' * 100)
+    (run / 'notes.txt').write_text('kept, not a wanted type')
+    f_types = picture_types + movie_types
+
+    assert set(scan_tree(str(run), f_types)) == {str(run), str(run / '00000')}
+    report = cleanup(str(tmp_path), f_types, dry_run=True)
+    assert (report['files'], report['bytes'], report['failed']) == (3, 300, 0)
+    assert sorted(report['removed']) == sorted([str(run / '00000/picture_00001.jpg'), str(run / 'picture_00002.jpg'),
+                                                str(run / 'movie.mp4')])
+    assert (run / 'movie.mp4').exists()
+
+    report = cleanup(str(tmp_path), f_types, keep_movies=True)
+    assert (report['files'], report['kept'], report['removed']) == (2, 1, [])
+    assert sorted(os.listdir(run)) == ['00000', 'movie.mp4', 'notes.txt']
+    assert os.listdir(run / '00000') == []
+
+
+def governor_at(free_mb, watermarks=(2000, 1000, 500, 200)):
+    governor = StorageGovernor('.', 3 * 1048576, 20, watermarks)
+    governor.free_mb = free_mb
+    governor.free_bytes = lambda: governor.free_mb * 1048576
+    return governor
+
+
+def test_governor_acts_one_level_at_the_time():
+    governor = governor_at(5000)
+    assert governor.update(3 * 1048576) == 0
+    governor.free_mb = 150                                    # below all the watermarks at once
+    levels = [governor.update(3 * 1048576)]
+    while levels[-1] > 0:
+        levels.append(governor.next_level())
+    assert levels == [1, 2, 3, 4, 0]
+
+
+def test_governor_prune_freeing_space_skips_the_stop():
+    governor = governor_at(150)
+    levels = [governor.update(3 * 1048576)]
+    while levels[-1] > 0:
+        if levels[-1] == 3:
+            governor.free_mb = 1500                           # the prune frees space, back to level 1
+        levels.append(governor.next_level())
+    assert levels == [1, 2, 3, 0]
+    assert governor.level == 1
+    governor.free_mb = 900                                    # level 2 can be reached again later
+    assert governor.update(3 * 1048576) == 2
@@ -67,6 +67,10 @@ parser.add_argument("--time", type=int,
 parser.add_argument("--text", type=str, 
                     help="Input the text to overlay on video. If 'fps' the used value is overlaid")
 
+# --dry_run argument is added to the parser
+parser.add_argument("--dry_run", action='store_true', 
+                    help="Lists the old files the cleanup would remove, without removing them")
+
 args = parser.parse_args()   # argument parsed assignement
 # ###############################################################################################
 
@@ -76,13 +80,26 @@ args = parser.parse_args()   # argument parsed assignement
 # libraries import
 from picamera2 import Picamera2, Preview
 from libcamera import controls
-from os import system
 from time import time, sleep, localtime, strftime
 from datetime import datetime, timedelta
-import os.path, pathlib, stat, sys, json
+import os.path, pathlib, stat, sys, json, glob
 import RPi.GPIO as GPIO
 import subprocess, socket
 from subprocess import Popen, PIPE
+from timelapse_manifest import append_record, frame_path, manifest_file
+from timelapse_render import list_frames, fit_to_time, image_input, run_ffmpeg, print_progress, save_render_timing
+from timelapse_render import render_speed, split_frames, write_concat_list, concat_command
+from timelapse_render import overlay_texts, overlay_filter, font_option
+from timelapse_render import partial_file, commit_partial, checkpoint_file, save_checkpoint, resume_jobs, partial_outputs
+from timelapse_worker import RenderWorker
+from timelapse_live import LiveStream
+from timelapse_storage import cleanup, print_report, StorageGovernor, QualityBudget
+from timelapse_staging import StagedWriter, latency_report
+from timelapse_archive import ArchivePacker, frame_stat
+from timelapse_compact import Compactor, available, finished_folders
+from timelapse_integrity import integrity_record, verify_folder, print_verify_report, resume_frames
+from timelapse_commit import set_policy, temp_path, commit, make_folder, commit_report, sweep_temp
+from timelapse_replica import Replicator, replicated_paths
 
 
 
@@ -256,6 +273,24 @@ def setup():
                 instructions_info('lux_threshold')    # instructions_info function is called
             else:                                     # case parent_folder is a key in settings.txt
                 lux_threshold = int(settings['lux_threshold'])  # lux threshold to take or not a picture
+            
+            bg_render = to_bool(settings.get('render_worker', False))  # flag to render in a background low priority process (False when missing)
+            overlay_info = to_bool(settings.get('overlay_info', False))  # flag to overlay capture time, lux and temperature per frame
+            keep_days = int(settings.get('keep_days', 0))  # files of the last keep_days days aren't erased (zero erases all)
+            keep_unrendered = to_bool(settings.get('keep_unrendered', False))  # flag to keep the pictures until their movie exists
+            ram_staging = to_bool(settings.get('ram_staging', False))  # flag to stage the pictures in RAM, flushed in batches
+            staging_mb = int(settings.get('staging_mb', 64))  # max RAM (MB) for the staged pictures
+            fsync_policy = settings.get('fsync_policy', 'file').strip().lower()  # fsync of the committed files: always, file or never
+            shard_frames = int(settings.get('shard_frames', 0))  # pictures per subfolder of folder (zero for a flat folder)
+            archive_days = to_bool(settings.get('archive_days', False))  # flag to pack the pictures of the finished days in day archives
+            compact_format = settings.get('compact_format', '').strip().lower()  # compacted format of the finished folders (empty to disable)
+            compact_quality = int(settings.get('compact_quality', 80))  # quality of the compacted pictures
+            replica_target = settings.get('replica_target', '').strip()  # secondary storage folder for the replicas (empty to disable)
+            replica_mbps = float(settings.get('replica_mbps', 2))  # replication bandwidth cap in MB/s (zero for no cap)
+            budget_mb = int(settings.get('budget_mb', 0))  # bytes budget (MB) of the run, zero to disable the budget mode
+            storage_watermarks = [int(v) for v in settings.get('storage_watermarks', '').split(',') if v.strip()]  # free MB watermarks
+            live_segment = int(settings.get('live_segment', 0))  # pictures per live stream segment (zero to disable)
+            live_port = int(settings.get('live_port', 8000))  # http port serving the live stream (zero for no server)
                 
             # ############################################################################
 
@@ -327,6 +362,23 @@ def setup():
     variables['fps'] = fps
     variables['overlay_fps'] = overlay_fps
     variables['overlay_text'] = overlay_text
+    variables['bg_render'] = bg_render
+    variables['overlay_info'] = overlay_info
+    variables['keep_days'] = keep_days
+    variables['keep_unrendered'] = keep_unrendered
+    variables['ram_staging'] = ram_staging
+    variables['staging_mb'] = staging_mb
+    variables['fsync_policy'] = fsync_policy
+    variables['storage_watermarks'] = storage_watermarks
+    variables['budget_mb'] = budget_mb
+    variables['archive_days'] = archive_days
+    variables['compact_format'] = compact_format
+    variables['compact_quality'] = compact_quality
+    variables['replica_target'] = replica_target
+    variables['replica_mbps'] = replica_mbps
+    variables['shard_frames'] = shard_frames
+    variables['live_segment'] = live_segment
+    variables['live_port'] = live_port
     
     variables['camera_w'] = camera_w
     variables['camera_h'] = camera_h
@@ -556,28 +608,33 @@ def power_outage_check(parent_folder, folder, pic_format, start_hhmm, end_hhmm,
         Returns the frame reference of the last saved picture in parent_folder/folder.
         Returns the quantity of days already shootted, when multiple shooting days.
         Returns a boolean if the power outage happened within the shooting period.
+        Frame numbers come from the frames index (manifest), or from the file names for pictures without manifest.
+        Pictures are checked first (integrity check): bad ones (i.e. truncated by the outage) are skipped, and their
+        frame numbers aren't used again.
     """
-    import glob
-    search_fname = os.path.join(parent_folder, folder, '*.' + pic_format)    # filename to search all the pic_format in folder
-    saved_pics = sorted(glob.iglob(search_fname), key=os.path.getmtime)      # ordered list of search_fname settings files
+    pics_folder = os.path.join(parent_folder, folder)               # pictures folder
+    if os.path.isdir(pics_folder):                                  # case the pictures folder exists
+        report = verify_folder(pics_folder, pic_format)             # pictures are checked, bad ones are skipped
+        if len(report['bad']) > 0:                                  # case of bad pictures
+            print_verify_report(report)                             # feedback is printed to the terminal
+    saved_pics, last_frame = resume_frames(pics_folder, pic_format) # saved pictures, and last frame number used
     
     if len(saved_pics) > 0:                                         # case there are files in folder
         power_outage = False                                        # power_outage is set initially False
         
         # searching filename of oldest and newest pictures
-        oldest_saved_pic = saved_pics[0]                            # filename of the oldest picture
-        newest_saved_pic = saved_pics[-1]                           # filename of the newest picture
-        last_frame = int(newest_saved_pic[-9:-4])                   # integer suffix of the newest picture
+        oldest_saved_pic = min(saved_pics.values(), key=lambda pic: frame_stat(pic)[1])  # filename of the oldest picture
+        newest_saved_pic = saved_pics[max(saved_pics)]              # filename of the newest picture
         
         
         # counting (full) days from 1st picture until today
-        oldest_pic_time = os.path.getmtime(oldest_saved_pic)        # epoch time (s) of the oldest picture
+        oldest_pic_time = frame_stat(oldest_saved_pic)[1] / 1e9     # epoch time (s) of the oldest picture
         oldest_pic_time_d = int(oldest_pic_time//86400)             # epoch time (days) of the oldest picture
         shot_days = int(time()//86400) - oldest_pic_time_d          # days difference between today and oldest picture
         
         
         # checking for power outage (last picture was taken not reaching the expected shooting end period)
-        newest_pic_time = os.path.getmtime(newest_saved_pic)                    # epoch time (s) of the newest pictur
+        newest_pic_time = frame_stat(newest_saved_pic)[1] / 1e9                 # epoch time (s) of the newest pictur
         newest_pic_time_h = datetime.fromtimestamp(newest_pic_time).hour        # hours from midnight of the newest picture
         newest_pic_time_m = datetime.fromtimestamp(newest_pic_time).minute      # minutes from the last hour of the newest picture
         newest_pic_time_s = datetime.fromtimestamp(newest_pic_time).second      # seconds from the last minute of the newest picture
@@ -612,42 +669,37 @@ def power_outage_check(parent_folder, folder, pic_format, start_hhmm, end_hhmm,
 
 
 def make_space(parent_folder):
-    """ Removes all the pictures files from the parent_folder and sub-directories. 
+    """ Removes the pictures files (and their manifest) from the parent_folder and sub-directories, and the movies
+        when erase_movies; Retention as per keep_days and keep_unrendered settings (dry run via --dry_run arg).
         Empties the Trash bin from pictures and movies.
     """
     error = 0                                         # error is set to zero (no errors)
-    folders = [x[0] for x in os.walk(parent_folder)]  # list folders in parent_folder
-    f_types = ['jpg', 'png']                          # file types to delete from folder
-    
+    f_types = ['jpg', 'png', 'jsonl', 'tar', 'idx', 'webp', 'avif']  # file types to delete from folder (pictures, day archives, manifest, compacted)
     if erase_movies:                                  # case erase_movies is set True
         f_types.append('mp4')                         # the movie extension is added to the list of file types
     
-    for directory in folders:                         # iteration over the folders
-        for f_type in f_types:                        # iteration over f_types
-            for file in os.listdir(directory): # iteration over files in directory
-                if file.endswith(f_type):             # case file ends as per f_type
-                    ret1 = system(f"sudo rm {parent_folder}/**/*.{f_type}") # delete f_type files from parent folder and sub folders
-                    if ret1 != 0:                     # case the file(s) removal returns 0
-                        print(f"Issue at removing old {f_type} picture from {directory}") # negative feedback printed to terminal
-                        error = 1                     # error variable is set to 1
-                    break                             # for loop iteration on files is interrupted
-        
+    replicated = replicated_paths(parent_folder) if variables['replica_target'] else None  # files safe to remove, when replicated
+    report = cleanup(parent_folder, f_types, keep_days=variables['keep_days'], keep_movies=not erase_movies,
+                     keep_unrendered=variables['keep_unrendered'], dry_run=dry_run, replicated=replicated)  # in process cleanup
+    print_report(report, label='Cleanup: ')           # feedback is printed to terminal
+    if report['failed'] > 0:                          # case of files not removed
+        print(f"Issue at removing old files from {parent_folder}")  # negative feedback printed to terminal
+        error = 1                                     # error variable is set to 1
+    
     if 'mp4' not in f_types:                          # case the movie type was not in the list of file types
         f_types.append('mp4')                         # file type to delete from trash bin
     
-    if os.path.exists("/home/pi/.local/share/Trash/files/"):  # if case the folder does not exist
-        for f_type in f_types:                        # iteration over f_types
-            for file in os.listdir("/home/pi/.local/share/Trash/files/"):  # iteration over files in trash bin folder
-                if file.endswith(f_type):             # case file ends as per f_type
-                    ret2 = system(f"sudo rm /home/pi/.local/share/Trash/files/*.{f_type}")  # delete f_type files from folder  
-                    ret3 = system(f"sudo rm /home/pi/.local/share/Trash/info/*.{f_type}.trashinfo") # delete f_type info from folder
-                    if ret2 != 0:                     # case the file(s) removal returns 0
-                        print(f"Issue at emptying the trash from {f_type} files")  # negative feedback printed to terminal
-                        error = 1                     # error variable is set to 1
-                    if ret3 != 0:                     # case the info removal returns 0
-                        print(f"Issue at emptying the trash from {f_type} files info") # negative feedback printed to terminal
-                        error = 1                     # error variable is set to 1
-                    break                             # for loop iteration on files is interrupted
+    trash = "/home/pi/.local/share/Trash"             # trash bin folder
+    if os.path.exists(os.path.join(trash, "files")):  # case the trash bin folder exists
+        report = cleanup(os.path.join(trash, "files"), f_types, dry_run=dry_run)  # trash bin files
+        print_report(report, label='Trash bin: ')     # feedback is printed to terminal
+        if report['failed'] > 0:                      # case of files not removed
+            print(f"Issue at emptying the trash")     # negative feedback printed to terminal
+            error = 1                                 # error variable is set to 1
+        report = cleanup(os.path.join(trash, "info"), [t + '.trashinfo' for t in f_types], dry_run=dry_run)  # trash info
+        if report['failed'] > 0:                      # case of info not removed
+            print(f"Issue at emptying the trash files info")  # negative feedback printed to terminal
+            error = 1                                 # error variable is set to 1
     return error                                      # error is returned
 
 
@@ -709,13 +761,50 @@ def preview_shoot_and_show(picam2, camera_started, preview_pic, preview_show_tim
     """
     if camera_started == False:                       # case camera_started is set False and almost time to shoot
         camera_started = start_camera(picam2, preview=False)  # starts the camera
-    ret = picam2.capture_file(preview_pic)            # camera takes and save a picture
+    ret = picam2.capture_file(temp_path(preview_pic)) # camera takes and save a picture
+    commit(temp_path(preview_pic), preview_pic)       # preview picture appears at once
     show_image(preview_pic, preview_show_time)        # call to the function to show the picture
 
 
 
 
 
+def storage_action(level):
+    """ Graded action of the storage governor, for the free space watermark level reached:
+        1 lowers the JPEG quality, 2 halves the resolution (once), 3 prunes the pictures already rendered, 4 stops
+        capturing. The free space is re-checked after each action (governor.next_level), so pruning enough space
+        skips the stop; Pruning can bring the level back, so the watermarks can be reached again later.
+    """
+    global stop_shooting
+    
+    print(f"\nStorage watermark {level} reached ({governor.status()}): {governor.actions[level]}")
+    if level == 1:                                    # case of first watermark
+        picam2.options["quality"] = min(picam2.options.get("quality", 90), 70)  # JPEG quality is lowered (picamera2 default is 90)
+        if budget is not None:                        # case of budget mode
+            budget.q_max = 70                         # budget mode doesn't raise the quality back
+            budget.quality = min(budget.quality, 70)  # current quality of the budget mode
+    
+    elif level == 2:                                  # case of second watermark
+        config = picam2.camera_configuration()        # current camera configuration
+        if tuple(config['main']['size']) == (camera_w, camera_h):  # case the resolution hasn't been lowered yet
+            config['main']['size'] = (camera_w//4*2, camera_h//4*2)  # half resolution (even values)
+            picam2.stop()                             # camera is stopped
+            picam2.configure(config)                  # smaller resolution is applied
+            picam2.start()                            # camera is re-started
+    
+    elif level == 3:                                  # case of third watermark
+        replicated = replicated_paths(parent_folder) if variables['replica_target'] else None  # files safe to remove, when replicated
+        report = cleanup(parent_folder, ['jpg', 'png'], keep_movies=True, keep_unrendered=True, replicated=replicated)  # rendered pictures
+        print_report(report, label='Pruned: ')        # feedback is printed to terminal
+    
+    elif level >= 4:                                  # case of last watermark
+        print("Shooting stopped, storage almost full")  # feedback is printed to terminal
+        stop_shooting = True                          # shooting loop is stopped
+
+
+
+
+
 def disk_space():
     """ Checks the disk space (main disk), and returns it in Mb.
     """    
@@ -805,7 +894,7 @@ def printout(day, days, pic_Mb, disk_Mb, max_pics, frames, start_now, local_cont
         if overlay_fps:
             print(f"Fps value will be overlayed on the video")
         if fix_movie_t:
-            print(f"Video rendered at {fps} fps, lasting {round(frames/fps)} secs")  
+            print(f"Video rendered at {fps} fps, lasting {movie_time_s} secs")  
     else:
         print(f"Timelapse video render not activated")
     
@@ -926,7 +1015,15 @@ def secs2hhmmss(secs):
 def display_time_left(time_left_s):
     """ Shows the left time to shooting, and turns the display backlight off.
         The display backlight is set off longer for longer left time. 
+        When a background render is ongoing, and the shooting isn't close, the render progress is shown instead.
     """
+    if time_left_s > 60 and not quitting:             # case the shooting isn't close
+        progress = check_render()                     # background render feedback
+        if progress:                                  # case of ongoing background render
+            render_progress(progress)                 # render progress to terminal and display
+            sleep(5)                                  # sleep when waiting for the planned shooting start
+            return                                    # function is terminated
+    
     # feedback is printed to display
     disp.show_on_disp4r('SHOOTING IN', secs2hhmmss(time_left_s), fs1=25, y2=55, fs2=22, y3=85, fs3=22)
     
@@ -959,6 +1056,8 @@ def display_time_left(time_left_s):
 def shoot(folder, fname, frame, pic_format, focus_ready, ref_time, display, disp_image, time_for_focus):
     """ Takes a picture, and saves it in folder with proper file name (prefix + incremental).
         When autofocus, the shoot is done once the camera confirms the focus achievement.
+        When RAM staging, the picture is saved to the staging folder and flushed later to folder (stager).
+        Returns the picture taken flag, the shoot time and the picture bytes.
     """
     
     if autofocus:                                     # case autofocus is set True (settings)
@@ -975,79 +1074,191 @@ def shoot(folder, fname, frame, pic_format, focus_ready, ref_time, display, disp
         metadata = picam2.capture_metadata()          # camera is inquired
         estimated_lux = metadata["Lux"]               # estimated lux from the camera is assigned
         if estimated_lux < lux_threshold:             # case the estimated lux is smaller than the lux_threshold (settings)
-            return False, time()                      # boolean (picture not taken), time reference of last (skipped) shoot is returned
-    
-    pic_name = '{}_{:05}.{}'.format(fname, frame, pic_format)  # file name construction for the picture
-    picture = os.path.join(folder, pic_name)          # path and file name for the picture
-    camera_info = picam2.capture_file(picture)        # camera takes and save a picture
+            return False, time(), 0                   # boolean (picture not taken), time reference of last (skipped) shoot is returned
+    
+    picture = frame_path(folder, fname, frame, pic_format, variables['shard_frames'])  # path and file name for the picture
+    pic_name = os.path.relpath(picture, folder)       # picture path in folder, for the frames index (manifest)
+    if variables['shard_frames'] > 0:                 # case the pictures are sharded in subfolders
+        make_folder(os.path.dirname(picture))         # shard subfolder is made, if missing
+    target = stager.stage_path(picture) if stager else temp_path(picture)  # file written at shooting time (RAM when staging)
+    request = picam2.capture_request()                # camera takes a picture (main and lores streams, and metadata)
+    try:                                              # tentative approach
+        save_start = time()                           # time reference for the write latency
+        request.save('main', target)                  # main stream is saved as picture
+        if not stager:                                # case of direct write
+            commit(target, picture)                   # picture appears at once (permissions, fsync, rename)
+            target = picture                          # picture written at shooting time
+        save_ms = 1000 * (time() - save_start)        # write latency, in ms
+        lores = request.make_array('lores')           # lores stream (YUV420), used for the luminance statistics
+        camera_info = request.get_metadata()          # camera metadata of the picture
+    finally:                                          # in any case
+        request.release()                             # request buffers are given back to the camera
 #     print("\n  Camera_info at picture taking", camera_info)  # camera info are printed to the terminal
     last_shoot_time = time()                          # current time is assigned to last_shoot_time 
     
+    # per-frame capture record, used by the renderer (i.e. deflicker) without opening the pictures
+    luma = float(lores[:lores.shape[0]*2//3].mean())  # mean luminance of the Y plane of the lores stream
+    check = integrity_record(target)                  # picture size and tail CRC, for the integrity check
+    append_record(folder, {'file': pic_name, 'frame': frame, 't': round(last_shoot_time, 2), 'quality': picam2.options.get('quality'),
+                           'lux': camera_info.get('Lux'), 'luma': round(luma, 2),
+                           'exposure': camera_info.get('ExposureTime'), 'gain': camera_info.get('AnalogueGain'),
+                           'sensor_t': camera_info.get('SensorTemperature'), 'cpu_t': cpu_temp(), **check})
+    
     if display and disp_image:                        # case display_image is set True
-        show_image(picture, 5)                        # image s plot on display
+        show_image(target, 5)                         # image s plot on display
     
-    ret = system(f"sudo chmod 777 {picture}")         # change permissions to the picture file: Read, write, and execute by all users
-    if ret != 0:                                      # case the permission change return an error
-        print(f"Issue at permissions changing of picture file ")  # negative feedback printed to terminal
+    pic_bytes = check['size']                         # picture size
+    if stager:                                        # case of RAM staging
+        stager.commit(target, picture, save_ms)       # picture is queued for the flush to folder
+    else:                                             # case of direct write
+        write_ms.append(save_ms)                      # write latency is stored
     
-    return True, last_shoot_time                      # boolean (picture taken), time reference of last shoot is returned
+    return True, last_shoot_time, pic_bytes           # boolean (picture taken), time reference of last shoot and bytes are returned
 
 
 
 
 
-def video_render(folder, pic_format, width, height, fps, overlay_text):
+def video_render(folder, pic_format, width, height, fps, overlay_text, movie_time_s=0, worker=None):
     """ Renders all pictures in folder to a movie.
         Saves the video in folder with proper file datetime file name.
-        When the setting constrains the video to a fix time, the fps are adapted.
+        When the setting constrains the video to a fix time (movie_time_s > 0), the fps are adapted; In case of
+        too many frames for the movie time, an evenly spaced subset is rendered (only these are decoded).
+        When overlay_info is set True, capture time, lux and temperature of each frame (manifest) are burned in.
+        When worker (RenderWorker) is provided, the render is queued to the background process and the function
+        returns immediately; The pictures are then always listed (ffconcat), so the next day shoots are excluded.
+        Renders not fitting the idle time before the next shooting window are queued as segments (render_jobs).
+        The movie is written as partial file, renamed once complete; Queued renders get a checkpoint, to be
+        resumed after a power outage (resume_renders).
     """
 
-    print(f"\n\nVideo rendering started")             # feedback is printed to the terminal
+    print(f"\n\nVideo rendering {'queued' if worker else 'started'}")  # feedback is printed to the terminal
     if display:                                       # case display is set True                              
         set_display_backlight(modified_disp,disp_bright)  # display backlight is set to disp_bright
-        disp.show_on_disp4r('RENDERING', 'ONGOING', fs1=30, y2=75, fs2=32) # feedback is printed to the display
+        disp.show_on_disp4r('RENDERING', 'QUEUED' if worker else 'ONGOING', fs1=30, y2=75, fs2=32) # feedback is printed to the display
         sleep(4)                                      # sleep time in between time checks
     
     render_start = time()                             # time reference for the rendering process
         
     render_warnings = False                           # flag to printout the rendering ffmpeg error 
-    render_progress = False                           # flag to printout the rendering progress (statistics)
     
     loglevel = '' if render_warnings else '-loglevel error'  # loglevel parameter setting
-    
-    # NOTE ffmpeg stats aren't updated when the comand is send through python
-    if render_progress:                               # case render_progress is set True
-        stats = '-stats'                              # stats parameter is set as active
-        stats_period = 20                             # time interval (secs) for the stats update
-    else:                                             # case render_progress is set False
-        stats = '-nostats'                            # tats parameter is set as not active
+    stats = '-nostats'                                # ffmpeg stats are replaced by the parsed -progress output
     
     pic_files = os.path.join(parent_folder, folder, '*.' + pic_format)   # input images files
-    out_file = os.path.join(parent_folder, folder, strftime("%Y%m%d_%H%M%S", localtime())+'.mp4')  # output video file
+    stamp = strftime("%Y%m%d_%H%M%S", localtime())    # datetime string for the file names
+    out_file = os.path.join(parent_folder, folder, stamp + '.mp4')  # output video file
+    partial = partial_file(out_file)                  # file written by ffmpeg, renamed to out_file when complete
+    list_file = os.path.join(parent_folder, folder, stamp + '.ffconcat')  # list of frames, when decimated or queued
     size = str(width)+'x'+str(height)                 # frame size
     
-    
+    report = verify_folder(os.path.join(parent_folder, folder), pic_format)  # pictures are checked, bad ones are skipped
+    if len(report['bad']) > 0:                        # case of bad pictures
+        print_verify_report(report)                   # feedback is printed to the terminal
+    frames = list_frames(os.path.join(parent_folder, folder), pic_format)  # sorted list of pictures
+    if len(frames) == 0:                              # case there are no pictures to render
+        print("No pictures to render")                # feedback is printed to the terminal
+        return                                        # function is terminated
+    framerate, decimated = fps, False                 # framerate and decimation, when the movie time is not fixed
+    if movie_time_s > 0:                              # case the movie time is fixed
+        frames, framerate, decimated = fit_to_time(frames, movie_time_s, variables['fps'])  # frames and framerate for exact time
+    overlays = overlay_texts(frames) if variables['overlay_info'] else None  # per-frame overlay texts, from the manifest
+    pic_input = image_input(frames, framerate, pic_files, list_file, decimated or worker is not None, overlays)  # ffmpeg input arguments
+    
+    
+    filters = [overlay_filter(height)] if overlays else []  # drawtext printing the per-frame overlay text
     if overlay_text != '':                            # case overlay_text is not an empty string
         text = overlay_text                           # overlay_text is assigned to text (shorter name)
-        font = '/usr/share/fonts/truetype/freefont/dejavu/DejaVuSans.ttf'
         fcol = 'white'                                # font color
         fsize = '48'                                  # font size
         bcol = 'black@0.5'                            # box color with % of transparency
         pad = str(round(int(fsize)/5))                # 20% of the font size
         pos_x = '70'                                  # reference from the left
         pos_y = str(height - 70)                      # reference from the bottom
-        v_f = (f"drawtext=fontfile={font}:text={text}:fontcolor={fcol}:fontsize={fsize}:box=1:boxcolor={bcol}:boxborderw={pad}:x={pos_x}:y={pos_y}")
+        v_f = (f"drawtext={font_option()}text={text}:fontcolor={fcol}:fontsize={fsize}:box=1:boxcolor={bcol}:boxborderw={pad}:x={pos_x}:y={pos_y}")
+        filters.append(v_f)                           # static text drawtext is added to the filters
+    
+    if len(filters) > 0:                              # case of text overlays
+        v_f = ','.join(filters)                       # filters chain
 #         print(v_f)
-        render_command = f"ffmpeg {stats} {loglevel} -f image2 -framerate {fps} -pattern_type glob -i '{pic_files}' -s '{size}'  -vf '{v_f}' '{out_file}' -y"
+        render_command = f"ffmpeg {stats} {loglevel} {pic_input} -s '{size}'  -vf '{v_f}' '{partial}' -y"
 #         print(render_command)
     else:                                             # case text is an empty string
-        render_command = f"ffmpeg {stats} {loglevel} -f image2 -framerate {fps} -pattern_type glob -i '{pic_files}' -s '{size}' {out_file} -y"
+        render_command = f"ffmpeg {stats} {loglevel} {pic_input} -s '{size}' '{partial}' -y"
+    
+    if worker:                                        # case of background render
+        jobs = render_jobs(worker, render_command, pic_input, frames, framerate, list_file, out_file, size, overlays)
+        save_checkpoint(out_file, jobs, frames)       # render checkpoint, for resuming after a power outage
+        worker.queue(jobs)                            # jobs are queued to the background worker
+        est_s = sum([job['est_s'] for job in jobs])   # estimated render time
+        print(f"Render estimated in {secs2hhmmss(round(est_s))}", end=' ')  # feedback is printed to the terminal
+        print(f"(queued as {len(jobs)-1} segments, in between shooting windows)" if len(jobs) > 1 else '')
+        return                                        # function is terminated
     
-    ret = system(render_command)                      # ffmpeg command is passed to system
+    ret = run_ffmpeg(render_command, len(frames), render_progress)  # ffmpeg is run, with progress feedback
+    commit_partial(ret, partial, out_file)            # movie renamed to out_file when complete
+    if os.path.exists(list_file):                     # case the list of frames has been made
+        os.remove(list_file)                          # list of frames is removed
     
-    render_time = timedelta(seconds=round(time() - render_start))  # rendering time is calculated
+    render_result(ret, out_file, len(frames), size, time() - render_start)  # render result feedback
+
+
+
+
+
+def render_jobs(worker, render_command, pic_input, frames, framerate, list_file, out_file, size, overlays=None):
+    """ Returns the list of background render jobs.
+        A single job when the render fits the idle time before the next shooting window (or no more windows).
+        Otherwise segments fitting the idle gap in between windows (estimated via past timings), followed by
+        a job joining the segments to out_file via ffmpeg concat (stream copy, no re-encoding).
+        overlays (per-frame texts, when any) are split as the frames.
+        Each job commits its partial file (segment or movie); The last job removes the render checkpoint.
+    """
+    speed = render_speed('pictures', size)            # expected render speed (fps) of the board
+    est_s = len(frames) / speed                       # estimated render time
+    partial = partial_file(out_file)                  # file written by ffmpeg, renamed to out_file when complete
+    checkpoint = checkpoint_file(out_file)            # render checkpoint, removed by the last job
+    time_left = worker.time_to_window()               # secs to the next shooting window
+    if time_left is None or est_s + worker.margin_s <= time_left or worker.gap_s <= 0:  # case the render fits
+        return [{'command': render_command, 'frames': len(frames), 'size': size, 'out_file': out_file,
+                 'commit': [partial, out_file], 'temp_files': [list_file, checkpoint], 'est_s': est_s}]  # single job
+    
+    if os.path.exists(list_file):                     # case the list of all the frames has been made
+        os.remove(list_file)                          # list is removed (each segment has its own)
+    segments = split_frames(frames, 0.8 * speed * max(worker.gap_s - worker.margin_s, 0))  # frames per segment
+    base = out_file[:-4]                              # output file without extension
+    jobs, seg_files, offset = [], [], 0               # jobs, segments files and frames offset
+    for i, seg in enumerate(segments):                # iteration over the segments
+        seg_file = f"{base}_seg{i:03}.mp4"            # segment video file
+        seg_list = f"{base}_seg{i:03}.ffconcat"       # segment list of frames
+        seg_overlays = overlays[offset:offset+len(seg)] if overlays else None  # overlay texts of the segment
+        seg_input = image_input(seg, framerate, '', seg_list, True, seg_overlays)  # ffmpeg input arguments of the segment
+        command = render_command.replace(pic_input, seg_input).replace(partial, partial_file(seg_file))  # segment command
+        jobs.append({'command': command, 'frames': len(seg), 'size': size, 'out_file': out_file,
+                     'commit': [partial_file(seg_file), seg_file], 'offset': offset, 'total': len(frames), 'temp_files': [seg_list], 'final': False,
+                     'label': f"segment {i+1}/{len(segments)}", 'est_s': len(seg) / speed})  # segment job
+        seg_files.append(seg_file)                    # segment file is appended
+        offset += len(seg)                            # frames offset of the next segment
+    
+    concat_list = base + '_segments.ffconcat'         # list of the segments
+    write_concat_list(seg_files, concat_list)         # segments list is written
+    jobs.append({'command': concat_command(concat_list, partial), 'frames': len(frames), 'size': size, 'out_file': out_file,
+                 'commit': [partial, out_file], 'temp_files': seg_files + [concat_list, checkpoint],
+                 'label': 'join', 'est_s': 0})  # join job
+    return jobs                                       # list of jobs is returned
+
+
+
+
+
+def render_result(ret, out_file, frames, size, render_s, save_timing=True):
+    """ Feedback (terminal and display) of a render result; The timing is saved when successful (and save_timing).
+    """
+    render_time = timedelta(seconds=round(render_s))  # rendering time as timedelta
     
     if ret==0:                                        # case no error is returned
+        if save_timing:                               # case the timing has to be saved
+            save_render_timing('pictures', frames, size, render_s)  # render timing record is saved
         print(f"Timelapse successfully rendered, in {render_time} secs")  # feednback is printed to terminal
         print(f"Timelase saved as {out_file} \n")     # reference to the vieo location is printed to terminal
         if display:                                   # case display is set True                              
@@ -1069,6 +1280,126 @@ def video_render(folder, pic_format, width, height, fps, overlay_text):
 
 
 
+def render_progress(progress):
+    """ Shows the render progress (frames, fps, percent and ETA) on the terminal and on the display.
+    """
+    print_progress(progress)                          # progress is printed to the terminal
+    if display:                                       # case display is set True
+        eta = secs2hhmmss(round(progress['eta_s']))   # ETA as hh:mm:ss string
+        disp.display_progress_bar(progress['percent'], 0, 0, progress['frame'],
+                                  row1='RENDER {:05}'.format(progress['frame']), row2='ETA ' + eta)
+        set_display_backlight(modified_disp,disp_bright)  # display backlight is set to disp_bright
+
+
+
+
+
+def check_render():
+    """ Collects the feedback of the background render worker (when used), and sends it the next queued job
+        when it fits the idle time before the next shooting window.
+        Returns the last progress dict of the ongoing render, or None when no render is ongoing.
+    """
+    if render_worker is None:                         # case the background render worker isn't used
+        return None                                   # no ongoing render
+    
+    for msg in render_worker.poll():                  # iteration over the worker messages
+        if msg['state'] == 'started':                 # case a render (or segment) has started
+            print(f"\nBackground rendering started: {msg['out_file']}")  # feedback is printed to the terminal
+        elif msg['state'] == 'done':                  # case a render (or segment) has ended
+            print()                                   # new line after the progress line
+            if not msg['final'] and msg['ret'] == 0:  # case of segment successfully rendered
+                save_render_timing('pictures', msg['frames'], msg['size'], msg['active_s'])  # timing record is saved
+                print(f"Timelapse {msg['label']} rendered, in {secs2hhmmss(round(msg['active_s']))}")
+            else:                                     # case of render done, or segment error
+                if msg['ret'] != 0:                   # case of error
+                    render_worker.cancel(msg['out_file'])  # next segments of the render are cancelled
+                render_result(msg['ret'], msg['out_file'], msg['frames'], msg['size'],
+                              msg.get('render_s', msg['active_s']), save_timing=msg['label']=='')  # render result
+    
+    if render_worker.paused:                          # case the worker is paused (shooting window)
+        return None                                   # no progress to show
+    render_worker.dispatch()                          # next queued job, when it fits the idle time
+    return render_worker.progress                     # last progress of the ongoing render
+
+
+
+
+
+def wait_render():
+    """ Waits for the background renders to be done, showing their progress.
+    """
+    if render_worker is None:                         # case the background render worker isn't used
+        return                                        # nothing to wait for
+    
+    render_worker.resume()                            # worker is resumed, if paused
+    render_worker.next_window = None                  # no more shooting windows
+    while render_worker.busy():                       # while renders are queued or ongoing
+        progress = check_render()                     # worker feedback, and next queued job
+        if progress and not quitting:                 # case of ongoing render
+            render_progress(progress)                 # progress to terminal and display
+        if render_worker.pending > 0 and not render_worker.process.is_alive():  # case the worker has died
+            print("Background render worker ended unexpectedly")  # feedback is printed to the terminal
+            break                                     # while loop is interrupted
+        sleep(2)                                      # sleep time in between checks
+    check_render()                                    # last worker feedback
+    render_worker.stop(wait=True)                     # worker is stopped
+
+
+
+
+
+def idle_schedule(windows_left):
+    """ Returns the epoch time of the next shooting window start (None when no windows are left), and the
+        idle time (secs) in between two consecutive shooting windows.
+    """
+    if start_now or windows_left <= 0:                # case there are no more shooting windows
+        return None, 0                                # no next window, no idle gap
+    
+    start_s, end_s, _ = start_time_end_time(start_hhmm, end_hhmm, interval_s)  # shooting window (secs from midnight)
+    shoot_s = (end_s - start_s) % 86400               # shooting time, also when crossing midnight
+    midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()  # last midnight (epoch)
+    next_start = midnight + start_s                   # today shooting start (epoch)
+    if next_start <= time():                          # case today shooting start is already passed
+        next_start += 86400                           # next shooting start is tomorrow
+    return next_start, 86400 - shoot_s                # next window start and idle gap are returned
+
+
+
+
+
+def resume_renders(parent_folder):
+    """ Startup check of the renders interrupted by a power outage, in parent_folder and its folders (i.e. the
+        date folders of the previous days): partial movies and orphan segments are listed and removed; Renders
+        with a checkpoint are queued again to the background worker (only the jobs not done yet), otherwise
+        their leftovers are removed too.
+    """
+    with os.scandir(parent_folder) as entries:        # single pass over the parent folder
+        folders = [e.path for e in entries if e.is_dir() and not e.name.startswith('.')]  # pictures folders
+    partials, checkpoints = [], []                    # empty lists to store the leftovers
+    for folder in [parent_folder] + sorted(folders):  # iteration over the folders
+        leftovers = partial_outputs(folder)           # leftovers of interrupted renders in folder
+        partials += leftovers[0]                      # partial files and orphan segments
+        checkpoints += leftovers[1]                   # render checkpoints
+    for fname in partials:                            # iteration over the partial files
+        print(f"Removing partial render output: {fname} ({os.path.getsize(fname)//1024} KB)")
+        os.remove(fname)                              # partial file is removed
+    
+    for fname in checkpoints:                         # iteration over the render checkpoints
+        resumed = resume_jobs(fname) if render_worker is not None else None  # frames and jobs still to be done
+        if resumed is not None and len(resumed[1]) > 0:  # case the render can be resumed
+            jobs = resumed[1]                         # jobs still to be done
+            render_worker.queue(jobs)                 # jobs are queued to the background worker
+            print(f"Render resumed: {jobs[-1]['out_file']}, {len(jobs)} jobs left")  # feedback is printed to the terminal
+            continue                                  # next checkpoint
+        base = fname[:-len('.render.json')]           # movie file name without extension
+        for leftover in glob.glob(glob.escape(base) + '_seg*') + [fname]:  # segments, their lists and the checkpoint
+            print(f"Removing interrupted render file: {leftover}")  # feedback is printed to the terminal
+            os.remove(leftover)                       # leftover is removed
+
+
+
+
+
 def cpu_temp():
     """ Returns the cpu temperature.
     """
@@ -1226,6 +1557,7 @@ def wait_until(time_for_focus, disp_preview, preview_pic, preview_show_time, int
     if time_left_s >= t:                              # case the time left for shooting is bigger than t
         while time_left_s >= t:                       # while time left for shooting is bigger than time t
             now_s, time_left_s = time_update(start_time_s)  # current time, and time left to shooting start, is retrieved again
+            check_render()                            # background render feedback, and scheduling
             if display and not quitting:              # case display is set True
                 display_time_left(time_left_s)        # prints left lime to display, and pause
             if disp_preview:                          # case display_preview
@@ -1274,6 +1606,7 @@ def wait_until_next_day(start_time_s, end_time_s, disp_preview, preview_pic, pre
 # ##################################################################################################
                 
             now_s, time_left_s = time_update(start_time_s)  # current time, and time left to shooting start of the next day
+            check_render()                            # background render feedback, and scheduling
             if display and not quitting:              # case display is set True
                 display_time_left(time_left_s + 86400)  # prints left lime to display, and pause
             if disp_preview:                          # case display_preview
@@ -1531,6 +1864,24 @@ def exit_func(error):
     except:                                           # exception
         print("\nFailing to close the Picamera")      # feedback is printed to the terminal
     
+    if render_worker is not None:                     # case the background render worker is used
+        render_worker.stop()                          # worker (and ffmpeg) are terminated
+    
+    if live_stream is not None:                       # case the live stream is used
+        live_stream.close(ended=False)                # http server is stopped (stream continues at the next start)
+    
+    if stager is not None:                            # case the pictures are staged in RAM
+        stager.close()                                # staged pictures are flushed to their folders
+    
+    if packer is not None:                            # case the day archives are used
+        packer.close(wait=False)                      # packing stops at the next batch (it continues at the next start)
+    
+    if compactor is not None:                         # case the finished folders are compacted
+        compactor.close()                             # compaction stops at the next batch of pictures (it continues at the next start)
+    
+    if replicator is not None:                        # case the files are replicated
+        replicator.close(wait=False)                  # replication stops at the next file (it resumes at the next start)
+    
     if not rendering_phase:                           # case rendering_phase is set False
         try:                                          # tentative approach
             disp.clean_display()                      # cleans the display
@@ -1574,6 +1925,15 @@ if __name__ == "__main__":
     parent_folder = '/home/pi/shared'          
     
     rendering_phase = False                    # flag covering the rendering period, is set False
+    render_worker = None                       # background render worker (when render_worker setting is True)
+    live_stream = None                         # rolling live stream (when live_segment setting is > 0)
+    governor = None                            # storage governor (when storage_watermarks are set)
+    budget = None                              # JPEG quality controller of the budget mode (when budget_mb is set)
+    stager = None                              # RAM staged writer (when ram_staging is set True)
+    write_ms = []                              # pictures write latencies (direct write), in ms
+    packer = None                              # day archives packer (when archive_days is set True)
+    compactor = None                           # compactor of the finished folders (when compact_format is set)
+    replicator = None                          # replication to the secondary storage (when replica_target is set)
     quitting = False                           # flag covering the quitting phase, is set False
     button_pressed = False                     # button_pressed is set False
     stop_shooting = False                      # flag to stop shooting on a day when multiple days
@@ -1644,6 +2004,8 @@ if __name__ == "__main__":
     fps = variables['fps']
     overlay_fps = variables['overlay_fps']
     overlay_text = variables['overlay_text']
+    if rendering and variables['bg_render']:  # case rendering is handed to the background worker
+        render_worker = RenderWorker()         # background low priority render worker
     
     camera_w = variables['camera_w']
     camera_h = variables['camera_h']
@@ -1692,6 +2054,10 @@ if __name__ == "__main__":
         if debug:                              # case debug is set True
             print("Folder for pictures (set via arguments):", folder)  # feedback is printed to the terminal
 
+    dry_run = False                            # flag for the cleanup to only list the files to be removed
+    if args.dry_run:                           # case the script has been launched with 'dry_run' argument
+        dry_run = True                         # cleanup lists the old files, without removing them
+    
     if args.render != None:                    # case the 'render' argument exists
         if args.render:                        # case the script has been launched with 'render' argument
             rendering = True                   # flag to enable/disable video rendering is set True
@@ -1750,11 +2116,31 @@ if __name__ == "__main__":
         folder = str(now.strftime('%Y%m%d'))   # folder name is retrieved as yyyymmdd
     folder = os.path.join(parent_folder, folder) # folder will be appended to the parent folder
     
-    if not os.path.exists(folder):             # case the folder does not exist
-        os.makedirs(folder)                    # folder is made
-        ret = system(f"sudo chmod 777 {folder}")  # change permissions to the folder: Read, write, and execute by all users
-        if ret != 0:                           # case the permission change return an error
-            print(f"Issue at changing the folder permissions") # negative feedback printed to terminal
+    set_policy(variables['fsync_policy'])      # fsync policy of the committed files (pictures, movies, state)
+    try:                                       # tentative approach
+        make_folder(folder)                    # folder is made, if missing (read, write, and execute by all users)
+    except OSError as e:                       # case the folder can't be made, or its permissions changed
+        print(f"Issue at making the folder or changing its permissions ({e})")  # negative feedback printed to terminal
+    
+    swept = sweep_temp(parent_folder)          # temporary files left by a crash before their commit
+    if swept > 0:                              # case of temporary files removed
+        print(f"Temporary files left by an interruption removed: {swept}")  # feedback is printed to the terminal
+    
+    if variables['ram_staging']:               # case the pictures are staged in RAM
+        stager = StagedWriter(max_mb=variables['staging_mb'])  # staged writer (pictures left by a crash are recovered)
+        stager.flush()                         # recovered pictures are written to their folders
+    
+    if variables['archive_days']:              # case the pictures of the finished days are packed
+        packer = ArchivePacker(pic_format)     # background packer of the day archives
+    
+    if variables['compact_format'] and not available(variables['compact_format']):  # case the format can't be encoded
+        print(f"Compaction format {variables['compact_format']} not supported by PIL, compaction not used")
+    elif variables['compact_format']:          # case the finished folders are compacted
+        compactor = Compactor(pic_format, variables['compact_format'], variables['compact_quality'],
+                              idle=lambda: render_worker is None or not render_worker.busy())  # idle time only
+    
+    if variables['replica_target']:            # case the files are replicated to a secondary storage
+        replicator = Replicator(variables['replica_target'], variables['replica_mbps'])  # background replication
     
     preview_pic = os.path.join(folder,"preview.jpg")  # path and filename for the preview picture
     preview_show_time = 5
@@ -1784,6 +2170,8 @@ if __name__ == "__main__":
     error, pic_size_bytes, pic_Mb = test_camera(pic_test_fname)         # test picture is made, measured, removed
     if error > 0:                              # case of an error
         exit_func(error)                       # exit function is called
+    if len(variables['storage_watermarks']) > 0:  # case the storage governor is set
+        governor = StorageGovernor(folder, pic_size_bytes, interval_s, variables['storage_watermarks'])
     # ###############################################################################################
     
     
@@ -1811,6 +2199,22 @@ if __name__ == "__main__":
     
     
     
+    ################  check for renders interrupted by a power outage  ##############################
+    resume_renders(parent_folder)              # partial outputs are removed, checkpointed renders are resumed (all the folders)
+    # ###############################################################################################
+    
+    
+    
+    ################  rolling live stream of the timelapse in progress  #############################
+    if variables['live_segment'] > 0:          # case the live stream is set
+        live_stream = LiveStream(os.path.join(parent_folder, 'live'), variables['live_segment'], fps,
+                                 port=variables['live_port'])  # live stream continues, if interrupted
+        if stager is not None:                 # case the pictures are staged in RAM
+            live_stream.ready = stager.is_flushed  # segments are encoded once their pictures are flushed
+    # ###############################################################################################
+    
+    
+    
     ################  timing for the shoot management   ############################################
     # in this call to the function the power_outage plays a role
     start_time_s, end_time_s, shoot_time_s = time_management(start_hhmm,
@@ -1824,6 +2228,19 @@ if __name__ == "__main__":
     
     
     
+    ################  budget mode: JPEG quality adapted to the bytes budget of the run   #############
+    if variables['budget_mb'] > 0:             # case the budget mode is set
+        _, _, day_shoot_s = time_management(start_hhmm, end_hhmm, start_now, period_hhmm, interval_s,
+                                            last_frame, power_outage = False)  # shooting time of a full day
+        planned = 1 + int(shoot_time_s/interval_s) + max(days - past_days - 1, 0) * (1 + int(day_shoot_s/interval_s))
+        used = sum([frame_stat(pic)[0] for pic in list_frames(folder, pic_format)])  # bytes of the pictures already taken
+        budget = QualityBudget(folder, variables['budget_mb'] * 1048576, planned, pic_size_bytes, used,
+                               quality=picam2.options.get("quality", 90))  # quality controller
+        print(f"Budget mode: {budget.status()}")  # feedback is printed to the terminal
+    # ###############################################################################################
+    
+    
+    
     ################  change time management system  ################################################
     # NOTE: from here onward time is managed in seconds from EPOCH time (as per 'time' module)
     current_time = datetime.fromtimestamp(time()) # convert current epoch time to datetime object
@@ -1880,11 +2297,38 @@ if __name__ == "__main__":
             
         # erasing pictures daily when the rendering is set True
         if rendering:                          # if rendering is set True (it renders every day!)
-            error = make_space(parent_folder)  # emptying the folder from old pictures
+            check_render()                     # background render feedback
+            if render_worker is not None and render_worker.busy():  # case a background render is still to be done
+                print("Old pictures not erased, as still being rendered")  # feedback is printed to the terminal
+            else:                              # case no background render is pending
+                if stager is not None:         # case the pictures are staged in RAM
+                    stager.flush()             # staged pictures are written to their folders
+                if packer is not None:         # case the day archives are used
+                    packer.wait()              # packing of the previous days is completed
+                if compactor is not None:      # case the finished folders are compacted
+                    compactor.pause()          # compaction is paused, not to compete with the erasing
+                error = make_space(parent_folder)  # emptying the folder from old pictures
+        
+        if packer is not None and (render_worker is None or not render_worker.busy()):  # case no render reads the loose pictures
+            packer.add(folder)                 # pictures of the finished days are packed (background, paused while shooting)
+        
+        if compactor is not None:              # case the finished folders are compacted
+            for f in finished_folders(parent_folder, folder):  # iteration over the rendered folders of previous runs
+                compactor.add(f)               # pictures are compacted (background, idle time only)
+        
+        if replicator is not None:             # case the files are replicated
+            for f in glob.glob(manifest_file(os.path.join(parent_folder, '*'))):  # iteration over the pictures folders
+                replicator.add(os.path.dirname(f))  # new files are replicated (resumed from the journals)
         
         disk_Mb = disk_space()                 # disk free space
+        if governor is not None:               # case of storage governor
+            pic_Mb = round(governor.frame_bytes/1024/1024, 2)  # average size of the pictures taken so far
+        if budget is not None:                 # case of budget mode
+            pic_Mb = round(budget.frame_bytes/1024/1024, 2)  # average size of the pictures taken so far
+            print(f"\nBudget mode: {budget.status()}")  # feedback is printed to the terminal
         max_pics = int(disk_Mb/pic_Mb)         # rough amount of allowed pictures quantity in disk
-        fps = round(frames/movie_time_s) if fix_movie_t else fps  # in case fix_movie_t is set True (forced movie time) the fps is calculated
+        if fix_movie_t:                        # case fix_movie_t is set True (forced movie time)
+            fps = round(fit_to_time(range(frames), movie_time_s, variables['fps'])[1])  # fps of the rendered movie, as per fit_to_time
         fps = 1 if fps < 1 else fps            # avoiding fps = 0
      
         now_s, time_left_s = time_update(start_time_s)  # current time, and time left to shooting start, is retrieved
@@ -1902,6 +2346,16 @@ if __name__ == "__main__":
             now_s, time_left_s, start_time_s = wait_until(time_for_focus, disp_preview, preview_pic, preview_show_time,
                                                           interval_s, start_time_s, end_time_s, camera_started)
         
+        if render_worker is not None:          # case the background render worker is used
+            check_render()                     # background render feedback
+            render_worker.pause()              # render is paused, not to steal CPU from capture
+        
+        if packer is not None:                 # case the day archives are used
+            packer.pause()                     # packing is paused, not to steal storage bandwidth from capture
+        
+        if compactor is not None:              # case the finished folders are compacted
+            compactor.pause()                  # compaction is paused, not to steal CPU from capture
+        
         if preview:                            # case preview is set True
             start_preview(picam2)              # preview stream is started
         
@@ -1947,7 +2401,7 @@ if __name__ == "__main__":
                 
                 if not quitting:                   # case quitting is set False
                     # calls the shooting function
-                    ret, last_shoot_time = shoot(folder, pic_name, frame, pic_format, focus_ready, ref_time, display, disp_image, time_for_focus)
+                    ret, last_shoot_time, pic_bytes = shoot(folder, pic_name, frame, pic_format, focus_ready, ref_time, display, disp_image, time_for_focus)
                     
                     if not ret:                    # case a picture has not been taken
                         if power_outage and lux_check and print_once:    # case there was power outage and lux_check is set True
@@ -1963,6 +2417,22 @@ if __name__ == "__main__":
                         
                         if first_shoot:            # case first_shoot is set True
                             first_shoot = False    # first_shoot is set False
+                        
+                        picture = frame_path(folder, pic_name, frame, pic_format, variables['shard_frames'])  # picture just taken
+                        if live_stream is not None:  # case the live stream is used
+                            live_stream.add(picture)  # picture is added to the live stream
+                        
+                        if governor is not None:   # case of storage governor
+                            level = governor.update(pic_bytes)  # first watermark level newly reached, if any
+                            while level > 0:       # case of watermark level to act on
+                                storage_action(level)  # graded action
+                                level = governor.next_level()  # free space re-checked after the action
+                        
+                        if budget is not None:     # case of budget mode
+                            picam2.options["quality"] = budget.update(pic_bytes)  # JPEG quality of the next frame
+                        
+                        if replicator is not None and frame_d % 50 == 0:  # case of replication, every 50 frames
+                            replicator.add(folder) # new pictures are replicated (background, bandwidth capped)
                             
                         frame+=1                   # frame variable (used for picture name) is incremented by one each shoot
                         frame_d+=1                 # frame_d variable (used for shooting timing) is incremented by one each day
@@ -2040,16 +2510,40 @@ if __name__ == "__main__":
             picam2.stop()                          # picamera object is closed
             camera_started = False                 # camera_started variable is set False
         
+        if stager is not None:                     # case the pictures are staged in RAM
+            stager.flush()                         # pictures of the day are written to their folder
+        
         if rendering and not quitting:             # case rendering is set True and button isn't pressed (as per quitting intention)
             if disp_preview and not start_now:     # case disp_preview is set True
                 if  os.path.exists(disp_preview):  # case the folder does not exist
                     os.remove(preview_pic)         # preview picture is removed
 
-            rendering_phase = True                 # rendering_phase variable is set True
-            video_render(folder, pic_format, camera_w, camera_h, fps, overlay_text)   # calls to function for video rendering
-            rendering_phase = False                # rendering_phase variable is reset tp False
+            if render_worker is not None:          # case the background render worker is used
+                render_worker.next_window, render_worker.gap_s = idle_schedule(days - day - 1)  # idle time for the renders
+                render_worker.resume()             # paused render (previous days) is resumed
+                video_render(folder, pic_format, camera_w, camera_h, fps, overlay_text,
+                             movie_time_s if fix_movie_t else 0, render_worker)  # render is queued to the worker
+            else:                                  # case of rendering in the main loop
+                rendering_phase = True             # rendering_phase variable is set True
+                video_render(folder, pic_format, camera_w, camera_h, fps, overlay_text,
+                             movie_time_s if fix_movie_t else 0)   # calls to function for video rendering
+                rendering_phase = False            # rendering_phase variable is reset tp False
+        
+        if packer is not None:                     # case the day archives are used
+            packer.resume()                        # packing continues in between the shooting windows
+        
+        if compactor is not None:                  # case the finished folders are compacted
+            compactor.resume()                     # compaction continues in idle time (no render pending)
+        
+        if replicator is not None:                 # case the files are replicated
+            replicator.add(folder)                 # pictures of the day (and the movie) are replicated
         
         print("\nCPU temp:", cpu_temp())           # cpu temperature is printed to terminal
+        for line in (stager.report() if stager is not None else [latency_report('Picture write', write_ms)]):
+            if line:                               # case of latency samples
+                print(line)                        # write latency percentiles are printed to terminal
+        if commit_report():                        # case of committed files
+            print(commit_report())                 # file commit timing counters are printed to terminal
         
         
         # AF: Double check if next two rows are really needed
@@ -2077,6 +2571,19 @@ if __name__ == "__main__":
     ######################################   closing stuff  #########################################
     #################################################################################################
     if not quitting:                               # case quitting is set False (quitting not already called)
+        if live_stream is not None:                # case the live stream is used
+            live_stream.close()                    # last pictures are encoded, and the playlist is finished
+        rendering_phase = True                     # rendering_phase variable is set True
+        wait_render()                              # waits for the background renders to be done
+        rendering_phase = False                    # rendering_phase variable is reset tp False
+        if packer is not None:                     # case the day archives are used
+            print("\nPacking the pictures in day archives")  # feedback is printed to the terminal
+            packer.add(folder, today=True)         # all the pictures of the folder are packed
+            packer.close()                         # waits for the packing to be done
+        if replicator is not None:                 # case the files are replicated
+            print("\nReplicating the last files to", variables['replica_target'])  # feedback is printed to the terminal
+            replicator.add(folder)                 # last pictures, movies and archives are replicated
+            replicator.close()                     # waits for the replication to be done
         exit_func(error)                           # exit function is called  
     # ###############################################################################################
     
\ No newline at end of file
@@ -0,0 +1,404 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+#############################################################################################################
+#  Timelapse application, day archives of the pictures
+#
+#  The pictures of a finished day are packed into a single file per day (frames_yyyymmdd.tar), in the
+#  pictures folder: a plain tar (ustar, uncompressed) of the concatenated pictures, therefore readable by any
+#  tar tool (tar -xf frames_yyyymmdd.tar); Each archive has an offset index (frames_yyyymmdd.idx, json) with
+#  the name, data offset, size and modification time of each picture.
+#  Packing is incremental: pictures are appended in batches, each batch is fsync-ed before the index is
+#  replaced (atomic), and only then the loose pictures are removed; After a crash the archive is truncated to
+#  the last indexed batch, and packing continues from there.
+#  Archived frames keep their path (folder/picture name) in the renderer: ffmpeg reads them in place via the
+#  subfile protocol (ffconcat lists), python reads them via a memory map of the archive (no extraction).
+#
+#  Usage: python timelapse_archive.py FOLDER [--all] (pack), --list, or --extract DEST
+#############################################################################################################
+"""
+
+
+from threading import Thread, Event, get_native_id
+from queue import Queue
+from datetime import datetime
+from time import time
+from timelapse_manifest import shard_folders
+from timelapse_commit import atomic_file
+import os.path, glob, json, mmap, io, tarfile, argparse
+
+
+archive_prefix = 'frames_'                            # archive (and index) file names prefix
+archive_ext = '.tar'                                  # archive file extension
+index_ext = '.idx'                                    # index file extension
+_indexes = {}                                         # archived frames per folder: folder -> (folder mtime, frames)
+_maps = {}                                            # memory maps of the archives: archive path -> (file, mmap)
+
+
+
+
+def archive_files(folder, day):
+    """ Returns the archive and index paths of day (yyyymmdd string) in folder.
+    """
+    base = os.path.join(folder, archive_prefix + day) # path without extension
+    return base + archive_ext, base + index_ext       # archive and index paths are returned
+
+
+
+
+
+def read_index(index_file):
+    """ Returns the index dict (end of the indexed data, and frames as [name, offset, size, mtime_ns]).
+        A missing or unreadable index is an empty archive.
+    """
+    try:                                              # tentative approach
+        with open(index_file, 'r') as f:              # index file is opened in reading mode
+            return json.load(f)                       # index is returned
+    except (OSError, ValueError):                     # case of missing or truncated index
+        return {'end': 0, 'frames': []}               # empty index is returned
+
+
+
+
+
+def write_index(index_file, index):
+    """ Writes the index (atomic commit), so a power outage leaves the old or the new one.
+    """
+    with atomic_file(index_file) as f:                # index is committed when written
+        json.dump(index, f)                           # index is written
+
+
+
+
+
+def archive_index(folder):
+    """ Returns the archived frames of folder, as dict: picture name -> (archive, offset, size, mtime_ns).
+        Cached until the folder changes (a file is added, removed or renamed).
+    """
+    try:                                              # tentative approach
+        stamp = os.stat(folder).st_mtime_ns           # folder modification time
+    except OSError:                                   # case the folder does not exist
+        return {}                                     # no archived frames
+    cached = _indexes.get(folder)                     # cached index of the folder
+    if cached is not None and cached[0] == stamp:     # case the folder hasn't changed
+        return cached[1]                              # cached frames are returned
+    frames = {}                                       # empty dict to store the archived frames
+    for index_file in sorted(glob.glob(os.path.join(folder, archive_prefix + '*' + index_ext))):  # day indexes
+        tar_file = index_file[:-len(index_ext)] + archive_ext  # archive of the index
+        for name, offset, size, mtime_ns in read_index(index_file)['frames']:  # iteration over the indexed frames
+            frames[name] = (tar_file, offset, size, mtime_ns)  # archived frame
+    _indexes[folder] = (stamp, frames)                # index is cached
+    return frames                                     # archived frames are returned
+
+
+
+
+
+def archived_frame(path):
+    """ Returns (archive, offset, size, mtime_ns) of the frame path when archived, otherwise None.
+    """
+    folder, name = os.path.split(path)                # frame folder and picture name
+    return archive_index(folder).get(name)            # archived frame, or None
+
+
+
+
+
+def list_archived(folder, pic_format):
+    """ Returns the paths (folder/picture name) of the archived pictures of pic_format in folder.
+    """
+    pic_format = '.' + pic_format.lstrip('.')         # picture extension
+    return [os.path.join(folder, name) for name in archive_index(folder) if name.endswith(pic_format)]
+
+
+
+
+
+def frame_entry(path):
+    """ Returns the ffmpeg input of the frame: the path, or the picture range in its archive (subfile protocol).
+    """
+    archived = archived_frame(path)                   # archived frame, if any
+    if archived is None:                              # case of loose picture
+        return path                                   # path is returned
+    tar_file, offset, size, _ = archived              # archive and picture range
+    return f"subfile,,start,{offset},end,{offset + size},,:{tar_file}"  # picture range in the archive
+
+
+
+
+
+def frame_stat(path):
+    """ Returns size and modification time (ns) of the frame, loose or archived.
+    """
+    archived = archived_frame(path)                   # archived frame, if any
+    if archived is None:                              # case of loose picture
+        st = os.stat(path)                            # picture file status
+        return st.st_size, st.st_mtime_ns             # size and modification time are returned
+    return archived[2], archived[3]                   # size and modification time from the index
+
+
+
+
+
+def frame_exists(path):
+    """ Returns True when the frame exists, loose or archived.
+    """
+    return archived_frame(path) is not None or os.path.exists(path)
+
+
+
+
+
+def archive_map(tar_file, end):
+    """ Returns the memory map of the archive, mapped again when it has grown beyond end.
+    """
+    mapped = _maps.get(tar_file)                      # current memory map, if any
+    if mapped is None or len(mapped[1]) < end:        # case not mapped, or grown meanwhile
+        if mapped is not None:                        # case of previous map
+            mapped[0].close()                         # previous file is closed (the map stays valid until released)
+        f = open(tar_file, 'rb')                      # archive is opened in binary mode
+        mapped = (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))  # read only memory map
+        _maps[tar_file] = mapped                      # map is stored
+    return mapped[1]                                  # memory map is returned
+
+
+
+
+
+def frame_bytes(path):
+    """ Returns the picture bytes: a memoryview of the archive map (no copy), or the loose file content.
+    """
+    archived = archived_frame(path)                   # archived frame, if any
+    if archived is None:                              # case of loose picture
+        with open(path, 'rb') as f:                   # picture is opened in binary mode
+            return f.read()                           # picture bytes are returned
+    tar_file, offset, size, _ = archived              # archive and picture range
+    return memoryview(archive_map(tar_file, offset + size))[offset:offset + size]  # view of the picture
+
+
+
+
+
+def open_frame(path):
+    """ Returns a binary file object of the frame (i.e. for Image.open), loose or archived.
+    """
+    if archived_frame(path) is None:                  # case of loose picture
+        return open(path, 'rb')                       # picture file is returned
+    return io.BytesIO(frame_bytes(path))              # archived picture as in memory file
+
+
+
+
+
+def loose_days(folder, pic_format, today=False):
+    """ Returns the loose pictures of folder by capture day (dict: yyyymmdd -> sorted paths), from their
+        modification time; The pictures of the current day are excluded, unless today is set True.
+    """
+    pic_format = '.' + pic_format.lstrip('.')         # picture extension
+    current = datetime.now().strftime('%Y%m%d')       # current day
+    days = {}                                         # empty dict to store the pictures per day
+    with os.scandir(folder) as entries:               # single pass over the folder
+        for entry in entries:                         # iteration over the folder entries
+            if entry.name.endswith(pic_format) and entry.is_file():  # case of picture
+                day = datetime.fromtimestamp(entry.stat().st_mtime).strftime('%Y%m%d')  # capture day
+                if today or day != current:           # case of finished day (or all days)
+                    days.setdefault(day, []).append(entry.path)  # picture of the day
+    return {day: sorted(paths) for day, paths in days.items()}  # pictures per day are returned
+
+
+
+
+
+def pack_day(folder, day, pictures, batch=200, remove=True, gate=None):
+    """ Appends pictures to the archive of day in folder, in batches (append, fsync, index, remove the loose
+        pictures); Pictures already indexed (crash before their removal) are only removed.
+        gate is called before each batch: it may wait (i.e. while shooting), and returns False to stop.
+        Returns the quantity of pictures packed.
+    """
+    tar_file, index_file = archive_files(folder, day) # archive and index paths
+    index = read_index(index_file)                    # index of the archive (empty when new)
+    indexed = {frame[0] for frame in index['frames']} # pictures already in the archive
+    done = [p for p in pictures if os.path.basename(p) in indexed]  # packed pictures, still loose
+    pictures = [p for p in pictures if os.path.basename(p) not in indexed]  # pictures to be packed
+    if remove:                                        # case the loose pictures are removed
+        for path in done:                             # iteration over the packed pictures
+            os.remove(path)                           # loose picture is removed
+    if len(pictures) == 0:                            # case nothing left to be packed
+        return 0                                      # no pictures packed
+
+    packed = 0                                        # packed pictures counter
+    with open(tar_file, 'r+b' if os.path.exists(tar_file) else 'wb') as f:  # archive is opened (or made)
+        for i in range(0, len(pictures), batch):      # iteration over the batches
+            if gate is not None and not gate():       # case packing has to stop
+                break                                 # packing continues next time
+            chunk = pictures[i:i+batch]               # pictures of the batch
+            f.truncate(index['end'])                  # data not indexed (crash) and end blocks are dropped
+            f.seek(index['end'])                      # appending after the last indexed picture
+            with tarfile.open(fileobj=f, mode='w', format=tarfile.USTAR_FORMAT) as tar:  # tar writer from there
+                for path in chunk:                    # iteration over the pictures of the batch
+                    info = tar.gettarinfo(path, arcname=os.path.basename(path))  # tar header of the picture
+                    info.uid = info.gid = 0           # neutral owner
+                    info.uname = info.gname = ''      # neutral owner names
+                    info.mode = 0o666                 # read and write by all users, once extracted
+                    with open(path, 'rb') as pic:     # picture is opened in binary mode
+                        tar.addfile(info, pic)        # header and picture are appended
+                    offset = tar.offset - tarfile.BLOCKSIZE * -(-info.size // tarfile.BLOCKSIZE)  # picture data offset
+                    index['frames'].append([info.name, offset, info.size, os.stat(path).st_mtime_ns])
+                end = tar.offset                      # end of the pictures data (end blocks follow)
+            f.flush()                                 # python buffer is flushed
+            os.fsync(f.fileno())                      # batch is written to the storage
+            index['end'] = end                        # end of the indexed data
+            write_index(index_file, index)            # index is replaced (batch committed)
+            if remove:                                # case the loose pictures are removed
+                for path in chunk:                    # iteration over the pictures of the batch
+                    os.remove(path)                   # loose picture is removed
+            packed += len(chunk)                      # packed pictures counter
+
+    if index['frames']:                               # case of archived pictures
+        mtime_ns = max([frame[3] for frame in index['frames']])  # newest picture of the day
+        os.utime(tar_file, ns=(mtime_ns, mtime_ns))   # archive dated as its pictures (retention policies)
+    return packed                                     # quantity of packed pictures is returned
+
+
+
+
+
+def pack_folder(folder, pic_format, today=False, batch=200, remove=True, gate=None):
+    """ Packs the loose pictures of the finished days (all days, when today is set True) of folder, and of its
+        shard subfolders, into their day archives (one per day and folder). Returns the quantity of pictures packed.
+    """
+    packed = 0                                        # packed pictures counter
+    for f in [folder] + [d.rstrip(os.sep) for d in shard_folders(folder)]:  # iteration over folder and its shards
+        for day, pictures in sorted(loose_days(f, pic_format, today).items()):  # iteration over the days
+            packed += pack_day(f, day, pictures, batch, remove, gate)  # pictures of the day are packed
+    return packed                                     # quantity of packed pictures is returned
+
+
+
+
+
+def extract(folder, dest, pic_format=''):
+    """ Extracts the archived pictures (of pic_format, when set) of folder to dest, with their modification
+        time. Returns the quantity of extracted pictures.
+    """
+    os.makedirs(dest, exist_ok=True)                  # destination folder is made, if missing
+    count = 0                                         # extracted pictures counter
+    for name in sorted(archive_index(folder)):        # iteration over the archived pictures
+        if pic_format and not name.endswith('.' + pic_format.lstrip('.')):  # case of other picture format
+            continue                                  # picture is skipped
+        path = os.path.join(dest, name)               # extracted picture path
+        with open(path, 'wb') as f:                   # picture is opened in writing mode
+            f.write(frame_bytes(os.path.join(folder, name)))  # picture is written
+        mtime_ns = archived_frame(os.path.join(folder, name))[3]  # original modification time
+        os.utime(path, ns=(mtime_ns, mtime_ns))       # modification time is restored
+        count += 1                                    # extracted pictures counter
+    return count                                      # quantity of extracted pictures is returned
+
+
+
+
+
+class ArchivePacker:
+    """ Packs the queued folders in a background thread, at the lowest CPU priority; Paused while shooting.
+    """
+
+    def __init__(self, pic_format, batch=200):
+        self.pic_format = pic_format                  # format of the pictures to be packed
+        self.batch = batch                            # pictures per batch
+        self.jobs = Queue()                           # queued (folder, today) to be packed
+        self.running = Event()                        # set when packing is allowed (not paused)
+        self.running.set()                            # packing is allowed
+        self.stopping = False                         # flag to stop at the next batch
+        self.thread = Thread(target=self.run, daemon=True)  # packing thread
+        self.thread.start()                           # packing thread is started
+
+
+    def add(self, folder, today=False):
+        """ Queues the folder to be packed (finished days only, unless today is set True).
+        """
+        self.jobs.put((folder, today))                # folder is queued
+
+
+    def gate(self):
+        """ Waits while paused; Returns False when packing has to stop.
+        """
+        self.running.wait()                           # waits until resumed
+        return not self.stopping                      # False when stopping
+
+
+    def run(self):
+        """ Packing thread: packs the queued folders, one after the other.
+        """
+        try:                                          # tentative approach
+            os.setpriority(os.PRIO_PROCESS, get_native_id(), 19)  # lowest CPU priority (per thread, on Linux)
+        except (AttributeError, OSError):             # case the priority can't be set
+            pass                                      # do nothing
+        while True:                                   # loop until stopped
+            folder, today = self.jobs.get()           # next queued folder
+            if folder is not None and not self.stopping:  # case of folder to be packed
+                start = time()                        # time reference for the packing
+                try:                                  # tentative approach
+                    packed = pack_folder(folder, self.pic_format, today, self.batch, gate=self.gate)
+                    if packed:                        # case of packed pictures
+                        print(f"\nArchive: {packed} pictures packed in {folder}, in {time() - start:.0f} secs")
+                except OSError as e:                  # case of storage error
+                    print(f"\nArchive: packing error in {folder} ({e})")
+            self.jobs.task_done()                     # job is done
+            if folder is None:                        # case of stop request
+                return                                # thread ends
+
+
+    def pause(self):
+        """ Pauses packing at the next batch (i.e. while shooting).
+        """
+        self.running.clear()                          # packing is paused
+
+
+    def resume(self):
+        """ Resumes packing.
+        """
+        self.running.set()                            # packing is allowed
+
+
+    def wait(self):
+        """ Waits until the queued folders are packed.
+        """
+        self.resume()                                 # packing is allowed
+        self.jobs.join()                              # waits for the queued folders
+
+
+    def close(self, wait=True):
+        """ Stops the packing thread, after the queued folders (wait) or at the next batch.
+        """
+        if not self.thread.is_alive():                # case the packing thread has already ended
+            return                                    # nothing to do
+        self.stopping = not wait                      # stop at the next batch, when not waiting
+        self.resume()                                 # packing is allowed (a paused thread can end)
+        self.jobs.put((None, False))                  # stop request, after the queued folders
+        self.thread.join()                            # waits for the packing thread to end
+
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Packs the pictures of the finished days in day archives')
+    parser.add_argument('folder', help='pictures folder')
+    parser.add_argument('--format', default='jpg', help='pictures format (default jpg)')
+    parser.add_argument('--all', action='store_true', help='packs also the pictures of the current day')
+    parser.add_argument('--list', action='store_true', help='lists the archives and their pictures quantity')
+    parser.add_argument('--extract', metavar='DEST', help='extracts the archived pictures to DEST')
+    args = parser.parse_args()
+
+    if args.extract:                                  # case of extraction
+        print(f"{extract(args.folder, args.extract, args.format)} pictures extracted to {args.extract}")
+    elif args.list:                                   # case of listing
+        for index_file in sorted(glob.glob(os.path.join(args.folder, archive_prefix + '*' + index_ext))):
+            index = read_index(index_file)            # index of the archive
+            print(f"{os.path.basename(index_file)[:-len(index_ext)] + archive_ext}: {len(index['frames'])} pictures, "
+                  f"{index['end']/1048576:.1f} MB")
+    else:                                             # case of packing
+        start = time()                                # time reference for the packing
+        packed = pack_folder(args.folder, args.format, args.all)  # pictures are packed
+        print(f"{packed} pictures packed in {time() - start:.1f} secs")
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+#############################################################################################################
+#  Timelapse application, atomic file commit (pictures, previews, movies and state files)
+#
+#  Every file is written to a hidden temporary name in its final folder, gets its permissions in-process (fchmod,
+#  no 'sudo chmod' shell per file), is fsync-ed as per the fsync policy and renamed (atomic): a power outage
+#  leaves the old file or the new one, never a truncated one with the final name.
+#  fsync policy: 'always' (file and folder), 'file' (file only, the rename may be lost), 'never' (left to the OS).
+#  Files made by other writers (camera, ffmpeg, PIL) are written to temp_path() and committed via commit().
+#  Temporary files left by a crash before their commit are removed at startup (sweep_temp).
+#  Timing counters (write, fsync, rename) are kept per process, and printed via commit_report().
+#############################################################################################################
+"""
+
+
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+import os.path
+
+
+policies = ('always', 'file', 'never')                # fsync policies
+fsync_policy = 'file'                                 # fsync policy in use
+temp_prefix = '.tmp.'                                 # name prefix of the temporary files (hidden)
+file_mode = 0o777                                     # permissions of the committed files and folders (read, write, and execute by all users)
+counters = {'files': 0, 'bytes': 0, 'write_s': 0.0, 'fsync_s': 0.0, 'rename_s': 0.0}  # timing counters
+counters_lock = Lock()                                # counters are updated by several threads
+
+
+
+
+def set_policy(policy):
+    """ Sets the fsync policy ('always', 'file' or 'never').
+    """
+    global fsync_policy
+    if policy not in policies:                        # case of unknown policy
+        raise ValueError(f"fsync policy {policy} not in {policies}")
+    fsync_policy = policy                             # fsync policy is set
+
+
+
+
+
+def temp_path(path):
+    """ Returns the temporary path of path: hidden, in the same folder (same file system, atomic rename), and with
+        the same extension (writers choosing the format from the extension, glob patterns not matching it).
+    """
+    folder, name = os.path.split(path)                # folder and file name
+    return os.path.join(folder, temp_prefix + name)   # temporary path is returned
+
+
+
+
+
+def sweep_temp(folder):
+    """ Removes the temporary files left in folder and its sub-folders (i.e. a crash in between the write and the
+        commit). Returns the quantity of removed files.
+    """
+    removed, stack = 0, [folder]                      # removed files counter, and folders to be scanned
+    while stack:                                      # loop until all the folders are scanned
+        directory = stack.pop()                       # next folder
+        try:                                          # tentative approach
+            with os.scandir(directory) as entries:    # single pass over the folder
+                for entry in entries:                 # iteration over the folder entries
+                    if entry.is_dir(follow_symlinks=False):  # case of sub-folder
+                        stack.append(entry.path)      # sub-folder will be scanned
+                    elif entry.name.startswith(temp_prefix):  # case of temporary file
+                        try:                          # tentative approach
+                            os.remove(entry.path)     # temporary file is removed
+                            removed += 1              # removed files counter
+                        except OSError:               # case the file can't be removed
+                            pass                      # file is left
+        except OSError:                               # case the folder can't be read (i.e. removed meanwhile)
+            continue                                  # folder is skipped
+    return removed                                    # quantity of removed files is returned
+
+
+
+
+
+def count(key, start, size=0):
+    """ Adds the time since start to the key counter (and size to the bytes counter).
+    """
+    with counters_lock:                               # counters are locked
+        counters[key] += time() - start               # time is added
+        counters['bytes'] += size                     # bytes are added
+
+
+
+
+
+def fsync_folder(folder, force=False):
+    """ Writes the folder entries (renames) to the storage, when the fsync policy is 'always' (or when forced).
+    """
+    if fsync_policy != 'always' and not force:        # case the folders aren't fsync-ed
+        return                                        # nothing to do
+    start = time()                                    # time reference for the fsync
+    fd = os.open(folder if folder else '.', os.O_RDONLY)  # folder descriptor
+    try:                                              # tentative approach
+        os.fsync(fd)                                  # folder entries are written to the storage
+    finally:                                          # in any case
+        os.close(fd)                                  # folder descriptor is closed
+    count('fsync_s', start)                           # fsync time
+
+
+
+
+
+def finish(f, size=0, durable=False):
+    """ Sets the permissions of the open file f, and fsync-s it as per the fsync policy (always when durable).
+    """
+    f.flush()                                         # python buffer is flushed
+    os.fchmod(f.fileno(), file_mode)                  # permissions, in-process
+    if fsync_policy != 'never' or durable:            # case the file is fsync-ed
+        start = time()                                # time reference for the fsync
+        os.fsync(f.fileno())                          # file is written to the storage
+        count('fsync_s', start, size)                 # fsync time
+    else:                                             # case the files aren't fsync-ed
+        count('fsync_s', time(), size)                # bytes only
+
+
+
+
+
+def rename(tmp, path, sync_folder=True):
+    """ Renames tmp to path (atomic), and fsync-s the folder as per the fsync policy (unless sync_folder is False,
+        i.e. a batch fsync-ing the folder once).
+    """
+    start = time()                                    # time reference for the rename
+    os.replace(tmp, path)                             # file appears at once, with its final name
+    with counters_lock:                               # counters are locked
+        counters['files'] += 1                        # committed files counter
+    count('rename_s', start)                          # rename time
+    if sync_folder:                                   # case the folder is fsync-ed now
+        fsync_folder(os.path.dirname(path))           # rename is written to the storage (as per policy)
+
+
+
+
+
+def commit(tmp, path, sync_folder=True):
+    """ Commits tmp (written by another writer, i.e. camera or ffmpeg) to path: permissions, fsync and rename.
+    """
+    with open(tmp, 'rb+') as f:                       # written file is opened (no data is read)
+        finish(f, os.fstat(f.fileno()).st_size)       # permissions and fsync
+    rename(tmp, path, sync_folder)                    # file appears at once, with its final name
+
+
+
+
+
+@contextmanager
+def atomic_file(path, mode='w', sync_folder=True, durable=False):
+    """ Context manager returning a file object, written to the temporary path and committed to path when the
+        block ends without errors; Otherwise the temporary file is removed. When durable, the file is fsync-ed
+        whatever the fsync policy (i.e. replicas, before the local copy can be removed).
+    """
+    tmp = temp_path(path)                             # temporary path
+    start = time()                                    # time reference for the write
+    f = open(tmp, mode)                               # temporary file is opened in writing mode
+    try:                                              # tentative approach
+        yield f                                       # file is written by the caller
+        count('write_s', start)                       # write time
+        finish(f, f.tell(), durable)                  # permissions and fsync
+        f.close()                                     # file is closed
+        rename(tmp, path, sync_folder)                # file appears at once, with its final name
+    except BaseException:                             # case of error while writing
+        f.close()                                     # file is closed
+        if os.path.exists(tmp):                       # case of temporary file
+            os.remove(tmp)                            # temporary file is removed
+        raise                                         # error is raised again
+
+
+
+
+
+def make_folder(folder):
+    """ Makes the folder (and its parents) if missing, with the permissions of the committed files (in-process).
+    """
+    if not os.path.isdir(folder):                     # case the folder does not exist
+        os.makedirs(folder, exist_ok=True)            # folder is made
+        os.chmod(folder, file_mode)                   # permissions, in-process (not limited by the umask)
+
+
+
+
+
+def commit_report():
+    """ Returns the report line of the timing counters.
+    """
+    with counters_lock:                               # counters are locked
+        c = dict(counters)                            # counters copy
+    if c['files'] == 0:                               # case no files were committed
+        return ''                                     # empty string is returned
+    ms = lambda key: 1000 * c[key] / c['files']       # average time per file, in ms
+    return (f"File commit ({fsync_policy}): {c['files']} files, {c['bytes']/1048576:.1f} MB, per file write "
+            f"{ms('write_s'):.1f} ms, fsync {ms('fsync_s'):.1f} ms, rename {ms('rename_s'):.2f} ms")
@@ -0,0 +1,320 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+#############################################################################################################
+#  Timelapse application, background compaction of the finished pictures
+#
+#  Pictures of finished (rendered) folders are kept for later re-edits; Compaction re-encodes them to a denser
+#  format (WebP, or AVIF when supported by PIL), in a pool of processes at the lowest CPU priority.
+#  Each result is checked (decoded, same size, PSNR against the original above a threshold) and committed
+#  (timelapse_commit: permissions, fsync and atomic rename); A manifest record maps the frame to the compacted
+#  picture (the original path is kept as 'source'), and only then the original is removed. The renderers read
+#  the compacted pictures via the frames index, as any other picture.
+#  Compaction runs only in idle time: paused while shooting, and while a render is pending.
+#  The report gives the space saved and the CPU time spent.
+#
+#  Usage: python timelapse_compact.py FOLDER [--format webp] [--quality 80]
+#############################################################################################################
+"""
+
+
+from multiprocessing import Pool
+from threading import Thread, Event
+from queue import Queue
+from time import time, process_time, sleep
+from PIL import Image, ImageChops, ImageStat, features
+from timelapse_manifest import read_manifest, append_record, manifest_root, manifest_file
+from timelapse_render import list_frames
+from timelapse_archive import archived_frame
+from timelapse_integrity import integrity_record
+from timelapse_commit import temp_path, commit
+import numpy as np
+import os.path, math, glob, argparse
+
+
+compact_types = {'webp': 'WEBP', 'avif': 'AVIF'}      # compacted formats: file extension -> PIL format
+
+
+
+
+def available(fmt):
+    """ Returns True when PIL can encode the compacted format fmt.
+    """
+    return fmt in compact_types and features.check(fmt)  # PIL plugin (webp, avif) availability
+
+
+
+
+
+def finished_folders(parent_folder, folder):
+    """ Returns the pictures folders in parent_folder already rendered (manifest and movie), except folder.
+    """
+    folders = []                                      # empty list to store the finished folders
+    for f in sorted(glob.glob(os.path.join(parent_folder, '*', ''))):  # iteration over the subfolders
+        f = f.rstrip(os.sep)                          # trailing separator is removed
+        if os.path.abspath(f) == os.path.abspath(folder):  # case of the current folder
+            continue                                  # folder is skipped (still shooting or rendering)
+        if os.path.exists(manifest_file(f)) and len(glob.glob(os.path.join(f, '*.mp4'))) > 0:  # case of rendered folder
+            folders.append(f)                         # folder is appended
+    return folders                                    # finished folders are returned
+
+
+
+
+
+def psnr(im_a, im_b):
+    """ Returns the PSNR (dB) between two pictures of the same size, on 1/8 size thumbnails.
+    """
+    size = (max(1, im_a.width // 8), max(1, im_a.height // 8))  # thumbnail size
+    diff = ImageChops.difference(im_a.convert('RGB').resize(size), im_b.convert('RGB').resize(size))
+    mse = np.mean(np.square(ImageStat.Stat(diff).rms))  # mean squared error over the channels
+    return 100.0 if mse == 0 else 10 * math.log10(255**2 / mse)  # PSNR in dB
+
+
+
+
+
+def init_worker():
+    """ Pool initializer: compaction processes run at the lowest CPU priority.
+    """
+    os.nice(19)                                       # lowest CPU priority
+
+
+
+
+
+def compact_frame(job):
+    """ Re-encodes a picture to fmt at quality, checks the result (size and PSNR) and renames it in place.
+        Returns (picture, compacted picture or None, original bytes, compacted bytes, CPU secs, error).
+    """
+    path, fmt, quality, min_psnr = job                # picture, compacted format, quality and PSNR threshold
+    cpu_start = process_time()                        # CPU time reference
+    new_path = os.path.splitext(path)[0] + '.' + fmt  # compacted picture path
+    tmp = temp_path(new_path)                         # temporary file, committed when checked
+    try:                                              # tentative approach
+        with Image.open(path) as im:                  # original picture is opened
+            im.load()                                 # original picture is decoded
+            exif = im.info.get('exif')                # camera metadata, kept in the compacted picture
+            options = {'quality': quality, 'exif': exif} if exif else {'quality': quality}
+            with open(tmp, 'wb') as f:                # temporary file is opened in writing mode
+                im.save(f, compact_types[fmt], **options)  # picture is re-encoded
+            with Image.open(tmp) as check:            # compacted picture is opened
+                check.load()                          # compacted picture is decoded
+                if check.size != im.size:             # case of different size
+                    raise ValueError(f"size {check.size} differs")
+                quality_db = psnr(im, check)          # PSNR against the original
+                if quality_db < min_psnr:             # case of excessive loss
+                    raise ValueError(f"PSNR {quality_db:.1f} dB below {min_psnr}")
+        old_size, new_size = os.path.getsize(path), os.path.getsize(tmp)  # sizes before and after
+        if new_size >= old_size:                      # case nothing is saved
+            raise ValueError("no space saved")
+        st = os.stat(path)                            # original file status
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))  # capture time kept as modification time
+        commit(tmp, new_path)                         # compacted picture appears at once (permissions, fsync, rename)
+        return path, new_path, old_size, new_size, process_time() - cpu_start, ''
+    except (OSError, ValueError) as e:                # case of failed compaction (original is kept)
+        if os.path.exists(tmp):                       # case of temporary file
+            os.remove(tmp)                            # temporary file is removed
+        return path, None, 0, 0, process_time() - cpu_start, str(e)
+
+
+
+
+
+def commit_frame(path, new_path, records):
+    """ Appends the manifest record of the compacted picture (record of the original, with 'source'), then
+        removes the original. records are the manifest records per manifest folder (read once).
+    """
+    root = manifest_root(os.path.dirname(path))       # folder of the manifest
+    if root not in records:                           # case the manifest is not read yet
+        records[root] = read_manifest(root)           # manifest is read
+    source = os.path.relpath(path, root)              # original picture in the manifest
+    try:                                              # tentative approach
+        record = dict(records[root].get(source, {}), file=os.path.relpath(new_path, root), source=source,
+                      **integrity_record(new_path))   # integrity fields of the compacted picture
+        append_record(root, record)                   # frame index points to the compacted picture
+    except OSError:                                   # case the record can't be written
+        rollback_frame(new_path)                      # compacted picture is removed, the original is kept
+        raise                                         # error is raised to the caller
+    os.remove(path)                                   # original picture is removed
+
+
+
+
+
+def rollback_frame(new_path):
+    """ Removes a compacted picture not recorded in the manifest (the original is kept, and compacted next time).
+    """
+    try:                                              # tentative approach
+        os.remove(new_path)                           # compacted picture is removed
+    except OSError:                                   # case the picture can't be removed
+        pass                                          # it's replaced at the next compaction
+
+
+
+
+
+def compact_folder(folder, pic_format, fmt='webp', quality=80, min_psnr=30, workers=None, gate=None):
+    """ Compacts the loose pictures (pic_format) of folder to fmt, in a pool of processes at the lowest priority.
+        Pictures are compacted in batches of one picture per process; gate is called before each batch, so no
+        picture is compacted while it waits (i.e. while shooting), and returns False to stop.
+        Originals left by an interruption (the compacted picture is indexed) are removed.
+        Returns the report dict: pictures, bytes before and after, CPU secs, failed pictures, secs.
+    """
+    start = time()                                    # time reference for the compaction
+    report = {'frames': 0, 'before': 0, 'after': 0, 'cpu_s': 0.0, 'failed': 0, 'seconds': 0}
+    frames = list_frames(folder, pic_format) + list_frames(folder, fmt)  # indexed pictures (original or compacted)
+    ext = '.' + pic_format.lstrip('.')                # extension of the originals
+    todo = []                                         # pictures to be compacted
+    for frame in sorted(set(frames)):                 # iteration over the pictures
+        if not frame.endswith(ext) or archived_frame(frame) is not None:  # case already compacted, or archived
+            continue                                  # picture is skipped
+        done = os.path.splitext(frame)[0] + '.' + fmt # compacted picture of the frame
+        if done in frames and os.path.exists(frame):  # case compacted and indexed, original still there
+            os.remove(frame)                          # original left by an interruption is removed
+        elif os.path.exists(frame):                   # case of picture to be compacted
+            todo.append((frame, fmt, quality, min_psnr))  # compaction job
+
+    records = {}                                      # manifest records per manifest folder
+    workers = workers if workers else max(1, os.cpu_count() - 1)  # one core is left to the rest
+    pool = Pool(workers, initializer=init_worker)     # pool of compaction processes
+    try:                                              # tentative approach
+        for i in range(0, len(todo), workers):        # iteration over batches of one picture per process
+            if gate is not None and not gate():       # case compaction has to stop (checked before any job starts)
+                break                                 # compaction continues next time
+            results = pool.map(compact_frame, todo[i:i+workers])  # batch is compacted, all the results returned
+            for n, (path, new_path, old_size, new_size, cpu_s, error) in enumerate(results):  # iteration over the results
+                report['cpu_s'] += cpu_s              # CPU time spent
+                if new_path is None:                  # case of failed compaction
+                    report['failed'] += 1             # failed pictures counter
+                    print(f"\nCompaction: {os.path.basename(path)} kept ({error})")
+                    continue                          # next result
+                try:                                  # tentative approach
+                    commit_frame(path, new_path, records)  # manifest record, and original removed
+                except OSError:                       # case of storage error
+                    for result in results[n+1:]:      # iteration over the results not recorded
+                        if result[1] is not None:     # case of compacted picture
+                            rollback_frame(result[1]) # compacted picture is removed, the original is kept
+                    raise                             # error is raised to the caller
+                report['frames'] += 1                 # compacted pictures counter
+                report['before'] += old_size          # bytes before
+                report['after'] += new_size           # bytes after
+    finally:                                          # in any case
+        pool.close()                                  # no jobs are running in between the batches
+        pool.join()                                   # waits for the processes to end
+    report['seconds'] = time() - start                # compaction time
+    return report                                     # report is returned
+
+
+
+
+
+def print_compact_report(report, label='Compaction: '):
+    """ Prints the compaction report to the terminal.
+    """
+    saved = report['before'] - report['after']        # bytes saved
+    ratio = 100 * saved / report['before'] if report['before'] else 0  # percentage saved
+    print(f"{label}{report['frames']} pictures, {saved/1048576:.1f} MB saved ({ratio:.0f}%), "
+          f"{report['failed']} kept, CPU {report['cpu_s']:.0f} secs, in {report['seconds']:.0f} secs")
+
+
+
+
+
+class Compactor:
+    """ Compacts the queued folders in a background thread, only in idle time (not paused, and idle() True).
+    """
+
+    def __init__(self, pic_format, fmt='webp', quality=80, idle=None):
+        self.pic_format = pic_format                  # format of the original pictures
+        self.fmt = fmt                                # compacted format
+        self.quality = quality                        # compacted quality
+        self.idle = idle                              # callable, False while a render is pending
+        self.jobs = Queue()                           # queued folders
+        self.queued = set()                           # folders queued or compacted (not queued again)
+        self.running = Event()                        # set when compaction is allowed (not paused)
+        self.running.set()                            # compaction is allowed
+        self.stopping = False                         # flag to stop at the next batch
+        self.thread = Thread(target=self.run, daemon=True)  # compaction thread
+        self.thread.start()                           # compaction thread is started
+
+
+    def add(self, folder):
+        """ Queues the folder to be compacted; Folders already queued, or compacted, are not queued again.
+        """
+        folder = os.path.abspath(folder)              # same folder, whatever the path
+        if folder in self.queued:                     # case the folder is queued, or compacted
+            return                                    # nothing to do
+        self.queued.add(folder)                       # folder is remembered
+        self.jobs.put(folder)                         # folder is queued
+
+
+    def gate(self):
+        """ Waits while paused, or not idle; Returns False when compaction has to stop.
+        """
+        while True:                                   # loop until idle time, or stopped
+            self.running.wait()                       # waits until resumed
+            if self.stopping:                         # case compaction has to stop
+                return False                          # compaction stops
+            if self.idle is None or self.idle():      # case of idle time
+                return True                           # compaction continues
+            sleep(5)                                  # waits for the idle time
+
+
+    def run(self):
+        """ Compaction thread: compacts the queued folders, one after the other.
+        """
+        while True:                                   # loop until stopped
+            folder = self.jobs.get()                  # next queued folder
+            if folder is not None and self.gate():    # case of folder to be compacted, in idle time
+                try:                                  # tentative approach
+                    report = compact_folder(folder, self.pic_format, self.fmt, self.quality, gate=self.gate)
+                    if report['frames'] or report['failed']:  # case of compacted or failed pictures
+                        print_compact_report(report, label=f"\nCompaction of {folder}: ")
+                except OSError as e:                  # case of storage error
+                    print(f"\nCompaction error in {folder} ({e})")
+                    self.queued.discard(folder)       # folder can be queued again
+            self.jobs.task_done()                     # job is done
+            if folder is None:                        # case of stop request
+                return                                # thread ends
+
+
+    def pause(self):
+        """ Pauses compaction at the next batch of pictures (i.e. while shooting).
+        """
+        self.running.clear()                          # compaction is paused
+
+
+    def resume(self):
+        """ Resumes compaction.
+        """
+        self.running.set()                            # compaction is allowed
+
+
+    def close(self):
+        """ Stops the compaction thread at the next batch of pictures (it continues at the next start).
+        """
+        if not self.thread.is_alive():                # case the compaction thread has already ended
+            return                                    # nothing to do
+        self.stopping = True                          # stop at the next batch
+        self.resume()                                 # compaction is allowed (a paused thread can end)
+        self.jobs.put(None)                           # stop request
+        self.thread.join()                            # waits for the compaction thread to end
+
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compacts the pictures of a finished folder to a denser format')
+    parser.add_argument('folder', help='pictures folder')
+    parser.add_argument('--pic_format', default='jpg', help='format of the pictures to compact (default jpg)')
+    parser.add_argument('--format', default='webp', choices=list(compact_types), help='compacted format (default webp)')
+    parser.add_argument('--quality', type=int, default=80, help='compacted quality (default 80)')
+    args = parser.parse_args()
+
+    if not available(args.format):                    # case PIL can't encode the format
+        print(f"{args.format} is not supported by this PIL installation")
+    else:                                             # case the format is supported
+        print_compact_report(compact_folder(args.folder, args.pic_format, args.format, args.quality))
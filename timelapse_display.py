@@ -117,8 +117,9 @@ class Display:
     
     
     
-    def display_progress_bar(self, percent, day, days, shoot):
-        """ Function to print a progress bar on the display."""
+    def display_progress_bar(self, percent, day, days, shoot, row1='', row2=''):
+        """ Function to print a progress bar on the display.
+            row1 and row2, when provided, replace the shoot number and the day info (i.e. render progress)."""
         
         w = self.disp_w                                            # display width, retrieved by display setting
         
@@ -129,14 +130,14 @@ class Display:
         # shoot number printed as text
         fs = 26                 # font size
         font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", fs)  # font and size
-        shoot_number = 'SHOOT ' + '{:05}'.format(shoot)                               # string of shoot number
+        shoot_number = row1 if row1 else 'SHOOT ' + '{:05}'.format(shoot)             # string of shoot number
         disp_draw.text((10, 6), shoot_number, font=font, fill=(255, 255, 255))        # text with shoot number
         
         # day number printed as text
         days = str(days)                                         # total of days as string
         digits = len(days)                                       # number digits of string of days
         day = str(day).zfill(digits)                             # active day in as string with heading zeros
-        day_info = 'DAY ' + day + ' OF ' + days                  # string of shoot number
+        day_info = row2 if row2 else 'DAY ' + day + ' OF ' + days  # string of shoot number
         fs = 21 + 2*(digits-1)                                   # font size, adjusted according to digits number
         font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", fs)  # font and size
         disp_draw.text((10, 50), day_info, font=font, fill=(255, 255, 255))  # text with shoot number
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+#############################################################################################################
+#  Timelapse application, integrity check of the pictures (i.e. truncated pictures after a power outage)
+#
+#  At each shoot the manifest record gets the picture size and the CRC32 of its tail (last 4 KB).
+#  The verifier reads only the tail of each picture (no decoding), in a pool of threads: size and tail CRC are
+#  compared with the record, and the end marker of the format is checked (JPEG EOI, PNG IEND), so even pictures
+#  without an integrity record are checked. Bad pictures are marked as skipped in the manifest, and left out by
+#  the frames index: the renderers never read them, and the power outage recovery doesn't count them.
+#  Runs at startup and before each render.
+#
+#  Usage: python timelapse_integrity.py FOLDER [--pic_format jpg] [--no_mark]
+#############################################################################################################
+"""
+
+
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from timelapse_manifest import read_manifest, append_record, skipped_frames, frame_index, frame_number, shard_folders
+from timelapse_archive import archived_frame, frame_bytes, frame_exists
+from timelapse_render import list_frames
+import os.path, zlib, glob, argparse
+
+
+tail_size = 4096                                      # bytes at the end of the picture, for the CRC and the marker
+end_markers = {'.jpg': b'\xff\xd9', '.jpeg': b'\xff\xd9', '.png': b'IEND\xaeB`\x82'}  # end of picture markers
+
+
+
+
+def read_tail(path):
+    """ Returns the picture size and its tail (last tail_size bytes), loose or archived.
+    """
+    if archived_frame(path) is not None:              # case of archived picture
+        data = frame_bytes(path)                      # view of the picture in the archive map (no copy)
+        return len(data), bytes(data[-tail_size:])    # size and tail
+    with open(path, 'rb') as f:                       # picture is opened in binary mode
+        size = os.fstat(f.fileno()).st_size           # picture size
+        f.seek(max(0, size - tail_size))              # position of the tail
+        return size, f.read()                         # size and tail
+
+
+
+
+
+def integrity_record(path):
+    """ Returns the integrity fields (size and tail CRC32) for the manifest record of the picture.
+    """
+    size, tail = read_tail(path)                      # picture size and tail
+    return {'size': size, 'crc': zlib.crc32(tail)}    # integrity fields
+
+
+
+
+
+def check_frame(path, record=None):
+    """ Returns an empty string when the picture is fine, otherwise the reason (missing, size, crc, truncated).
+        Size and CRC are checked when the record has them; The end marker is checked for JPEG and PNG.
+    """
+    try:                                              # tentative approach
+        size, tail = read_tail(path)                  # picture size and tail
+    except OSError:                                   # case the picture can't be read
+        return 'missing'                              # reason is returned
+    record = record if record is not None else {}     # empty record, when none
+    if record.get('size') is not None and record['size'] != size:  # case of different size
+        return 'size'                                 # reason is returned
+    if record.get('crc') is not None and record['crc'] != zlib.crc32(tail):  # case of different tail
+        return 'crc'                                  # reason is returned
+    marker = end_markers.get(os.path.splitext(path)[1].lower())  # end marker of the format, if any
+    if marker is not None and not tail.rstrip(b'\x00').endswith(marker):  # case the end marker is missing
+        return 'truncated'                            # reason is returned
+    return ''                                         # picture is fine
+
+
+
+
+
+def verify_folder(folder, pic_format, workers=8, mark=True):
+    """ Checks the pictures of folder (tail only), in a pool of threads; Bad pictures are marked as skipped in the
+        manifest when mark. Returns the report dict: checked pictures, bad pictures (path -> reason), secs.
+    """
+    start = time()                                    # time reference for the check
+    records = read_manifest(folder)                   # records of the pictures, by path relative to folder
+    frames = list_frames(folder, pic_format)          # pictures of folder (the skipped ones are left out)
+    prefix = os.path.join(folder, '')                 # folder path, with trailing separator
+    names = [f[len(prefix):] if f.startswith(prefix) else os.path.relpath(f, folder) for f in frames]  # paths in the manifest
+    chunks = [list(range(i, len(frames), workers)) for i in range(workers)]  # one chunk of pictures per thread
+    check_chunk = lambda chunk: [check_frame(frames[i], records.get(names[i])) for i in chunk]  # pictures of a chunk
+    results = [''] * len(frames)                      # check result per picture
+    with ThreadPoolExecutor(max_workers=workers) as pool:  # pool of threads (storage bound)
+        for chunk, reasons in zip(chunks, pool.map(check_chunk, chunks)):  # iteration over the checked chunks
+            for i, reason in zip(chunk, reasons):     # iteration over the pictures of the chunk
+                results[i] = reason                   # check result of the picture
+
+    bad = {}                                          # empty dict to store the bad pictures
+    for frame, name, reason in zip(frames, names, results):  # iteration over the checked pictures
+        if reason:                                    # case of bad picture
+            bad[frame] = reason                       # bad picture and reason
+            if mark:                                  # case the bad pictures are marked
+                append_record(folder, {'file': name, 'skip': reason, 't_check': round(time(), 2)})  # frame is skipped
+    return {'frames': len(frames), 'bad': bad, 'seconds': time() - start}  # report is returned
+
+
+
+
+
+def resume_frames(folder, pic_format):
+    """ Returns the pictures of folder to resume from after a power outage (dict: frame number -> picture path,
+        loose and archived, skipped ones left out), and the last frame number used.
+        Frame numbers come from the frames index (manifest), or from the file names for pictures without manifest;
+        Numbers of the skipped pictures, and of the pictures whose record was lost (truncated manifest line), count
+        as used, so these pictures are never overwritten.
+    """
+    index = frame_index(folder, pic_format)           # frame number -> picture path, from the manifest
+    if len(index) == 0:                               # case of pictures without manifest
+        index = {frame_number(pic): pic for pic in list_frames(folder, pic_format)}  # frame numbers from the file names
+    saved = {n: pic for n, pic in index.items() if n is not None and frame_exists(pic)}  # loose and archived pictures
+    loose = [pic for f in [folder] + shard_folders(folder) for pic in glob.glob(os.path.join(f, '*.' + pic_format))]
+    used = [frame_number(pic) for pic in list(skipped_frames(folder)) + loose]  # frame numbers in use, by file name
+    last_frame = max(list(saved) + [n for n in used if n is not None], default=0)  # last frame number used
+    return saved, last_frame                          # pictures and last frame number are returned
+
+
+
+
+
+def print_verify_report(report, label='Integrity check: '):
+    """ Prints the integrity check report to the terminal.
+    """
+    print(f"{label}{report['frames']} pictures checked in {report['seconds']:.1f} secs, {len(report['bad'])} skipped")
+    for frame, reason in report['bad'].items():       # iteration over the bad pictures
+        print(f"  {os.path.basename(frame)}: {reason}")  # bad picture and reason
+
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Checks the pictures of a folder, and marks the bad ones as skipped')
+    parser.add_argument('folder', help='pictures folder')
+    parser.add_argument('--pic_format', default='jpg', help='format of the pictures (default jpg)')
+    parser.add_argument('--no_mark', action='store_true', help='bad pictures are listed, not marked as skipped')
+    args = parser.parse_args()
+
+    print_verify_report(verify_folder(args.folder, args.pic_format, mark=not args.no_mark))
+    skipped = skipped_frames(args.folder)             # pictures marked as skipped so far
+    if len(skipped) > 0:                              # case of skipped pictures
+        print(f"{len(skipped)} pictures marked as skipped in the manifest")
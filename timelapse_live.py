@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+#############################################################################################################
+#  Timelapse application, rolling live stream of the timelapse in progress (HLS)
+#
+#  Every seg_frames new pictures a short MPEG-TS segment is encoded and appended to an m3u8 playlist, so any
+#  HLS player on the LAN (VLC, Safari, ffplay, hls.js) can watch the timelapse so far, while shooting.
+#  Encoded segments are never touched again: the stream grows by one segment at the time, and the whole
+#  folder is never re-encoded. Pictures are decoded at reduced size by the JPEG decoder (lowres: 1/2, 1/4,
+#  1/8), and ffmpeg runs at the lowest CPU priority, in background of the shooting loop.
+#  The playlist is replaced atomically, and after a power outage the stream continues from the last segment.
+#  When a port is set, the live folder is served via http (http://<pi address>:<port>/live.m3u8).
+#############################################################################################################
+"""
+
+
+from subprocess import Popen
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+from threading import Thread
+import os.path, math, glob
+
+from timelapse_render import image_input
+from timelapse_commit import atomic_file, make_folder
+
+
+playlist_name = 'live.m3u8'                           # playlist file name, in the live folder
+
+
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """ Http handler serving the live folder, without logging each request to the terminal.
+    """
+
+    def log_message(self, format, *args):
+        pass                                          # requests aren't logged
+
+    def end_headers(self):
+        self.send_header('Cache-Control', 'no-cache') # the playlist changes at every segment
+        self.send_header('Access-Control-Allow-Origin', '*')  # browser players from other hosts
+        super().end_headers()
+
+
+
+
+
+class LiveStream:
+    """ Rolling HLS stream of the pictures added via add().
+    """
+
+    def __init__(self, folder, seg_frames=30, fps=24, lowres=2, port=0):
+        self.folder = folder                          # live stream folder (segments and playlist)
+        self.seg_frames = max(1, int(seg_frames))     # pictures per segment
+        self.fps = fps                                # stream fps
+        self.lowres = lowres                          # JPEG decoding at 1/2**lowres of the picture size
+        self.playlist = os.path.join(folder, playlist_name)  # playlist file
+        self.frames = []                              # pictures waiting for the next segment
+        self.encoding = None                          # ongoing segment encode: (ffmpeg process, segment, list)
+        self.server = None                            # http server (when a port is set)
+        self.ready = None                             # callable telling if a picture can be read (i.e. staged writes)
+        make_folder(folder)                           # live folder is made, if missing
+        self.segments = self.read_playlist()          # (segment name, duration) of the stream so far
+        if port:                                      # case of http server
+            self.serve(port)                          # live folder is served
+
+
+    def read_playlist(self):
+        """ Returns the segments of an unfinished playlist (stream continued after a power outage); A finished
+            playlist, or a missing one, starts a new stream (old segments are removed).
+        """
+        segments = []                                 # empty list to store the segments
+        if os.path.exists(self.playlist):             # case of a previous playlist
+            with open(self.playlist, 'r') as f:       # playlist is opened in reading mode
+                lines = f.read().splitlines()         # playlist lines
+            if '#EXT-X-ENDLIST' not in lines:         # case the previous stream wasn't finished
+                for i, line in enumerate(lines[:-1]): # iteration over the playlist lines
+                    if line.startswith('#EXTINF:'):   # case of segment duration
+                        segments.append((lines[i+1], float(line[8:].rstrip(','))))  # segment and duration
+                return segments                       # segments of the previous stream are returned
+        for fname in glob.glob(os.path.join(self.folder, 'live_*.ts')) + [self.playlist]:  # old stream files
+            if os.path.exists(fname):                 # case the file exists
+                os.remove(fname)                      # old file is removed
+        return segments                               # empty list is returned
+
+
+    def write_playlist(self, ended=False):
+        """ Writes the playlist (EVENT type, segments are only appended); Atomic commit, so players never read
+            a truncated playlist.
+        """
+        target = max([math.ceil(d) for _, d in self.segments] + [1])  # longest segment duration
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{target}',
+                 '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:EVENT']
+        for name, duration in self.segments:          # iteration over the segments
+            lines += [f'#EXTINF:{duration:.3f},', name]  # segment duration and file
+        if ended:                                     # case the stream is finished
+            lines.append('#EXT-X-ENDLIST')            # no more segments
+        with atomic_file(self.playlist) as f:         # playlist is committed when written
+            f.write('\n'.join(lines) + '\n')          # playlist is written
+
+
+    def add(self, frame):
+        """ Adds a picture to the stream; A segment is encoded when seg_frames pictures are waiting, and no
+            other segment is being encoded (not blocking).
+        """
+        self.frames.append(frame)                     # picture waits for the next segment
+        self.poll()                                   # ongoing encode is checked
+        ready = self.ready is None or self.ready(self.frames[min(self.seg_frames, len(self.frames)) - 1])  # pictures on storage
+        if self.encoding is None and len(self.frames) >= self.seg_frames and ready:  # case a segment can be encoded
+            self.encode(self.frames[:self.seg_frames])  # segment encode is started
+            self.frames = self.frames[self.seg_frames:]  # pictures still waiting
+
+
+    def encode(self, frames):
+        """ Starts the encode of the frames to the next segment (not blocking); Timestamps continue from the
+            previous segments, so the stream plays without discontinuities.
+        """
+        index = len(self.segments)                    # segment index
+        name = f'live_{index:05}.ts'                  # segment file name
+        list_file = os.path.join(self.folder, f'live_{index:05}.ffconcat')  # list of the segment frames
+        pic_input = image_input(frames, self.fps, '', list_file, True)  # ffmpeg input arguments
+        pic_input = pic_input.replace('-i ', f'-lowres {self.lowres} -i ', 1)  # reduced size JPEG decoding
+        offset = sum([d for _, d in self.segments])   # stream time at the segment start
+        command = (f"nice -n 19 ffmpeg -nostats -loglevel error {pic_input} -vf 'scale=trunc(iw/2)*2:trunc(ih/2)*2' "
+                   f"-c:v libx264 -preset ultrafast -pix_fmt yuv420p -g {self.seg_frames} "
+                   f"-f mpegts -output_ts_offset {offset:.3f} '{os.path.join(self.folder, name)}' -y")
+        self.encoding = (Popen(command, shell=True), name, len(frames) / self.fps, list_file)  # ffmpeg is started
+
+
+    def poll(self):
+        """ Checks the ongoing segment encode; When done, the segment is appended to the playlist.
+        """
+        if self.encoding is None:                     # case no encode is ongoing
+            return                                    # nothing to do
+        proc, name, duration, list_file = self.encoding  # ongoing encode
+        ret = proc.poll()                             # ffmpeg return code (None while running)
+        if ret is None:                               # case ffmpeg is still encoding
+            return                                    # nothing to do
+        if ret == 0:                                  # case the segment is encoded
+            self.segments.append((name, duration))    # segment is added to the stream
+            self.write_playlist()                     # playlist is updated
+        else:                                         # case of encode error
+            print(f"\nLive stream: segment {name} not encoded")  # feedback is printed to the terminal
+        if os.path.exists(list_file):                 # case the list of frames exists
+            os.remove(list_file)                      # list of frames is removed
+        self.encoding = None                          # no ongoing encode
+
+
+    def serve(self, port):
+        """ Serves the live folder via http, on port (daemon thread).
+        """
+        handler = partial(QuietHandler, directory=self.folder)  # handler serving the live folder
+        try:                                          # tentative approach
+            self.server = ThreadingHTTPServer(('', port), handler)  # http server
+        except OSError as e:                          # case the port can't be used
+            print(f"Live stream: http server not started on port {port} ({e})")
+            return                                    # stream is still made, not served
+        Thread(target=self.server.serve_forever, daemon=True).start()  # server is started
+        print(f"Live stream at http://{os.uname()[1]}.local:{port}/{playlist_name}")
+
+
+    def close(self, ended=True):
+        """ Encodes the pictures still waiting (blocking), and finishes the playlist when ended; The http
+            server is stopped.
+        """
+        if self.encoding is not None:                 # case of ongoing encode
+            self.encoding[0].wait()                   # waits for ffmpeg to end
+            self.poll()                               # segment is added to the playlist
+        if ended and len(self.frames) > 0:            # case of pictures waiting
+            self.encode(self.frames)                  # last (shorter) segment is encoded
+            self.frames = []                          # no more pictures waiting
+            self.encoding[0].wait()                   # waits for ffmpeg to end
+            self.poll()                               # segment is added to the playlist
+        if ended:                                     # case the stream is finished
+            self.write_playlist(ended=True)           # playlist is closed
+        if self.server is not None:                   # case of http server
+            self.server.shutdown()                    # http server is stopped
+            self.server = None                        # server reference is cleared
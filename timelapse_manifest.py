@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+#############################################################################################################
+#  Timelapse application, per-frame capture metadata (manifest)
+#
+#  At each shoot a json record is appended to the manifest.jsonl file, in the pictures folder.
+#  The renderer uses these records (i.e. lores luminance) instead of opening the pictures.
+#
+#  Frame index: each record has the frame number and the picture path (relative to the pictures folder), so
+#  the manifest maps frame numbers to pictures; Frame numbers have at least five digits, and grow wider when
+#  needed. For long runs the pictures can be sharded in subfolders of shard frames each (00000, 00001, ...),
+#  keeping each folder small; The renderer and the power outage recovery use the index, not the file names.
+#############################################################################################################
+"""
+
+
+import os.path, json, glob, re
+
+
+manifest_fname = 'manifest.jsonl'                     # file name of the manifest, in the pictures folder
+
+
+
+def manifest_file(folder):
+    """ Returns the path of the manifest file in folder.
+    """
+    return os.path.join(folder, manifest_fname)       # manifest path is returned
+
+
+
+
+
+def frame_path(folder, fname, frame, pic_format, shard=0):
+    """ Returns the path of the picture of frame: prefix and frame number (at least five digits), in the shard
+        subfolder of the frame when shard (frames per subfolder) is set, otherwise in folder.
+    """
+    pic_name = '{}_{:05}.{}'.format(fname, frame, pic_format)  # file name of the picture
+    if shard > 0:                                     # case of sharded folder
+        return os.path.join(folder, '{:05}'.format(frame // shard), pic_name)  # picture in its shard subfolder
+    return os.path.join(folder, pic_name)             # picture in folder
+
+
+
+
+
+def shard_folders(folder):
+    """ Returns the shard subfolders (digits names) of folder, sorted.
+    """
+    return sorted([d for d in glob.glob(os.path.join(folder, '[0-9]*', '')) if os.path.basename(d[:-1]).isdigit()])
+
+
+
+
+
+def manifest_root(folder):
+    """ Returns the folder holding the manifest of the pictures in folder: its parent for a shard subfolder.
+    """
+    parent, name = os.path.split(folder)              # parent folder and folder name
+    if name.isdigit() and not os.path.exists(manifest_file(folder)) and os.path.exists(manifest_file(parent)):
+        return parent                                 # shard subfolder, the manifest is in the parent
+    return folder                                     # folder has its own manifest (or none)
+
+
+
+
+
+def frame_number(path):
+    """ Returns the frame number from the picture file name (prefix_number.ext), or None; Only for pictures
+        without manifest records.
+    """
+    match = re.search(r'_(\d+)\.[^./]+$', path)      # frame number before the extension
+    return int(match.group(1)) if match else None     # frame number, or None
+
+
+
+
+
+def frame_index(folder, pic_format=''):
+    """ Returns the frame index of folder (dict: frame number -> picture path), from the manifest records; Pictures
+        of pic_format only, when set (compacted pictures match the format of their source, too); The latest record
+        of a frame wins, and frames marked as skipped (integrity check) are left out. Empty dict when folder has no manifest.
+    """
+    ext = '.' + pic_format.lstrip('.') if pic_format else ''  # picture extension, if any
+    index = {}                                        # empty dict to store the frames index
+    for name, record in read_manifest(folder).items():  # iteration over the manifest records
+        source = record.get('source', '')             # original picture of a compacted one
+        if record.get('skip'):                        # case of frame marked as skipped (i.e. truncated picture)
+            continue                                  # picture is left out
+        if record.get('frame') is not None and (name.endswith(ext) or source.endswith(ext)):  # case of picture record
+            index[int(record['frame'])] = os.path.join(folder, name)  # frame number -> picture path
+    return index                                      # frames index is returned
+
+
+
+
+
+def skipped_frames(folder):
+    """ Returns the pictures of folder marked as skipped by the integrity check (dict: picture path -> reason).
+    """
+    return {os.path.join(folder, name): record['skip'] for name, record in read_manifest(folder).items() if record.get('skip')}
+
+
+
+
+
+def append_record(folder, record):
+    """ Appends a record (dict) to the manifest in folder, as a single json line.
+        A line truncated by a power outage is closed first, so it doesn't absorb the new record.
+    """
+    with open(manifest_file(folder), 'ab+') as f:     # manifest file is opened in append mode
+        lead = b''                                    # no separator by default
+        if f.tell() > 0:                              # case of manifest with previous records
+            f.seek(-1, os.SEEK_END)                   # last byte of the manifest
+            lead = b'' if f.read(1) == b'\n' else b'\n'  # new line after a truncated line
+        f.write(lead + (json.dumps(record) + '\n').encode())  # record is written as one json line
+
+
+
+
+
+def read_manifest(folder):
+    """ Returns a dict with the picture file name as key and its record as value.
+        Later records of the same picture update the earlier ones.
+        Truncated lines (i.e. power outage while writing) are skipped.
+    """
+    records = {}                                      # empty dict to store the records
+    fname = manifest_file(folder)                     # manifest path
+    if not os.path.exists(fname):                     # case the manifest does not exist
+        return records                                # empty dict is returned
+
+    with open(fname, 'r') as f:                       # manifest file is opened in reading mode
+        for line in f:                                # iteration over the manifest lines
+            try:                                      # tentative approach
+                record = json.loads(line)             # line is parsed to a dict
+                records.setdefault(record['file'], {}).update(record)  # record is added, or updates the previous one
+            except (ValueError, KeyError, TypeError): # case of truncated or invalid line
+                continue                              # line is skipped
+    return records                                    # dict of records is returned
@@ -0,0 +1,282 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+#############################################################################################################
+#  Timelapse application, distributed render over the LAN
+#
+#  Worker: 'python video_render.py --serve PORT' waits for render requests; Each request is a chunk of frames,
+#  encoded by the local ffmpeg (image2pipe) to a segment, that is sent back to the coordinator.
+#  Coordinator: 'python video_render.py --remote host:port,host:port' splits the frames in chunks, hands them
+#  to the workers (one chunk at the time per worker), collects the segments and joins them (stream copy).
+#
+#  Protocol: a json line per message, eventually followed by raw bytes (the json 'bytes' key is their length).
+#    ping   -> worker replies if it can read the pictures folder at its own parent folder (shared path)
+#    render -> frames are read by the worker (shared path), or streamed by the coordinator after the request
+#              worker replies with the ffmpeg return code, followed by the segment bytes
+#  Frames are referred as folder name and paths relative to it (shard subfolders); Each worker looks for the folder
+#  in its own parent folder (--parent), so each machine can mount the shared pictures at a different path, or not
+#  at all (streamed).
+#  Testable on one machine, i.e. workers on localhost:5001 and localhost:5002.
+#############################################################################################################
+"""
+
+
+from subprocess import Popen, PIPE, run
+from threading import Thread
+from time import time
+import socketserver, socket, tempfile, json, queue, os.path
+
+from timelapse_render import progress_info, print_progress, split_frames, write_concat_list, concat_command
+from timelapse_archive import frame_bytes, frame_exists
+
+
+segment_codec = '-c:v libx264 -pix_fmt yuv420p'       # same encoder settings on all the machines (concat copy)
+
+
+
+
+def send_msg(wfile, msg, data=b''):
+    """ Sends msg (dict) as a json line, followed by the data bytes (their length is added as 'bytes' key).
+    """
+    msg = dict(msg, bytes=len(data))                  # data length is added to the message
+    wfile.write((json.dumps(msg) + '\n').encode())    # json line is sent
+    if data:                                          # case of data
+        wfile.write(data)                             # data bytes are sent
+    wfile.flush()                                     # buffered data are sent
+
+
+
+
+
+def read_msg(rfile):
+    """ Returns the next message (dict) and its data bytes, or (None, b'') when the connection is closed.
+        Malformed messages raise ValueError.
+    """
+    line = rfile.readline()                           # json line
+    if not line:                                      # case the connection is closed
+        return None, b''                              # None is returned
+    msg = json.loads(line)                            # json line is parsed to a dict
+    if not isinstance(msg, dict):                     # case of malformed message
+        raise ValueError(f"malformed message {line[:100]!r}")
+    data = rfile.read(msg['bytes']) if msg.get('bytes', 0) > 0 else b''  # data bytes, when any
+    return msg, data                                  # message and data are returned
+
+
+
+
+
+def shared_frame(folder, name):
+    """ Returns the path of the frame name (relative to folder, i.e. 'shard/picture.jpg') on this machine;
+        Names out of folder raise OSError.
+    """
+    if os.path.isabs(name) or os.path.normpath(name).split(os.sep)[0] == '..':  # case of name out of folder
+        raise OSError(f"frame {name} out of the pictures folder")
+    return os.path.join(folder, name)                 # frame path is returned
+
+
+
+
+
+def segment_command(framerate, size, v_f, out_file):
+    """ Returns the ffmpeg command encoding the pictures piped to stdin (image2pipe) to the out_file segment.
+    """
+    v_f = f"-vf '{v_f}'" if v_f else ''               # video filter, when any
+    return (f"ffmpeg -nostats -loglevel error -f image2pipe -framerate {framerate} -i - "
+            f"-s '{size}' {v_f} {segment_codec} -r {framerate} '{out_file}' -y")
+
+
+
+
+
+class RenderHandler(socketserver.StreamRequestHandler):
+    """ Worker side of the protocol: serves the requests of a coordinator connection.
+    """
+
+    def handle(self):
+        parent_folder = self.server.parent_folder     # pictures parent folder, on this machine
+        while True:                                   # loop until the coordinator closes the connection
+            msg, _ = read_msg(self.rfile)             # request from the coordinator
+            if msg is None:                           # case the connection is closed
+                break                                 # while loop is interrupted
+
+            folder = os.path.join(parent_folder, msg.get('folder', ''))  # pictures folder, on this machine
+            if msg['cmd'] == 'ping':                  # case of ping request
+                try:                                  # tentative approach
+                    shared = frame_exists(shared_frame(folder, msg.get('sample', '')))  # pictures are readable
+                except OSError:                       # case of sample out of the pictures folder
+                    shared = False                    # frames are streamed
+                send_msg(self.wfile, {'host': socket.gethostname(), 'shared': shared})
+
+            elif msg['cmd'] == 'render':              # case of render request
+                print(f"Segment {msg['segment']} from {self.client_address[0]}, {len(msg['frames'])} frames")
+                fd, seg_file = tempfile.mkstemp(suffix='.mp4')  # temporary segment file
+                os.close(fd)                          # file descriptor isn't used
+                start_time = time()                   # time reference for the segment render
+                command = segment_command(msg['framerate'], msg['size'], msg.get('v_f', ''), seg_file)
+                proc = Popen(command, shell=True, stdin=PIPE, stderr=PIPE)  # ffmpeg is started
+                failed = False                        # flag for a frame not reaching ffmpeg
+                for name in msg['frames']:            # iteration over the frames of the chunk
+                    if msg['stream']:                 # case the frames are streamed by the coordinator
+                        _, data = read_msg(self.rfile)  # frame bytes (always read, to keep the protocol in sync)
+                    elif not failed:                  # case the frames are read from the shared folder
+                        try:                          # tentative approach
+                            data = frame_bytes(shared_frame(folder, name))  # frame bytes (loose, or archived)
+                        except OSError:               # case the frame can't be read
+                            failed = True             # a frame is missing
+                            proc.kill()               # ffmpeg is stopped, not to render a shorter segment
+                    if not failed:                    # case all the frames so far reached ffmpeg
+                        try:                          # tentative approach
+                            proc.stdin.write(data)    # frame is piped to ffmpeg
+                        except OSError:               # case ffmpeg stopped
+                            failed = True             # ffmpeg return code reports the error
+                try:                                  # tentative approach
+                    proc.stdin.close()                # end of the frames
+                except OSError:                       # case ffmpeg stopped
+                    pass                              # ffmpeg return code reports the error
+                err = proc.stderr.read().decode(errors='replace')  # ffmpeg errors, when any
+                ret = proc.wait()                     # ffmpeg return code
+                ret = ret if ret != 0 or not failed else -1  # a missing frame is an error
+
+                data = b''                            # segment bytes
+                if ret == 0:                          # case the segment is rendered
+                    with open(seg_file, 'rb') as f:   # segment file is opened in reading mode
+                        data = f.read()               # segment bytes
+                os.remove(seg_file)                   # temporary segment file is removed
+                send_msg(self.wfile, {'ret': ret, 'error': err[-500:], 'host': socket.gethostname(),
+                                      'seconds': round(time() - start_time, 2)}, data)  # segment is sent back
+
+
+
+
+
+def serve(port, parent_folder, host='0.0.0.0'):
+    """ Runs the render worker on port (until Ctrl+C); parent_folder is where the shared pictures are mounted.
+    """
+    socketserver.TCPServer.allow_reuse_address = True # port reusable right after a restart
+    with socketserver.TCPServer((host, port), RenderHandler) as server:  # one chunk at the time
+        server.parent_folder = parent_folder          # pictures parent folder, on this machine
+        print(f"Render worker listening on port {port}, pictures parent folder {parent_folder}")
+        try:                                          # tentative approach
+            server.serve_forever()                    # requests are served
+        except KeyboardInterrupt:                     # case of Ctrl+C
+            print("\nRender worker stopped")
+
+
+
+
+
+def parse_workers(workers):
+    """ Returns the list of (host, port) from the 'host:port,host:port' string.
+    """
+    addresses = []                                    # empty list to store the addresses
+    for worker in workers.split(','):                 # iteration over the workers
+        host, _, port = worker.strip().rpartition(':')  # host and port
+        addresses.append((host if host else 'localhost', int(port)))  # address is appended
+    return addresses                                  # list of addresses is returned
+
+
+
+
+
+def remote_worker(address, chunks, segments, folder, frames_sample, request, done, timeout=600):
+    """ Coordinator side of a worker connection: takes chunks from the chunks queue, until empty.
+        Frames are sent as paths relative to folder (the local pictures folder), frames_sample is one of them.
+        Rendered segments are stored in the segments dict (chunk index as key); A failed chunk is put back
+        to the queue, and the worker is dropped; A worker not replying to the ping is dropped before taking chunks.
+    """
+    try:                                              # tentative approach
+        conn = socket.create_connection(address, timeout=timeout)  # connection to the worker
+    except OSError as e:                              # case the worker is not reachable
+        print(f"Render worker {address[0]}:{address[1]} not reachable ({e})")
+        return                                        # worker is dropped
+
+    with conn, conn.makefile('rb') as rfile, conn.makefile('wb') as wfile:
+        try:                                          # tentative approach
+            send_msg(wfile, {'cmd': 'ping', 'folder': request['folder'], 'sample': frames_sample})  # ping request
+            info, _ = read_msg(rfile)                 # worker info
+            if info is None or 'shared' not in info or 'host' not in info:  # case of closed connection, or malformed reply
+                raise ValueError('connection closed' if info is None else 'malformed ping reply')
+        except (OSError, ValueError) as e:            # case the worker doesn't reply to the ping
+            print(f"Render worker {address[0]}:{address[1]} not reachable ({e})")
+            return                                    # worker is dropped, the chunks are left to the others
+        stream = not info['shared']                   # frames are streamed when not readable by the worker
+        print(f"Render worker {info['host']} ({address[0]}:{address[1]}), frames {'streamed' if stream else 'shared'}")
+
+        while True:                                   # loop until the chunks are over
+            try:                                      # tentative approach
+                index, chunk = chunks.get_nowait()    # next chunk
+            except queue.Empty:                       # case of no more chunks
+                break                                 # while loop is interrupted
+            try:                                      # tentative approach
+                send_msg(wfile, dict(request, cmd='render', segment=index, stream=stream,
+                                     frames=[os.path.relpath(f, folder) for f in chunk]))  # render request
+                if stream:                            # case the frames are streamed
+                    for frame in chunk:               # iteration over the frames of the chunk
+                        send_msg(wfile, {}, frame_bytes(frame))  # frame bytes are sent (archived: no copy)
+                reply, data = read_msg(rfile)         # segment from the worker
+                if reply is None or reply.get('ret') != 0:  # case the segment hasn't been rendered
+                    raise RuntimeError(reply.get('error', 'malformed reply') if reply else 'connection closed')
+            except (OSError, RuntimeError, ValueError) as e:  # case of errors
+                print(f"\nRender worker {address[0]}:{address[1]} failed on segment {index} ({e})")
+                chunks.put((index, chunk))            # chunk is put back, for the other workers
+                return                                # worker is dropped
+            segments[index] = data                    # segment is stored
+            done.append(len(chunk))                   # frames done
+
+
+
+
+
+def remote_render(folder, frames, framerate, size, v_f, workers, out_file, chunk_frames=200,
+                  progress_cb=print_progress, period=2):
+    """ Renders frames (pictures of folder) on the remote workers ('host:port,host:port'), in chunks of
+        chunk_frames, then joins the segments to out_file. Returns the ffmpeg return code (-1 when segments are
+        missing, i.e. no workers reachable).
+    """
+    start_time = time()                               # time reference for the render
+    folder_rel = os.path.basename(os.path.normpath(folder))  # pictures folder name, looked up by the workers
+    request = {'folder': folder_rel, 'framerate': str(framerate), 'size': size, 'v_f': v_f}  # render request
+    chunks = queue.Queue()                            # queue of the chunks to render
+    for index, chunk in enumerate(split_frames(frames, chunk_frames)):  # iteration over the chunks
+        chunks.put((index, chunk))                    # chunk is queued
+    count = chunks.qsize()                            # chunks quantity
+    segments, done = {}, []                           # rendered segments, and frames done per segment
+
+    for attempt in range(3):                          # new connections for the chunks put back by failed workers
+        threads = [Thread(target=remote_worker, daemon=True,
+                          args=(a, chunks, segments, folder, os.path.relpath(frames[0], folder), request, done))
+                   for a in parse_workers(workers)]   # one thread per worker
+        for thread in threads:                        # iteration over the threads
+            thread.start()                            # thread is started
+        last_cb = 0                                   # time of the last call to progress_cb
+        while any([t.is_alive() for t in threads]):   # while workers are rendering
+            if progress_cb and time() - last_cb >= period:  # case it is time for a feedback
+                progress_cb(progress_info(sum(done), len(frames), start_time))  # progress feedback
+                last_cb = time()                      # time of the last feedback
+            for thread in threads:                    # iteration over the threads
+                thread.join(timeout=0.5)              # short wait
+        if len(segments) == count or chunks.empty():  # case all chunks have been taken
+            break                                     # for loop is interrupted
+
+    if progress_cb:                                   # case of progress feedback
+        progress_cb(progress_info(sum(done), len(frames), start_time))  # last progress feedback
+    if progress_cb is print_progress:                 # case the progress is printed to the terminal
+        print()                                       # new line after the progress line
+    if len(segments) < count:                         # case of missing segments
+        print(f"Remote render: {count - len(segments)} of {count} segments missing")
+        return -1                                     # error return code
+
+    base = out_file.rsplit('.', 1)[0]                 # output file without extension
+    seg_files = [f"{base}_seg{i:03}.mp4" for i in range(count)]  # segments files
+    for i, seg_file in enumerate(seg_files):          # iteration over the segments
+        with open(seg_file, 'wb') as f:               # segment file is opened in binary mode
+            f.write(segments[i])                      # segment is saved
+    list_file = base + '_segments.ffconcat'           # list of the segments
+    write_concat_list(seg_files, list_file)           # segments list is written
+    joined = run(concat_command(list_file, out_file), shell=True, stderr=PIPE, text=True)  # segments are joined (stream copy)
+    for fname in seg_files + [list_file]:             # iteration over the temporary files
+        os.remove(fname)                              # temporary file is removed
+    if joined.returncode != 0:                        # case the segments haven't been joined
+        print(f"Remote render: segments join failed ({joined.stderr.strip()[-500:]})")
+    return joined.returncode                          # ffmpeg return code is returned
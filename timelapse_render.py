@@ -0,0 +1,966 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+#############################################################################################################
+#  Timelapse application, rendering helpers shared by timelapse.py and video_render.py
+#
+#  Proxy render: pictures are decoded at 1/2, 1/4 or 1/8 of their size via the DCT scaling of libjpeg
+#  (PIL draft), in a pool of processes, and piped as raw video to ffmpeg; Frames are never fully decoded.
+#
+#  Deflicker: per-frame mean luminance is taken from the capture-time lores stats (manifest), or from DCT
+#  scaled thumbnails; The luminance curve is smoothed and a per-frame gain is applied while piping the frames.
+#
+#  Stabilization: the shift in between consecutive frames is estimated by FFT phase correlation on small
+#  grayscale thumbnails (DCT scaled decoding, in a pool of processes; FFT vectorized over blocks of frames);
+#  The camera trajectory is smoothed, and each frame is cropped at its offset while piping the frames.
+#
+#  Fix movie time: when the frames exceed what the movie time can show at a sensible fps, an evenly spaced
+#  subset of frames is rendered (only these are decoded); Otherwise a fractional framerate is used.
+#
+#  Mezzanine cache: the first render of a folder also stores all the frames as a high quality video stream;
+#  Later renders changing only timing or overlays start from it, until the frames manifest hash changes.
+#  A render stamp (frames hash, options and movies) lets batch renders skip folders already rendered.
+#
+#  Renditions: several outputs (size, codec, quality, fps or time, overlay) from a single decode pass, via a
+#  split filter graph; ffmpeg benchmark lines give the decode time and the encode time of each output.
+#
+#  Progress: ffmpeg runs as a managed subprocess, its -progress output is parsed to frames done, encode fps,
+#  percent and ETA; Each render appends a timing record to render_timings.jsonl, next to the scripts (render
+#  speed of the board).
+#
+#  Overlay timeline: capture time, lux and temperature of each frame (manifest) travel with the frame, as packet
+#  metadata in the ffconcat list, and drawtext prints them (or PIL, when piping); No extra decode or encode.
+#
+#  Night trim: frames below a lux or luminance threshold (chosen at render time) are dropped by their capture
+#  values (manifest), so dark frames are never opened; Optionally a short crossfade hides each cut (piping).
+#
+#  Scheduling: past timings give the expected render speed, to estimate a render and split it in segments
+#  fitting the idle time in between shooting windows; Segments are joined via ffmpeg concat (stream copy).
+#
+#  Crash safety: movies and segments are written as .partial files, renamed (atomic) when complete; A render
+#  checkpoint (json) lists the jobs of a queued render, so after a power outage only the missing segments
+#  are rendered; Leftovers of interrupted renders are listed, and removed, at startup.
+#
+#  Day archives: pictures packed in day archives (timelapse_archive.py) are listed with the loose ones, and
+#  read in place: ffconcat lists point ffmpeg to their range of the archive, PIL decodes them from memory.
+#############################################################################################################
+"""
+
+
+from multiprocessing import Pool
+from fractions import Fraction
+from subprocess import Popen, PIPE
+from time import time, localtime, strftime
+from datetime import timedelta
+from PIL import Image, ImageStat, ImageDraw, ImageFont
+from timelapse_manifest import read_manifest, manifest_root, frame_index, shard_folders, skipped_frames
+from timelapse_archive import list_archived, frame_entry, frame_stat, frame_exists, open_frame
+from timelapse_commit import atomic_file, commit
+import numpy as np
+import os.path, glob, hashlib, json, re, socket
+
+
+timings_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render_timings.jsonl')  # render timings, next to the scripts
+font_files = ('/usr/share/fonts/truetype/freefont/dejavu/DejaVuSans.ttf', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+font_file = next((f for f in font_files if os.path.isfile(f)), None)  # overlay font, for ffmpeg and PIL (None when missing)
+
+
+
+def list_frames(folder, pic_format):
+    """ Returns the pictures (pic_format) in folder, in frame order from the frames index (manifest), also
+        when sharded in subfolders; Pictures packed in day archives are included (same path, as if loose), and
+        so are the compacted pictures (any format, from the frames index); Pictures marked as skipped by the
+        integrity check are left out.
+        Folders without manifest are listed by name, as per the ffmpeg glob pattern.
+    """
+    pic_format = pic_format.lstrip('.')               # leading dot is removed, if any
+    index = frame_index(folder, pic_format)           # frame number -> picture path, from the manifest
+    if len(index) > 0:                                # case of frames index
+        index = frame_index(folder)                   # all the frames of the run (originals and compacted pictures)
+        return [index[n] for n in sorted(index) if frame_exists(index[n])]  # existing pictures, in frame order
+    frames = []                                       # empty list to store the pictures
+    for f in [folder] + shard_folders(folder):        # iteration over folder and its shard subfolders
+        frames += glob.glob(os.path.join(f, '*.' + pic_format)) + list_archived(f.rstrip(os.sep), pic_format)
+    skipped = skipped_frames(folder)                  # pictures marked as skipped by the integrity check
+    return sorted(set(frames).difference(skipped))    # sorted list of pictures
+
+
+
+
+
+def fit_to_time(frames, movie_time_s, fps=24, max_fps=30, extra=0):
+    """ Returns the frames, the framerate and the decimation flag, to render a movie of exactly movie_time_s.
+        When the frames would need more than max_fps, an evenly spaced subset of fps*movie_time_s frames
+        is selected; Otherwise all the frames are used, at the (fractional) framerate frames/movie_time_s.
+        extra are the frames added to the movie (i.e. crossfades), taken from the frames budget.
+    """
+    count = len(frames)                               # frames quantity
+    if count + extra > max_fps * movie_time_s:        # case the frames exceed the max_fps for the movie time
+        fps = min(int(fps), max_fps)                  # fps of the decimated movie
+        n = min(count, max(1, fps * movie_time_s - extra))  # frames quantity for the exact movie time
+        return [frames[i*count//n] for i in range(n)], Fraction(fps), True  # evenly spaced frames
+    return frames, Fraction(count + extra, max(1, movie_time_s)), False  # all the frames, at fractional framerate
+
+
+
+
+
+def image_input(frames, framerate, pic_files, list_file, decimated, overlays=None):
+    """ Returns the ffmpeg input arguments for the pictures.
+        All the pictures are read via the glob pattern pic_files; When decimated, only the selected frames are
+        listed in the ffconcat list_file (each lasting 1/framerate), so the others are never decoded.
+        When overlays (one text per frame) are provided, the frames are listed and each one carries its text
+        as 'overlay' metadata, printed by overlay_filter.
+        Archived frames are always listed, as their range in the day archive (subfile protocol); Sharded frames,
+        frame numbers wider than five digits (name order differs from frame order), compacted frames (format
+        differs from the pattern), and frames leaving out pictures matched by the pattern are listed too.
+    """
+    entries = [frame_entry(frame) for frame in frames]  # frame paths, or archive ranges
+    archived = entries != list(frames)                # case of archived frames
+    globbed = all([os.path.dirname(f) == os.path.dirname(pic_files) and
+                   os.path.splitext(f)[1] == os.path.splitext(pic_files)[1] for f in entries]) and entries == sorted(entries) \
+              and len(glob.glob(pic_files)) == len(entries)  # pattern order, and no pictures left out (i.e. bad ones)
+    if not decimated and overlays is None and not archived and globbed:  # case the glob pattern matches the frames
+        return f"-f image2 -framerate {framerate} -pattern_type glob -i '{pic_files}'"
+    
+    duration = float(1/Fraction(framerate))           # time (secs) each frame lasts
+    with open(list_file, 'w') as f:                   # ffconcat list file is opened in writing mode
+        f.write('ffconcat version 1.0\n')             # ffconcat header
+        for i, frame in enumerate(entries):           # iteration over the selected frames
+            frame = frame.replace("'", "'\\''")      # quotes are escaped as per ffconcat syntax
+            f.write(f"file '{frame}'\n")              # frame file
+            if overlays is not None:                  # case of overlays
+                text = overlays[i].replace("'", "")   # quotes are removed from the text
+                f.write(f"file_packet_metadata 'overlay={text}'\n")  # overlay text as frame metadata
+            f.write(f"duration {duration:.6f}\n")     # time the frame lasts
+    whitelist = '-protocol_whitelist file,subfile ' if archived else ''  # archive ranges are allowed
+    return f"-f concat -safe 0 {whitelist}-i '{list_file}' -r {framerate}"
+
+
+
+
+
+def select_filter(count, n):
+    """ Returns the ffmpeg select filter keeping n evenly spaced frames out of count.
+        Kept frames are the same of fit_to_time (frame i*count//n, for i in range(n)).
+    """
+    return f"select='gt(ceil((n+1)*{n}/{count}),ceil(n*{n}/{count}))'"
+
+
+
+
+
+def timing_filter(framerate):
+    """ Returns the ffmpeg setpts filter, retiming the frames to framerate (it can be a fraction).
+    """
+    framerate = Fraction(framerate)                   # framerate as fraction
+    return f"setpts=N*{framerate.denominator}/({framerate.numerator}*TB)"
+
+
+
+
+
+def frames_hash(frames):
+    """ Returns the hash of the frames manifest (file name, size and modification time of each frame).
+    """
+    h = hashlib.sha1()                                # hash object
+    for frame in frames:                              # iteration over the frames
+        size, mtime_ns = frame_stat(frame)            # frame size and modification time (no file reading)
+        h.update(f"{os.path.basename(frame)}:{size}:{mtime_ns}\n".encode())
+    return h.hexdigest()                              # hash as hex string
+
+
+
+
+
+def mezzanine_files(folder):
+    """ Returns the paths of the mezzanine video, its temporary file and its info file.
+    """
+    mezz_folder = os.path.join(folder, '.mezzanine')  # hidden folder for the mezzanine cache
+    return (os.path.join(mezz_folder, 'mezzanine.mkv'),
+            os.path.join(mezz_folder, 'mezzanine.partial.mkv'),
+            os.path.join(mezz_folder, 'mezzanine.json'))
+
+
+
+
+
+def valid_mezzanine(folder, frames_id, count, size):
+    """ Returns the mezzanine path when it matches the frames (hash and quantity) and size, otherwise None.
+    """
+    mezz_file, _, info_file = mezzanine_files(folder) # mezzanine paths
+    if not os.path.exists(mezz_file) or not os.path.exists(info_file):  # case the mezzanine is missing
+        return None                                   # None is returned
+    try:                                              # tentative approach
+        with open(info_file, 'r') as f:               # mezzanine info file is opened in reading mode
+            info = json.load(f)                       # mezzanine info are parsed to a dict
+    except ValueError:                                # case of invalid info file
+        return None                                   # None is returned
+    if info.get('hash') != frames_id or info.get('frames') != count or info.get('size') != size:
+        return None                                   # None is returned, as the mezzanine is outdated
+    return mezz_file                                  # valid mezzanine path is returned
+
+
+
+
+
+def store_mezzanine(folder, frames_id, count, size):
+    """ Validates the just made mezzanine: temporary file is renamed and its info file is written.
+    """
+    mezz_file, mezz_tmp, info_file = mezzanine_files(folder)  # mezzanine paths
+    commit(mezz_tmp, mezz_file)                       # atomic commit of the mezzanine
+    with atomic_file(info_file) as f:                 # mezzanine info file is committed when written
+        json.dump({'hash': frames_id, 'frames': count, 'size': size}, f)  # mezzanine info are saved
+
+
+
+
+
+def stamp_file(folder):
+    """ Returns the path of the render stamp (frames hash, render options and movies of the last render).
+    """
+    return os.path.join(folder, '.rendered.json')     # hidden file in the pictures folder
+
+
+
+
+
+def rendered_unchanged(folder, frames_id, options):
+    """ Returns the movies of the last render, when made from the same frames (hash) with the same options
+        and all still existing; Otherwise returns None.
+    """
+    try:                                              # tentative approach
+        with open(stamp_file(folder), 'r') as f:      # render stamp is opened in reading mode
+            stamp = json.load(f)                      # render stamp is parsed to a dict
+    except (OSError, ValueError):                     # case of missing or invalid stamp
+        return None                                   # None is returned
+    if stamp.get('hash') != frames_id or stamp.get('options') != options:  # case pictures or options changed
+        return None                                   # None is returned
+    movies = stamp.get('movies', [])                  # movies of the last render
+    if len(movies) == 0 or not all([os.path.exists(m) for m in movies]):  # case of missing movies
+        return None                                   # None is returned
+    return movies                                     # movies of the last render are returned
+
+
+
+
+
+def store_render_stamp(folder, frames_id, options, movies):
+    """ Writes the render stamp of folder, after a successful render.
+    """
+    with atomic_file(stamp_file(folder)) as f:        # render stamp is committed when written
+        json.dump({'hash': frames_id, 'options': options, 'movies': movies,
+                   'date': strftime("%Y-%m-%d %H:%M:%S", localtime())}, f)  # render stamp is saved
+
+
+
+
+
+def rendition_plan(renditions, count, width, height):
+    """ Returns the renditions (list of dicts) completed with defaults, framerate and frames selection.
+        Rendition keys: name, width, height, codec, crf, fps, time (fix movie time when > 0), text, format.
+    """
+    plan = []                                         # empty list to store the completed renditions
+    for i, r in enumerate(renditions):                # iteration over the requested renditions
+        r = dict(r)                                   # copy of the rendition dict
+        r.setdefault('name', f'r{i}')                 # rendition name, used as output file suffix
+        r.setdefault('width', width)                  # rendition width, pictures width when not defined
+        r.setdefault('height', height)                # rendition height, pictures height when not defined
+        r.setdefault('codec', 'libx264')              # video codec
+        r.setdefault('crf', 23)                       # quality (constant rate factor)
+        r.setdefault('fps', 24)                       # fps, when the movie time is not fixed
+        r.setdefault('time', 0)                       # fix movie time (secs), zero to use fps
+        r.setdefault('text', '')                      # text to overlay
+        r.setdefault('format', 'gif' if r['codec'] == 'gif' else 'mp4')  # output container
+        
+        if int(r['time']) > 0:                        # case of fix movie time
+            selected, framerate, decimated = fit_to_time(range(count), int(r['time']), int(r['fps']))
+            r['frames'], r['framerate'], r['decimated'] = len(selected), framerate, decimated
+        else:                                         # case of fix fps
+            r['frames'], r['framerate'], r['decimated'] = count, Fraction(int(r['fps'])), False
+        plan.append(r)                                # completed rendition is added to the list
+    return plan                                       # list of completed renditions is returned
+
+
+
+
+
+def renditions_command(pic_input, plan, count, height, stamp, folder, mezz_tmp='', width=0):
+    """ Returns the ffmpeg command making all the renditions from a single decode of pic_input.
+        When mezz_tmp is provided, the mezzanine (all the frames at width x height) is an additional output.
+    """
+    branches = len(plan) + (1 if mezz_tmp else 0)     # split branches, one per output
+    f_c = [f"[0:v]split={branches}" + ''.join(f'[v{i}]' for i in range(branches))]  # split of the decoded frames
+    outputs = []                                      # empty list to store the output arguments
+    for i, r in enumerate(plan):                      # iteration over the renditions
+        v_f = [select_filter(count, r['frames'])] if r['decimated'] else []  # evenly spaced frames, if decimated
+        v_f.append(timing_filter(r['framerate']))     # frames retiming
+        v_f.append(f"scale={r['width']}:{r['height']}")  # rendition size
+        if r['text'] != '':                           # case of text to overlay
+            v_f.append(drawtext_filter(r['text'], int(r['height']), height/int(r['height'])))
+        f_c.append(f"[v{i}]" + ','.join(v_f) + f"[o{i}]")  # filter chain of the rendition
+        
+        r['out_file'] = os.path.join(folder, f"{stamp}_{r['name']}.{r['format']}")  # rendition output file
+        if r['format'] == 'gif':                      # case of a (looping) gif preview
+            codec = '-loop 0'                         # endless loop
+        else:                                         # case of a video codec
+            codec = f"-c:v {r['codec']} -crf {r['crf']} -pix_fmt yuv420p"
+        outputs.append(f"-map '[o{i}]' {codec} -r {r['framerate']} '{r['out_file']}'")
+    
+    if mezz_tmp:                                      # case the mezzanine is made in the same pass
+        f_c.append(f"[v{len(plan)}]scale={width}:{height}[mz]")
+        outputs.append(f"-map '[mz]' -c:v libx264 -preset veryfast -crf 12 -pix_fmt yuv420p '{mezz_tmp}'")
+    
+    return f"ffmpeg -nostats -benchmark_all {pic_input} -filter_complex \"{';'.join(f_c)}\" {' '.join(outputs)} -y"
+
+
+
+
+
+def parse_benchmark(log):
+    """ Returns the decode time and the encode time of each output (secs), from the ffmpeg -benchmark_all log.
+        Times are exact with the serial pipeline of ffmpeg up to 5.x (Raspberry Pi OS); With the threaded
+        pipeline of ffmpeg 6+ the per-call deltas overlap, and the negative (wrapped) ones are skipped.
+    """
+    decode_s = 0                                      # decode time, in secs
+    encode_s = {}                                     # encode time per output index, in secs
+    for real_us, task, out_idx in re.findall(r'bench:.*?(\d+) real (\w+) (\d+)[.:]', log):
+        if int(real_us) >= 2**63:                     # case of negative delta, printed as unsigned
+            continue                                  # value is skipped
+        if task == 'decode_video':                    # case of decoding task
+            decode_s += int(real_us)/1e6              # decode time is accumulated
+        elif task in ('encode_video', 'flush_video'): # case of encoding task
+            encode_s[int(out_idx)] = encode_s.get(int(out_idx), 0) + int(real_us)/1e6  # encode time per output
+    return decode_s, encode_s                         # decode and encode times are returned
+
+
+
+
+
+def progress_info(frame, total, start_time):
+    """ Returns the progress dict: frames done, total frames, average fps, percent, elapsed and ETA (secs).
+    """
+    elapsed_s = max(time() - start_time, 1e-3)        # elapsed time since the render start
+    fps = frame / elapsed_s                           # average render fps
+    percent = min(100, 100 * frame / total) if total > 0 else 0  # render percentage
+    eta_s = (total - frame) / fps if fps > 0 else 0   # estimated time to the render end
+    return {'frame': frame, 'total': total, 'fps': fps, 'percent': percent, 'elapsed_s': elapsed_s, 'eta_s': max(0, eta_s)}
+
+
+
+
+
+def print_progress(progress):
+    """ Prints the render progress on a single terminal line.
+    """
+    print(f"\r  Rendered {progress['frame']} of {progress['total']} frames ({progress['percent']:.1f}%)"
+          f"  {progress['fps']:.1f} fps  ETA {timedelta(seconds=round(progress['eta_s']))}   ", end='', flush=True)
+
+
+
+
+
+def run_ffmpeg(render_command, total, progress_cb=print_progress, period=2):
+    """ Runs the ffmpeg command (string) as a managed subprocess, parsing its -progress output.
+        progress_cb is called with the progress dict at most every period secs, and at the end.
+        Returns the ffmpeg return code.
+    """
+    render_command = render_command.replace('ffmpeg ', 'ffmpeg -progress pipe:1 ', 1)  # progress key=value to stdout
+    start_time = time()                               # time reference for the render
+    last_cb = 0                                       # time of the last call to progress_cb
+    frame = 0                                         # frames rendered
+    proc = Popen(render_command, shell=True, stdout=PIPE, text=True)  # ffmpeg is started
+    for line in proc.stdout:                          # iteration over the progress lines
+        key, _, value = line.strip().partition('=')   # key and value of the progress line
+        if key == 'frame':                            # case of frames quantity
+            frame = int(value)                        # frames rendered so far
+        elif key == 'progress':                       # case of end of a progress block
+            if progress_cb and (value == 'end' or time() - last_cb >= period):  # case it is time for a feedback
+                progress_cb(progress_info(frame, total, start_time))  # progress feedback
+                last_cb = time()                      # time of the last feedback
+    ret = proc.wait()                                 # ffmpeg return code
+    if progress_cb is print_progress:                 # case the progress is printed to the terminal
+        print()                                       # new line after the progress line
+    return ret                                        # ffmpeg return code is returned
+
+
+
+
+
+def save_render_timing(kind, frames, size, seconds, fname=timings_file):
+    """ Appends a render timing record to fname (next to the scripts, whatever the launch folder), to track the
+        render speed of the board.
+    """
+    record = {'date': strftime("%Y-%m-%d %H:%M:%S", localtime()), 'host': socket.gethostname(),
+              'machine': os.uname().machine, 'kind': kind, 'frames': frames, 'size': size,
+              'seconds': round(seconds, 2), 'fps': round(frames/max(seconds, 1e-3), 2)}
+    try:                                              # tentative approach
+        with open(fname, 'a') as f:                   # timings file is opened in append mode
+            f.write(json.dumps(record) + '\n')        # record is written as one json line
+    except OSError:                                   # case the timings file can't be written
+        print("Could not save the render timing to", fname)
+
+
+
+
+
+def render_speed(kind, size, fname=timings_file, default_fps=4.0, last=10):
+    """ Returns the expected render speed (fps) on this board, as the median of the last matching timings
+        (same host and kind; same size when available, otherwise scaled by the pixels count).
+        default_fps is returned when there are no timings yet.
+    """
+    host = socket.gethostname()                       # board host name
+    same_size, other_size = [], []                    # fps of the timings with the same, or other, size
+    try:                                              # tentative approach
+        with open(fname, 'r') as f:                   # timings file is opened in reading mode
+            for line in f:                            # iteration over the timing records
+                try:                                  # tentative approach
+                    record = json.loads(line)         # line is parsed to a dict
+                except ValueError:                    # case of truncated line
+                    continue                          # line is skipped
+                if record.get('host') != host or record.get('kind') != kind or record.get('fps', 0) <= 0:
+                    continue                          # timings of other boards or render kinds are skipped
+                if record.get('size') == size:        # case of same frame size
+                    same_size.append(record['fps'])   # fps is appended
+                else:                                 # case of different frame size
+                    w, h = map(int, record['size'].split('x'))  # width and height of the recorded render
+                    pixels = np.prod([int(v) for v in size.split('x')])  # pixels of the render to estimate
+                    other_size.append(record['fps'] * w * h / pixels)  # fps scaled by the pixels ratio
+    except (OSError, ValueError, KeyError):           # case the timings file is missing or unexpected
+        pass                                          # do nothing
+    
+    speeds = same_size if same_size else other_size   # same size timings are preferred
+    if len(speeds) == 0:                              # case of no timings
+        return default_fps                            # default fps is returned
+    return float(np.median(speeds[-last:]))           # median of the last timings is returned
+
+
+
+
+
+def estimate_render_s(frames, kind, size, fname=timings_file):
+    """ Returns the estimated render time (secs) of frames pictures, based on the past timings.
+    """
+    return frames / render_speed(kind, size, fname)   # estimated render time is returned
+
+
+
+
+
+def split_frames(frames, seg_frames):
+    """ Returns the frames list split in consecutive segments of (at most) seg_frames pictures.
+    """
+    seg_frames = max(1, int(seg_frames))              # at least one picture per segment
+    return [frames[i:i+seg_frames] for i in range(0, len(frames), seg_frames)]  # list of segments is returned
+
+
+
+
+
+def write_concat_list(files, list_file):
+    """ Writes the ffconcat list of the files (segments), referred relative to the list folder.
+    """
+    with open(list_file, 'w') as f:                   # list file is opened in writing mode
+        f.write('ffconcat version 1.0\n')             # ffconcat header
+        for fname in files:                           # iteration over the files
+            f.write(f"file '{os.path.basename(fname)}'\n")  # file, relative to the list
+
+
+
+
+
+def concat_command(list_file, out_file):
+    """ Returns the ffmpeg command joining the segments of list_file to out_file (stream copy, no re-encoding).
+    """
+    return f"ffmpeg -nostats -loglevel error -f concat -safe 0 -i '{list_file}' -c copy '{out_file}' -y"
+
+
+
+
+
+def partial_file(out_file):
+    """ Returns the temporary name out_file is rendered to; It is renamed to out_file once complete.
+    """
+    base, ext = os.path.splitext(out_file)            # file name and extension
+    return base + '.partial' + ext                    # extension kept, as ffmpeg picks the muxer from it
+
+
+
+
+
+def commit_partial(ret, partial, out_file):
+    """ Commits partial to out_file (permissions, fsync and atomic rename) when ret is zero, otherwise removes it.
+    """
+    if ret == 0 and os.path.exists(partial):          # case the render is complete
+        commit(partial, out_file)                     # complete file appears at once, with its final name
+    elif os.path.exists(partial):                     # case of render error
+        os.remove(partial)                            # incomplete file is removed
+
+
+
+
+
+def checkpoint_file(out_file):
+    """ Returns the render checkpoint file of out_file.
+    """
+    return os.path.splitext(out_file)[0] + '.render.json'  # checkpoint file name
+
+
+
+
+
+def save_checkpoint(out_file, jobs, frames):
+    """ Saves the render checkpoint of out_file: its jobs (dicts) and the frames; Atomic commit, so a power
+        outage never leaves a truncated checkpoint.
+    """
+    with atomic_file(checkpoint_file(out_file)) as f: # checkpoint is committed when written
+        json.dump({'out_file': out_file, 'frames': frames, 'jobs': jobs}, f)  # checkpoint is written
+
+
+
+
+
+def resume_jobs(fname):
+    """ Returns the frames and the jobs still to be done of the render checkpoint fname, or None when the render
+        can't be resumed (movie already made, pictures removed, or lists of the missing jobs not available).
+        A job is done when the file it commits to exists.
+    """
+    try:                                              # tentative approach
+        with open(fname, 'r') as f:                   # checkpoint file is opened in reading mode
+            checkpoint = json.load(f)                 # checkpoint is parsed
+    except (OSError, ValueError):                     # case the checkpoint can't be read
+        return None                                   # render can't be resumed
+    if os.path.exists(checkpoint['out_file']):        # case the movie has been made
+        return None                                   # nothing to resume
+    frames = checkpoint['frames']                     # frames of the render
+    if not all([frame_exists(f) for f in frames[:1] + frames[-1:]]):  # case the pictures have been removed
+        return None                                   # render can't be resumed
+    
+    jobs = [job for job in checkpoint['jobs'] if not os.path.exists(job['commit'][1])]  # jobs still to be done
+    for job in jobs:                                  # iteration over the jobs to be done
+        lists = [f for f in job.get('temp_files', []) if f.endswith('.ffconcat')]  # lists of frames or segments
+        if not all([os.path.exists(f) for f in lists]):  # case of a missing list
+            return None                               # job can't be rendered
+    return frames, jobs                               # frames and remaining jobs are returned
+
+
+
+
+
+def partial_outputs(folder):
+    """ Returns the leftovers of interrupted renders in folder: partial files and orphan segments (no
+        checkpoint), and the render checkpoints.
+    """
+    partials, checkpoints, segments = [], [], []      # empty lists to store the leftovers
+    with os.scandir(folder) as entries:               # single pass over the folder
+        for entry in entries:                         # iteration over the folder entries
+            if '.partial.' in entry.name:             # case of a partial file
+                partials.append(entry.path)           # partial file is appended
+            elif entry.name.endswith('.render.json'): # case of a render checkpoint
+                checkpoints.append(entry.path)        # checkpoint is appended
+            elif re.search(r'_seg\d{3}\.mp4$', entry.name):  # case of a segment
+                segments.append(entry.path)           # segment is appended
+    bases = [fname[:-len('.render.json')] for fname in checkpoints]  # movies with a checkpoint
+    orphans = [f for f in segments if f.rsplit('_seg', 1)[0] not in bases]  # segments of no checkpoint
+    return sorted(partials + orphans), sorted(checkpoints)  # leftovers are returned
+
+
+
+
+
+def proxy_size(width, height, scale):
+    """ Returns the frame size reduced by scale, rounded to even values as required by yuv420p.
+    """
+    w = max(2, int(width/scale)//2*2)                 # proxy width, even value
+    h = max(2, int(height/scale)//2*2)                # proxy height, even value
+    return w, h                                       # proxy size is returned
+
+
+
+
+
+def font_option():
+    """ Returns the fontfile option of the ffmpeg drawtext filter; Empty when font_file is missing, so ffmpeg uses
+        its default font (fontconfig).
+    """
+    return f"fontfile={font_file}:" if font_file else ''  # drawtext font option
+
+
+
+
+
+def drawtext_filter(text, height, scale=1):
+    """ Returns the ffmpeg drawtext filter to overlay text on the bottom left of the video.
+        Font size and position are reduced by scale, for proxy renders.
+    """
+    fcol = 'white'                                    # font color
+    fsize = str(max(12, round(48/scale)))             # font size
+    bcol = 'black@0.5'                                # box color with % of transparency
+    pad = str(round(int(fsize)/5))                    # 20% of the font size
+    pos_x = str(round(70/scale))                      # reference from the left
+    pos_y = str(height - round(70/scale))             # reference from the bottom
+    return (f"drawtext={font_option()}text={text}:fontcolor={fcol}:fontsize={fsize}:box=1:boxcolor={bcol}:boxborderw={pad}:x={pos_x}:y={pos_y}")
+
+
+
+
+
+def thumb_gray(job):
+    """ Returns a picture as a grayscale float32 thumbnail of the wanted (width, height), decoded via the DCT
+        scaling (JPEG) at the smallest scale still larger than the thumbnail.
+    """
+    path, size = job                                  # picture path and thumbnail (width, height)
+    with Image.open(open_frame(path)) as im:          # picture is opened (header only)
+        im.draft('L', size)                           # DCT scaled decoding, luminance only
+        im = im.convert('L').resize(size, Image.BILINEAR)  # thumbnail
+        return np.asarray(im, dtype=np.float32)       # thumbnail as array
+
+
+
+
+
+def phase_shifts(thumbs):
+    """ Returns the (dx, dy) shifts (thumbnail pixels) of each thumbnail versus the previous one, via FFT phase
+        correlation; thumbs is a (frames, height, width) array, all the pairs are computed at once.
+        The correlation peak is refined to sub-pixel by a parabolic fit on its neighbours.
+    """
+    n, h, w = thumbs.shape                            # frames, thumbnail height and width
+    window = np.outer(np.hanning(h), np.hanning(w)).astype(np.float32)  # window suppressing the border effects
+    spectra = np.fft.rfft2((thumbs - thumbs.mean(axis=(1, 2), keepdims=True)) * window)  # spectra of all the frames
+    cross = spectra[1:] * np.conj(spectra[:-1])       # cross power spectra of the consecutive frames
+    cross /= np.maximum(np.abs(cross), 1e-9)          # normalized (phase only)
+    corr = np.fft.irfft2(cross, s=(h, w))             # correlation surfaces, peak at the shift
+    peaks = corr.reshape(n - 1, -1).argmax(axis=1)    # peak position of each surface
+    py, px = np.unravel_index(peaks, (h, w))          # peak row and column
+    rows = np.arange(n - 1)                           # surfaces index
+
+    def refine(c_m, c_0, c_p):                        # parabolic sub-pixel offset of the peak
+        den = c_m - 2 * c_0 + c_p                     # parabola curvature
+        return np.where(np.abs(den) > 1e-9, 0.5 * (c_m - c_p) / np.where(den == 0, 1, den), 0)
+
+    dx = px + refine(corr[rows, py, (px - 1) % w], corr[rows, py, px], corr[rows, py, (px + 1) % w])
+    dy = py + refine(corr[rows, (py - 1) % h, px], corr[rows, py, px], corr[rows, (py + 1) % h, px])
+    dx = np.where(dx > w / 2, dx - w, dx)             # shifts larger than half thumbnail are negative shifts
+    dy = np.where(dy > h / 2, dy - h, dy)             # shifts larger than half thumbnail are negative shifts
+    return np.stack([dx, dy], axis=1)                 # (frames-1, 2) array of shifts
+
+
+
+
+
+def frames_shifts(frames, thumb_w=256, workers=None, block=256):
+    """ Returns the (dx, dy) shift of each frame versus the previous one (zero for the first frame), as fraction
+        of the frame width and height. Thumbnails (thumb_w wide) are decoded in a pool of processes, and the
+        phase correlation is computed over blocks of frames (limited memory).
+    """
+    with Image.open(open_frame(frames[0])) as im:     # first picture is opened (header only)
+        thumb_h = max(16, round(thumb_w * im.height / im.width))  # thumbnail height, same aspect ratio
+    size = (thumb_w, thumb_h)                         # thumbnail size
+    workers = workers if workers else os.cpu_count()  # one decoding process per cpu core, when not defined
+    shifts = [np.zeros((1, 2))]                       # first frame has no shift
+    with Pool(workers) as pool:                       # pool of decoding processes
+        thumbs = pool.imap(thumb_gray, [(frame, size) for frame in frames], chunksize=8)  # thumbnails, in order
+        prev = None                                   # last thumbnail of the previous block
+        while True:                                   # loop over the blocks of frames
+            stack = [t for _, t in zip(range(block), thumbs)]  # next block of thumbnails
+            if len(stack) == 0:                       # case of no more thumbnails
+                break                                 # while loop is interrupted
+            stack = ([prev] if prev is not None else []) + stack  # previous thumbnail links the blocks
+            if len(stack) > 1:                        # case of at least a pair of frames
+                shifts.append(phase_shifts(np.stack(stack)))  # shifts of the block
+            prev = stack[-1]                          # last thumbnail, for the next block
+    return np.concatenate(shifts) / np.array(size)    # shifts as fraction of the frame size
+
+
+
+
+
+def moving_average(values, window):
+    """ Returns the centered moving average of values (along the first axis) over window frames (odd, at most
+        the values quantity), with the curve ends padded with the first and last values.
+    """
+    values = np.asarray(values, dtype=np.float64)     # values as float array
+    window = max(1, min(int(window), len(values)))    # window can't be larger than the values quantity
+    window -= 1 - window % 2                          # window is forced to an odd value (centered average)
+    pad = window // 2                                 # values padded at each curve end
+    padded = np.pad(values, [(pad, pad)] + [(0, 0)] * (values.ndim - 1), mode='edge')  # curve ends padded
+    kernel = np.ones(window) / window                 # averaging kernel
+    return np.apply_along_axis(lambda v: np.convolve(v, kernel, mode='valid'), 0, padded)  # same length as values
+
+
+
+
+
+def stabilize_boxes(shifts, window=30, max_crop=0.1):
+    """ Returns the crop box (left, top, right, bottom, as fractions of the frame) of each frame: the camera
+        trajectory (cumulated shifts) is smoothed over window frames, and each frame is offset by its difference
+        from the smoothed trajectory. The crop margin covers the largest offset, limited to max_crop per side.
+        Returns the boxes and the crop margin.
+    """
+    trajectory = np.cumsum(shifts, axis=0)            # camera position of each frame
+    offsets = moving_average(trajectory, window) - trajectory  # correction of each frame
+    margin = min(float(np.abs(offsets).max()) if len(offsets) else 0, max_crop)  # crop margin per side
+    offsets = np.clip(offsets, -margin, margin)       # offsets within the margin
+    boxes = [(margin - ox, margin - oy, 1 - margin - ox, 1 - margin - oy) for ox, oy in offsets]
+    return boxes, margin                              # crop boxes and margin are returned
+
+
+
+
+
+def thumb_luma(path):
+    """ Returns the mean luminance of a picture, decoded at 1/8 size via the DCT scaling (JPEG).
+    """
+    with Image.open(open_frame(path)) as im:          # picture is opened (header only)
+        im.draft('L', (im.width//8, im.height//8))    # DCT scaled decoding, luminance only
+        return ImageStat.Stat(im.convert('L')).mean[0]  # mean luminance is returned
+
+
+
+
+
+def frames_records(frames):
+    """ Returns the manifest record of each frame (empty dict when missing).
+    """
+    manifests, roots = {}, {}                         # manifest records per manifest folder, and manifest folder per folder
+    records = []                                      # empty list to store the records
+    for frame in frames:                              # iteration over the frames
+        folder = os.path.dirname(frame)               # frame folder
+        if folder not in roots:                       # case the folder is new
+            roots[folder] = manifest_root(folder)     # folder holding the manifest (parent, for shard subfolders)
+        root = roots[folder]                          # manifest folder of the frame
+        if root not in manifests:                     # case the manifest is not read yet
+            manifests[root] = read_manifest(root)     # manifest is read
+        records.append(manifests[root].get(os.path.relpath(frame, root), {}))  # capture record of the frame
+    return records                                    # list of records is returned
+
+
+
+
+
+def overlay_texts(frames):
+    """ Returns the overlay text of each frame: capture time, lux and temperature (sensor, or cpu) from the
+        manifest; Frames without a record get the file modification time only.
+    """
+    texts = []                                        # empty list to store the texts
+    for frame, record in zip(frames, frames_records(frames)):  # iteration over the frames and their records
+        t = record.get('t') or frame_stat(frame)[1] / 1e9  # capture time (epoch)
+        parts = [strftime("%d %b %Y  %H:%M:%S", localtime(t))]  # capture time as text
+        if record.get('lux') is not None:             # case of lux value
+            parts.append(f"{record['lux']:.0f} lux")  # lux as text
+        temp = record.get('sensor_t', record.get('cpu_t'))  # sensor temperature, or cpu temperature
+        if temp is not None:                          # case of temperature value
+            parts.append(f"{temp:.1f} C")             # temperature as text
+        texts.append('   '.join(parts))               # overlay text of the frame
+    return texts                                      # list of texts is returned
+
+
+
+
+
+def overlay_filter(height, scale=1):
+    """ Returns the ffmpeg drawtext filter printing the per-frame 'overlay' metadata on the top left of the video.
+        Font size and position are reduced by scale, for proxy renders.
+    """
+    fsize = str(max(10, round(32/scale)))             # font size
+    pad = str(round(int(fsize)/5))                    # 20% of the font size
+    pos = str(round(40/scale))                        # reference from the left and from the top
+    return (f"drawtext={font_option()}text=%{{metadata\\:overlay}}:fontcolor=white:fontsize={fsize}"
+            f":box=1:boxcolor=black@0.5:boxborderw={pad}:x={pos}:y={pos}")
+
+
+
+
+
+def draw_overlay(im, text):
+    """ Draws text on the top left of the (decoded) picture, as overlay_filter does, for the piped renders.
+    """
+    fsize = max(10, round(32 * im.height / 1080))     # font size, relative to the picture height
+    try:                                              # tentative approach
+        font = ImageFont.truetype(font_file, fsize) if font_file else ImageFont.load_default()  # overlay font, as for ffmpeg
+    except OSError:                                   # case the font can't be read
+        font = ImageFont.load_default()               # PIL default font
+    pos, pad = round(40 * im.height / 1080), round(fsize / 5)  # position and box border
+    draw = ImageDraw.Draw(im, 'RGBA')                 # drawing context, with transparency
+    box = draw.textbbox((pos, pos), text, font=font)  # text box
+    draw.rectangle((box[0]-pad, box[1]-pad, box[2]+pad, box[3]+pad), fill=(0, 0, 0, 128))  # text background
+    draw.text((pos, pos), text, font=font, fill=(255, 255, 255))  # text
+
+
+
+
+
+def dark_frames(frames, lux_min=None, luma_min=None):
+    """ Returns the set of frames captured below lux_min or below luma_min (manifest values, frames aren't opened).
+        Frames without capture values are never considered dark.
+    """
+    dark = set()                                      # empty set to store the dark frames
+    for frame, record in zip(frames, frames_records(frames)):  # iteration over the frames and their records
+        lux, luma = record.get('lux'), record.get('luma')  # capture values, None if missing
+        if lux_min is not None and lux is not None and lux < lux_min:  # case the scene was too dark
+            dark.add(frame)                           # frame is dark
+        elif luma_min is not None and luma is not None and luma < luma_min:  # case the picture is too dark
+            dark.add(frame)                           # frame is dark
+    return dark                                       # set of dark frames is returned
+
+
+
+
+
+def trim_cuts(frames, all_frames, dark):
+    """ Returns the set of indexes of frames (rendered subset of all_frames) preceded by dropped dark frames,
+        where a crossfade can be placed.
+    """
+    dark_before, count = [], 0                        # dark frames quantity before each of all_frames
+    for frame in all_frames:                          # iteration over all the frames
+        dark_before.append(count)                     # dark frames so far
+        count += frame in dark                        # dark frames counter
+    index = {frame: i for i, frame in enumerate(all_frames)}  # position of each frame in all_frames
+    return {i for i in range(1, len(frames))
+            if dark_before[index[frames[i]]] > dark_before[index[frames[i-1]]]}  # cuts after dropped frames
+
+
+
+
+
+def fit_trimmed(frames, all_frames, dark, movie_time_s, fps=24, max_fps=30, fade=0):
+    """ Returns the frames, the framerate, the decimation flag and the cuts (see fit_to_time and trim_cuts), to
+        render the trimmed frames (all_frames without the dark ones) to a movie of exactly movie_time_s, with
+        fade crossfade frames at each cut taken from the frames budget.
+        Decimation can merge the cuts, so the fit is repeated (up to three times) with the cuts of the fitted frames.
+    """
+    cuts = trim_cuts(frames, all_frames, dark) if fade > 0 and dark else set()  # cuts of the trimmed frames
+    for attempt in range(3):                          # iteration until the cuts don't change
+        fit = fit_to_time(frames, movie_time_s, fps, max_fps, fade * len(cuts))  # frames, framerate and decimation
+        fit_cuts = trim_cuts(fit[0], all_frames, dark) if cuts else set()  # cuts of the fitted frames
+        if len(fit_cuts) == len(cuts):                # case the crossfades are as expected
+            break                                     # for loop is interrupted
+        cuts = fit_cuts                               # cuts of the fitted frames, for the next fit
+    return fit + (fit_cuts,)                          # frames, framerate, decimation flag and cuts
+
+
+
+
+
+def frames_luma(frames, workers=None):
+    """ Returns the mean luminance of each frame, and the source of these values.
+        The capture-time lores stats (manifest) are used when available for all the frames, otherwise
+        the luminance is measured on DCT scaled thumbnails, in a pool of processes.
+    """
+    luma = [record.get('luma') for record in frames_records(frames)]  # luminance at capture time, None if missing
+    
+    if None not in luma:                              # case all the frames have the capture-time luminance
+        return np.array(luma, dtype=np.float64), 'capture stats'
+    
+    workers = workers if workers else os.cpu_count()  # one process per cpu core, when not defined
+    with Pool(workers) as pool:                       # pool of decoding processes
+        luma = pool.map(thumb_luma, frames, chunksize=8)  # luminance of the DCT scaled thumbnails
+    return np.array(luma, dtype=np.float64), 'thumbnails'
+
+
+
+
+
+def deflicker_gains(luma, window=15, max_gain=2.0):
+    """ Returns the per-frame gains flattening the luminance flicker.
+        The luminance curve is smoothed by a centered moving average over window frames (edges padded),
+        and each gain is the ratio between the smoothed and the frame luminance (limited to max_gain).
+    """
+    luma = np.maximum(np.asarray(luma, dtype=np.float64), 1.0)  # luminance, prevents zero division
+    smooth = moving_average(luma, window)             # smoothed luminance, same length as luma
+    return np.clip(smooth/luma, 1/max_gain, max_gain) # per-frame gains
+
+
+
+
+
+def decode_frame(job):
+    """ Decodes a picture to raw RGB24 bytes, at the requested size, applying the crop box (stabilization), the
+        gain and the overlay text.
+        For JPEG pictures the decoder is set via draft to the smallest DCT scale (1/2, 1/4, 1/8) still
+        larger than size, therefore the full resolution picture is never decoded.
+    """
+    path, size, gain, text, box = job                 # picture path, wanted (width, height), gain, overlay and crop
+    with Image.open(open_frame(path)) as im:          # picture is opened (header only)
+        draft = size if box is None else (round(size[0] / (box[2] - box[0])), round(size[1] / (box[3] - box[1])))
+        im.draft('RGB', draft)                        # DCT scaled decoding (no effect on non-JPEG pictures)
+        im = im.convert('RGB')                        # picture is decoded
+        if box is not None:                           # case of crop box (fractions of the picture)
+            w, h = im.size                            # decoded picture size
+            im = im.resize(size, Image.BILINEAR, box=(box[0]*w, box[1]*h, box[2]*w, box[3]*h))  # crop and resize
+        elif im.size != size:                           # case the DCT scaled size differs from the wanted size
+            im = im.resize(size, Image.BILINEAR)      # picture is resized
+        if gain != 1:                                 # case of a gain (deflicker)
+            lut = [min(255, int(v * gain + 0.5)) for v in range(256)]  # lookup table for the gain
+            im = im.point(lut * 3)                    # gain applied to the three channels
+        if text:                                      # case of overlay text
+            draw_overlay(im, text)                    # text is drawn on the picture
+        return im.tobytes()                           # raw RGB24 bytes are returned
+
+
+
+
+
+def pipe_render(frames, out_file, size, fps, v_f='', loglevel='error', workers=None, gains=None,
+                progress_cb=print_progress, period=2, overlays=None, cuts=(), fade=0, boxes=None):
+    """ Decodes the frames in a pool of processes, and pipes them to ffmpeg as raw video.
+        When gains are provided, each frame gets its own gain (deflicker).
+        When overlays are provided, each frame gets its own text (drawn while decoding).
+        When fade is set, fade blended frames are inserted before each of the cuts (frames indexes).
+        When boxes are provided, each frame is cropped at its box (stabilization) and resized to size.
+        progress_cb is called with the progress dict at most every period secs (frames piped to ffmpeg).
+        Frames order is preserved. Returns the ffmpeg return code; When a frame can't be decoded ffmpeg is stopped,
+        the partial out_file is removed and -1 is returned.
+    """
+    w, h = size                                       # output frame size
+    render_command = ['ffmpeg', '-nostats', '-loglevel', loglevel,
+                      '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{w}x{h}', '-framerate', str(fps), '-i', '-']
+    if v_f != '':                                     # case of a video filter (i.e. text overlay)
+        render_command += ['-vf', v_f]                # video filter is added to the command
+    render_command += ['-pix_fmt', 'yuv420p', out_file, '-y']
+
+    workers = workers if workers else os.cpu_count()  # one decoding process per cpu core, when not defined
+    gains = gains if gains is not None else [1] * len(frames)  # unit gain when not defined
+    overlays = overlays if overlays is not None else [''] * len(frames)  # no overlay when not defined
+    boxes = boxes if boxes is not None else [None] * len(frames)  # no crop when not defined
+    jobs = [(frame, size, float(gain), text, box) for frame, gain, text, box in zip(frames, gains, overlays, boxes)]
+    cuts = set(cuts) if fade > 0 else set()           # cuts as set, for the lookup at each frame
+    total = len(jobs) + fade * len([i for i in cuts if 0 < i < len(jobs)])  # frames of the movie, crossfades included
+    piped, written = 0, 0                             # frames piped to ffmpeg, and movie frames (crossfades included)
+
+    start_time = last_cb = time()                     # time references for the render and the progress feedback
+    proc = Popen(render_command, stdin=PIPE)          # ffmpeg reads the raw frames from its stdin
+    prev_raw = None                                   # previous raw frame, for the crossfades
+    try:                                              # tentative approach
+        with Pool(workers) as pool:                   # pool of decoding processes
+            for i, raw in enumerate(pool.imap(decode_frame, jobs, chunksize=4)):  # decoded frames, in the original order
+                if i in cuts and prev_raw is not None:  # case of a cut to be crossfaded
+                    im_a = Image.frombytes('RGB', size, prev_raw)  # last frame before the cut
+                    im_b = Image.frombytes('RGB', size, raw)  # first frame after the cut
+                    for k in range(1, fade + 1):      # iteration over the crossfade frames
+                        proc.stdin.write(Image.blend(im_a, im_b, k / (fade + 1)).tobytes())  # blended frame is piped
+                    written += fade                   # crossfade frames of the movie
+                proc.stdin.write(raw)                 # raw frame is piped to ffmpeg
+                piped, written = i + 1, written + 1   # frames piped to ffmpeg, and movie frames
+                prev_raw = raw                        # raw frame is kept for the next cut
+                if progress_cb and (time() - last_cb >= period or i + 1 == len(jobs)):  # case it is time for a feedback
+                    progress_cb(progress_info(written, total, start_time))  # progress feedback
+                    last_cb = time()                  # time of the last feedback
+    except BrokenPipeError:                           # case ffmpeg has quitted (error is returned by wait)
+        pass                                          # do nothing
+    except Exception as e:                            # case a frame can't be decoded (i.e. corrupt picture)
+        print(f"\nRender stopped, {os.path.basename(frames[piped])} can't be decoded ({e})")
+        proc.kill()                                   # ffmpeg is stopped, not to close a shorter movie
+        proc.wait()                                   # ffmpeg process is collected
+        if os.path.exists(out_file):                  # case ffmpeg has written part of the movie
+            os.remove(out_file)                       # partial movie is removed
+        return -1                                     # error return code
+    finally:                                          # in any case
+        try:                                          # tentative approach
+            proc.stdin.close()                        # end of stream for ffmpeg
+        except BrokenPipeError:                       # case ffmpeg has already quitted
+            pass                                      # do nothing
+    if progress_cb is print_progress:                 # case the progress is printed to the terminal
+        print()                                       # new line after the progress line
+    return proc.wait()                                # ffmpeg return code
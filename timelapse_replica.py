@@ -0,0 +1,313 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+#############################################################################################################
+#  Timelapse application, incremental replication of the pictures and movies to a secondary storage
+#
+#  Pictures folders are mirrored to the target folder (i.e. a USB disk, or a NAS share mounted on the Pi), at
+#  target/<folder name>/..., in a background thread at the lowest CPU priority and with a bandwidth cap.
+#  Files are copied in batches: each copy gets the CRC32 of the source while reading, is read back from the
+#  target and compared, and is committed there (timelapse_commit, always fsync-ed); Once the batch is on the
+#  target, its files are appended to the journal of the folder (.replicated.jsonl: file, size, mtime, crc).
+#  The journal is the 'replicated' marker: an interrupted replication resumes from it (files already there,
+#  with the same size and mtime, are skipped), and the cleanup removes only the local files it lists.
+#  A missing target (i.e. not mounted) is never made: replication waits for it.
+#
+#  Usage: python timelapse_replica.py FOLDER TARGET [--mbps 0]
+#############################################################################################################
+"""
+
+
+from threading import Thread, Event, get_native_id
+from queue import Queue
+from time import time, sleep
+from timelapse_commit import atomic_file, fsync_folder, make_folder
+from timelapse_storage import picture_types, movie_types
+import os.path, json, glob, zlib, argparse
+
+
+journal_fname = '.replicated.jsonl'                   # replication journal (marker), in the pictures folder
+replica_types = picture_types + movie_types + ('jsonl', 'idx')  # file types replicated (manifest and archive indexes too)
+chunk_size = 262144                                   # bytes per read/write (and bandwidth check)
+
+
+
+
+def journal_file(folder):
+    """ Returns the path of the replication journal of folder.
+    """
+    return os.path.join(folder, journal_fname)        # journal path is returned
+
+
+
+
+
+def read_journal(folder):
+    """ Returns the replicated files of folder (dict: path relative to folder -> record); Later records of the
+        same file replace the earlier ones, truncated lines are skipped.
+    """
+    records = {}                                      # empty dict to store the records
+    try:                                              # tentative approach
+        with open(journal_file(folder), 'r') as f:    # journal is opened in reading mode
+            for line in f:                            # iteration over the journal lines
+                try:                                  # tentative approach
+                    record = json.loads(line)         # line is parsed to a dict
+                    records[record['file']] = record  # record of the file
+                except (ValueError, KeyError, TypeError):  # case of truncated or invalid line
+                    continue                          # line is skipped
+    except OSError:                                   # case of missing journal
+        pass                                          # empty dict is returned
+    return records                                    # records are returned
+
+
+
+
+
+def append_journal(folder, records):
+    """ Appends the records (list of dicts) to the journal of folder, and writes them to the storage.
+        A line truncated by a power outage is closed first, so it doesn't absorb the first new record.
+    """
+    with open(journal_file(folder), 'a+') as f:       # journal is opened in append mode
+        lead = ''                                     # no separator by default
+        if f.tell() > 0:                              # case of journal with previous records
+            f.seek(f.tell() - 1)                      # last character of the journal
+            if f.read(1) != '\n':                     # case of line truncated by a power outage
+                lead = '\n'                           # the new records start on a new line
+        f.write(lead + ''.join([json.dumps(r) + '\n' for r in records]))  # one json line per file
+        f.flush()                                     # python buffer is flushed
+        os.fsync(f.fileno())                          # records are written to the storage
+
+
+
+
+
+def replicated_paths(parent_folder):
+    """ Returns the set of (path, size) of the files replicated, for the folders in parent_folder (and itself).
+        The cleanup removes only these files, when replication is used.
+    """
+    paths = set()                                     # empty set to store the replicated files
+    for journal in glob.glob(os.path.join(parent_folder, journal_fname)) + \
+                   glob.glob(os.path.join(parent_folder, '*', journal_fname)):  # iteration over the journals
+        folder = os.path.dirname(journal)             # folder of the journal
+        for name, record in read_journal(folder).items():  # iteration over the replicated files
+            paths.add((os.path.join(folder, name), record['size']))  # replicated file and its size
+    return paths                                      # replicated files are returned
+
+
+
+
+
+def scan_files(folder):
+    """ Returns the files to replicate in folder and its subfolders (dict: path relative to folder -> stat);
+        Hidden files (temporary, cache, journal) and partial movies are left out.
+    """
+    files, stack = {}, [folder]                       # files found, and folders to be scanned
+    while stack:                                      # loop until all the folders are scanned
+        directory = stack.pop()                       # next folder
+        try:                                          # tentative approach
+            with os.scandir(directory) as entries:    # single pass over the folder
+                for entry in entries:                 # iteration over the folder entries
+                    if entry.name.startswith('.') or '.partial.' in entry.name:  # case of hidden or partial file
+                        continue                      # entry is skipped
+                    if entry.is_dir(follow_symlinks=False):  # case of sub-folder (i.e. shard)
+                        stack.append(entry.path)      # sub-folder will be scanned
+                    elif entry.name.lower().endswith(replica_types) and entry.is_file(follow_symlinks=False):
+                        files[os.path.relpath(entry.path, folder)] = entry.stat(follow_symlinks=False)
+        except OSError:                               # case the folder can't be read (i.e. removed meanwhile)
+            continue                                  # folder is skipped
+    return files                                      # files to replicate are returned
+
+
+
+
+
+class Throttle:
+    """ Bandwidth cap: spend() sleeps when the bytes moved so far exceed bytes_s since the start (zero: no cap);
+        Idle time isn't saved up for more than one sec of burst.
+    """
+
+    def __init__(self, bytes_s=0):
+        self.bytes_s = bytes_s                        # bandwidth cap, in bytes per sec
+        self.start = time()                           # time reference
+        self.moved = 0                                # bytes moved since the start
+        self.slept = 0.0                              # secs slept by the cap
+
+
+    def spend(self, size):
+        """ Accounts size bytes, sleeping as long as needed to keep the cap.
+        """
+        self.moved += size                            # bytes moved
+        if self.bytes_s > 0:                          # case of bandwidth cap
+            ahead = self.moved / self.bytes_s - (time() - self.start)  # secs ahead of the cap
+            if ahead < -1:                            # case of idle time (no bytes moved for a while)
+                self.start += -ahead - 1              # burst limited to one sec at the cap
+            elif ahead > 0:                           # case of bytes moved too fast
+                sleep(ahead)                          # waits to keep the cap
+                self.slept += ahead                   # secs slept
+
+
+
+
+
+def copy_file(src, dst, throttle):
+    """ Copies src to dst (atomic commit, always fsync-ed), returning the CRC32 of the source; The copy is read
+        back and compared, and a ValueError is raised when it differs.
+    """
+    crc = 0                                           # CRC32 of the source
+    with open(src, 'rb') as f_in, atomic_file(dst, 'wb', sync_folder=False, durable=True) as f_out:  # source and copy
+        while True:                                   # loop until the end of the source
+            data = f_in.read(chunk_size)              # chunk of the source
+            if not data:                              # case of end of file
+                break                                 # copy is done
+            crc = zlib.crc32(data, crc)               # CRC32 of the source so far
+            f_out.write(data)                         # chunk is written
+            throttle.spend(len(data))                 # bandwidth cap
+    check = 0                                         # CRC32 of the copy
+    with open(dst, 'rb') as f:                        # copy is opened in reading mode
+        for data in iter(lambda: f.read(chunk_size), b''):  # iteration over the chunks of the copy
+            check = zlib.crc32(data, check)           # CRC32 of the copy so far
+    if check != crc:                                  # case the copy differs from the source
+        raise ValueError(f"checksum mismatch of {dst}")
+    st = os.stat(src)                                 # source file status
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))  # modification time kept
+    return crc                                        # CRC32 is returned
+
+
+
+
+
+def replicate_folder(folder, target, throttle=None, batch=50, gate=None):
+    """ Replicates the new or changed files of folder to target/<folder name>, in batches; The journal of folder
+        gets the files of each batch once they are on the target. gate is called in between files, and returns
+        False to stop (replication resumes from the journal). Returns the report dict.
+    """
+    start = time()                                    # time reference for the replication
+    throttle = throttle if throttle is not None else Throttle()  # no bandwidth cap, when none
+    report = {'files': 0, 'bytes': 0, 'failed': 0, 'seconds': 0}
+    if not os.path.isdir(target):                     # case the target is missing (i.e. not mounted)
+        report['failed'] = -1                         # target missing flag
+        return report                                 # nothing is replicated
+    dest = os.path.join(target, os.path.basename(folder.rstrip(os.sep)))  # replica folder
+    journal = read_journal(folder)                    # files already replicated
+    todo = []                                         # files to be replicated
+    for name, st in sorted(scan_files(folder).items()):  # iteration over the files of folder
+        done = journal.get(name)                      # journal record of the file, if any
+        if done is None or done['size'] != st.st_size or done['mtime_ns'] != st.st_mtime_ns:  # case of new or changed file
+            todo.append((name, st))                   # file to be replicated
+
+    for i in range(0, len(todo), batch):              # iteration over the batches
+        records, folders = [], set()                  # journal records and replica folders of the batch
+        for name, st in todo[i:i + batch]:            # iteration over the files of the batch
+            if gate is not None and not gate():       # case replication has to stop
+                break                                 # batch is closed
+            dst = os.path.join(dest, name)            # replica file
+            try:                                      # tentative approach
+                make_folder(os.path.dirname(dst))     # replica folder is made, if missing
+                crc = copy_file(os.path.join(folder, name), dst, throttle)  # file is copied and checked
+            except (OSError, ValueError) as e:        # case the file can't be replicated
+                print(f"\nReplication: {name} not replicated ({e})")
+                report['failed'] += 1                 # failed files counter
+                continue                              # next file
+            records.append({'file': name, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'crc': crc, 't': round(time(), 2)})
+            folders.add(os.path.dirname(dst))         # replica folder to be fsync-ed
+            report['bytes'] += st.st_size             # bytes counter
+        for d in folders:                             # iteration over the replica folders of the batch
+            fsync_folder(d, force=True)               # replicas names are written to the target storage
+        if records:                                   # case of replicated files
+            append_journal(folder, records)           # files are marked as replicated
+            report['files'] += len(records)           # replicated files counter
+        if gate is not None and not gate():           # case replication has to stop
+            break                                     # replication continues next time
+    report['seconds'] = time() - start                # replication time
+    return report                                     # report is returned
+
+
+
+
+
+def print_replica_report(report, label='Replication: '):
+    """ Prints the replication report to the terminal.
+    """
+    rate = report['bytes'] / 1048576 / report['seconds'] if report['seconds'] else 0  # MB/s
+    print(f"{label}{report['files']} files, {report['bytes']/1048576:.1f} MB in {report['seconds']:.0f} secs "
+          f"({rate:.1f} MB/s), {report['failed']} failed")
+
+
+
+
+
+class Replicator:
+    """ Replicates the queued folders in a background thread, at the lowest CPU priority and with a bandwidth cap.
+    """
+
+    def __init__(self, target, mbps=0, batch=50):
+        self.target = target                          # target folder (mounted secondary storage)
+        self.batch = batch                            # files per batch
+        self.throttle = Throttle(mbps * 1048576)      # bandwidth cap (MB/s, zero for no cap)
+        self.jobs = Queue()                           # queued folders
+        self.queued = set()                           # folders queued and not replicated yet
+        self.stopping = False                         # flag to stop at the next file
+        self.warned = False                           # flag for the missing target feedback
+        self.done = Event()                           # set when the thread has ended
+        self.thread = Thread(target=self.run, daemon=True)  # replication thread
+        self.thread.start()                           # replication thread is started
+
+
+    def add(self, folder):
+        """ Queues the folder to be replicated (not queued twice), not blocking.
+        """
+        if folder not in self.queued:                 # case the folder isn't queued yet
+            self.queued.add(folder)                   # folder is queued
+            self.jobs.put(folder)                     # folder is queued
+
+
+    def run(self):
+        """ Replication thread: replicates the queued folders, one after the other.
+        """
+        try:                                          # tentative approach
+            os.setpriority(os.PRIO_PROCESS, get_native_id(), 19)  # lowest CPU priority (per thread, on Linux)
+        except (AttributeError, OSError):             # case the priority can't be set
+            pass                                      # do nothing
+        while True:                                   # loop until stopped
+            folder = self.jobs.get()                  # next queued folder
+            if folder is None:                        # case of stop request
+                self.done.set()                       # thread has ended
+                return                                # thread ends
+            self.queued.discard(folder)               # changes from now on need a new job
+            if self.stopping:                         # case replication has to stop
+                continue                              # folder is left to the next start
+            report = replicate_folder(folder, self.target, self.throttle, self.batch, gate=lambda: not self.stopping)
+            if report['failed'] == -1 and not self.warned:  # case the target is missing, first time
+                print(f"\nReplication target {self.target} not found, replication waits for it")
+                self.warned = True                    # feedback is printed once
+            elif report['files'] or report['failed'] > 0:  # case of replicated or failed files
+                print_replica_report(report, label=f"\nReplication of {os.path.basename(folder)}: ")
+
+
+    def close(self, wait=True):
+        """ Stops the replication thread; When wait, the queued folders are replicated first, otherwise the
+            replication stops at the next file (it resumes from the journals at the next start).
+        """
+        if not self.thread.is_alive():                # case the replication thread has already ended
+            return                                    # nothing to do
+        self.stopping = not wait                      # stop at the next file, when not waiting
+        self.jobs.put(None)                           # stop request, after the queued folders
+        self.done.wait()                              # waits for the replication thread to end
+
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replicates a pictures folder to a target folder (incremental)')
+    parser.add_argument('folder', help='pictures folder')
+    parser.add_argument('target', help='target folder (i.e. a mounted USB disk or NAS share)')
+    parser.add_argument('--mbps', type=float, default=0, help='bandwidth cap in MB/s (default 0, no cap)')
+    args = parser.parse_args()
+
+    report = replicate_folder(args.folder.rstrip(os.sep), args.target, Throttle(args.mbps * 1048576))
+    if report['failed'] == -1:                        # case the target is missing
+        print(f"Target {args.target} not found")
+    else:                                             # case the target exists
+        print_replica_report(report)
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+#############################################################################################################
+#  Timelapse application, RAM staged writes
+#
+#  Pictures are saved to a tmpfs staging folder (RAM, i.e. /dev/shm), so the timed shoot never waits for the
+#  SD card, USB or network storage; A background thread flushes them in batches to their final location:
+#  each file is committed (timelapse_commit: temporary name, fsync and rename), the folder fsync-ed once per batch.
+#  RAM use is bounded: when the staged bytes exceed the limit, the shoot waits for the flush (back pressure).
+#  A staged file is removed only once committed: files not written (i.e. full storage) stay staged and pending,
+#  retried every retry_s secs (or at the next flush request); Meanwhile the shoot doesn't wait for the flush.
+#  Staged file names carry their final path, so frames left in the staging folder by a crash (of the script,
+#  the RAM content is lost on a power outage) are flushed at the next start.
+#  Write latencies (staged save, and flush to the final storage) are kept for the percentiles report.
+#############################################################################################################
+"""
+
+
+from threading import Thread, Condition
+from time import time
+from urllib.parse import quote, unquote
+from timelapse_commit import atomic_file, fsync_folder
+import numpy as np
+import os
+
+
+stage_root = '/dev/shm/timelapse_stage'               # tmpfs staging folder
+
+
+
+
+def latency_report(label, samples_ms):
+    """ Returns a line with the p50, p95, p99 and max of the latencies samples_ms (empty string when none).
+    """
+    if len(samples_ms) == 0:                          # case of no samples
+        return ''                                     # empty string is returned
+    p50, p95, p99 = np.percentile(samples_ms, [50, 95, 99])  # latency percentiles
+    return (f"{label} latency (ms, {len(samples_ms)} files): p50 {p50:.1f}, p95 {p95:.1f}, p99 {p99:.1f}, "
+            f"max {max(samples_ms):.1f}")
+
+
+
+
+
+class StagedWriter:
+    """ Stages the pictures in RAM, and flushes them in batches to their final location (background thread).
+    """
+
+    def __init__(self, stage_dir=stage_root, max_mb=64, batch=10, flush_s=30, retry_s=60):
+        self.stage_dir = stage_dir                    # staging folder (tmpfs)
+        self.max_bytes = max_mb * 1048576             # max staged bytes (RAM use)
+        self.batch = max(1, batch)                    # files per flush batch
+        self.flush_s = flush_s                        # max secs a file stays staged
+        self.retry_s = retry_s                        # secs in between flush attempts, after a failed one
+        self.pending = []                             # (staged path, final path, bytes) to be flushed, in order
+        self.staged_bytes = 0                         # bytes staged, not flushed yet
+        self.stage_ms = []                            # staged write latencies (capture path)
+        self.flush_ms = []                            # flush latencies per file (final storage)
+        self.errors = 0                               # files lost (staged file missing)
+        self.failing = False                          # flag for the last flush attempt having failed files
+        self.rounds = 0                               # flush attempts (batches) done
+        self.cond = Condition()                       # lock and signal for the pending list
+        self.stopping = False                         # flag to stop the flush thread
+        os.makedirs(stage_dir, exist_ok=True)         # staging folder is made, if missing
+        self.recover()                                # frames staged before a crash are queued first
+        self.thread = Thread(target=self.flush_loop, daemon=True)  # flush thread
+        self.thread.start()                           # flush thread is started
+
+
+    def stage_path(self, final_path):
+        """ Returns the staging path of final_path (the final path is encoded in the file name).
+        """
+        return os.path.join(self.stage_dir, quote(os.path.abspath(final_path), safe=''))
+
+
+    def recover(self):
+        """ Queues the files left in the staging folder (i.e. after a crash of the script), in name order.
+        """
+        with os.scandir(self.stage_dir) as entries:   # single pass over the staging folder
+            staged = sorted([(e.name, e.path, e.stat().st_size) for e in entries if e.is_file()])
+        for name, path, size in staged:               # iteration over the staged files
+            self.pending.append((path, unquote(name), size))  # file is queued for the flush
+            self.staged_bytes += size                 # staged bytes counter
+        if staged:                                    # case of recovered files
+            print(f"Staged pictures recovered: {len(staged)}, flushed to their folders")
+
+
+    def commit(self, staged_path, final_path, stage_ms=None):
+        """ Queues the staged file for the flush to final_path; Waits when the staged bytes exceed the limit.
+            stage_ms is the latency of the staged write, kept for the report.
+        """
+        size = os.path.getsize(staged_path)           # staged file size
+        with self.cond:                               # pending list is locked
+            while self.staged_bytes + size > self.max_bytes and self.pending and not self.failing:  # case of RAM limit
+                self.cond.notify_all()                # flush is requested
+                self.cond.wait(timeout=1)             # waits for the flush (back pressure)
+            self.pending.append((staged_path, final_path, size))  # file is queued
+            self.staged_bytes += size                 # staged bytes counter
+            if stage_ms is not None:                  # case of staged write latency
+                self.stage_ms.append(stage_ms)        # latency is stored
+            if len(self.pending) >= self.batch and not self.failing:  # case a batch is ready (retries are timed)
+                self.cond.notify_all()                # flush is requested
+
+
+    def is_flushed(self, final_path):
+        """ Returns True when final_path is not waiting in the staging folder.
+        """
+        with self.cond:                               # pending list is locked
+            return all([final != final_path for _, final, _ in self.pending])
+
+
+    def locate(self, final_path):
+        """ Returns the current path of final_path: the staged file when not flushed yet, otherwise final_path.
+        """
+        with self.cond:                               # pending list is locked
+            for staged, final, _ in self.pending:     # iteration over the pending files
+                if final == final_path:               # case the file is still staged
+                    return staged                     # staged path is returned
+        return final_path                             # final path is returned
+
+
+    def flush_loop(self):
+        """ Flush thread: flushes a batch when ready, or when the oldest staged file waited flush_s; After a failed
+            attempt, the next one is made after retry_s (or at a flush request). At the closing, files not flushed
+            are left in the staging folder, flushed at the next start.
+        """
+        while True:                                   # loop until stopped
+            with self.cond:                           # pending list is locked
+                if (len(self.pending) < self.batch or self.failing) and not self.stopping:  # case no batch to flush now
+                    self.cond.wait(timeout=self.retry_s if self.failing else self.flush_s)  # waits for a batch, a request, or the timeout
+                batch = self.pending[:self.batch]     # files of the batch (they stay pending until flushed)
+                if not batch and self.stopping:       # case nothing left and stop requested
+                    return                            # thread ends
+            if batch and self.flush_batch(batch) > 0 and self.stopping:  # case of files not flushed at the closing
+                print(f"{len(self.pending)} pictures left in {self.stage_dir}, flushed at the next start")
+                return                                # thread ends
+
+
+    def flush_batch(self, batch):
+        """ Writes the batch files to their final location (atomic commit), fsync-ing each folder once (as per
+            the fsync policy), then removes them from the staging folder. Files not written (i.e. full storage)
+            stay staged and pending, for a later attempt; Returns the quantity of these files.
+        """
+        folders, done, failed, error = set(), [], 0, None  # folders, files done, files kept staged, last error
+        for item in batch:                            # iteration over the batch files
+            staged, final, size = item                # staged path, final path and bytes
+            start = time()                            # time reference for the flush latency
+            try:                                      # tentative approach
+                with open(staged, 'rb') as src, atomic_file(final, 'wb', sync_folder=False) as dst:  # staged and final files
+                    dst.write(src.read())             # picture is copied
+                folders.add(os.path.dirname(final))   # folder to be fsync-ed
+                self.flush_ms.append(1000 * (time() - start))  # flush latency
+                os.remove(staged)                     # staged file is removed, once committed (RAM is freed)
+            except OSError as e:                      # case the picture can't be flushed
+                if os.path.exists(staged):            # case the staged file is still there
+                    failed, error = failed + 1, e     # file stays staged and pending, for a later attempt
+                    continue                          # next file
+                print(f"\nStaged picture for {final} lost ({e})")
+                self.errors += 1                      # lost files counter
+            done.append(item)                         # file is no longer pending
+        if failed > 0:                                # case of files kept staged
+            print(f"\n{failed} staged pictures not flushed ({error}), kept staged for a retry in {self.retry_s} secs")
+        for folder in folders:                        # iteration over the folders of the batch
+            fsync_folder(folder)                      # renames are written to the storage (as per policy)
+        with self.cond:                               # pending list is locked
+            for item in done:                         # iteration over the files done
+                self.pending.remove(item)             # file is no longer pending
+            self.staged_bytes -= sum([size for _, _, size in done])  # staged bytes counter
+            self.failing = failed > 0                 # flag for a failed attempt
+            self.rounds += 1                          # flush attempts counter
+            self.cond.notify_all()                    # waiting commits and flushes are notified
+        return failed                                 # files kept staged are returned
+
+
+    def flush(self):
+        """ Flushes all the staged files, and waits until done (i.e. before a render, or a cleanup); Returns early
+            when an attempt made after the request fails (files kept staged, for a later attempt).
+        """
+        with self.cond:                               # pending list is locked
+            rounds = self.rounds                      # flush attempts done before the request
+            while self.pending and not (self.failing and self.rounds > rounds):  # while files are staged
+                self.cond.notify_all()                # flush is requested
+                self.cond.wait(timeout=1)             # waits for the flush
+
+
+    def close(self):
+        """ Flushes all the staged files, and stops the flush thread.
+        """
+        with self.cond:                               # pending list is locked
+            self.stopping = True                      # stop request
+            self.cond.notify_all()                    # flush thread is notified
+        self.thread.join()                            # waits for the flush thread to end
+
+
+    def report(self):
+        """ Returns the latency report lines (staged writes, and flushes to the final storage).
+        """
+        return [line for line in (latency_report('Staged write', self.stage_ms),
+                                  latency_report('Flush to storage', self.flush_ms)) if line]
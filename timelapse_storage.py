@@ -0,0 +1,323 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+#############################################################################################################
+#  Timelapse application, storage cleanup engine
+#
+#  A single scandir walk of the folder tree collects the files of the wanted types (name, size, mtime), the
+#  retention policies select those to be removed, and they are removed in process, one batch per folder
+#  (unlink relative to the folder descriptor), without forking a shell per file type.
+#  Retention policies: keep the files of the last N days, keep the movies, keep the pictures until their movie
+#  exists (a movie in the same folder made after the picture). Dry run lists and sizes, without removing.
+#  Files not removable by this user (i.e. made by root) are removed via a single 'sudo rm' per batch.
+#  When the files are replicated (timelapse_replica), pictures and movies are removed only once replicated.
+#
+#  Storage governor: while shooting, the real bytes per frame (moving average) and the free space (statvfs)
+#  give the frames left and the projected time to full; Crossing the free space watermarks triggers graded
+#  actions: lower JPEG quality, smaller resolution, prune the rendered pictures, and finally stop capturing.
+#
+#  Budget mode: the run has a bytes budget; The rolling average of the frame size is compared with the bytes
+#  per frame still available (budget left, and free space, over the planned frames left), and the JPEG quality
+#  is adapted in between frames: lowered when the frames are too large, raised back when there is room.
+#############################################################################################################
+"""
+
+
+from time import time
+import subprocess, os, math
+
+
+movie_types = ('mp4',)                                # movie file types (rendered outputs)
+picture_types = ('jpg', 'jpeg', 'png', 'bmp', 'gif', 'tar', 'webp', 'avif')  # picture file types (tar: day archives, webp and avif: compacted)
+
+
+
+
+def scan_tree(folder, f_types):
+    """ Walks folder and its sub-folders once (scandir), returning a dict: folder -> list of (name, size, mtime)
+        of the files ending by one of f_types.
+    """
+    f_types = tuple(f_types)                          # file types as tuple (str.endswith)
+    found = {}                                        # files per folder
+    stack = [folder]                                  # folders to be scanned
+    while stack:                                      # loop until all the folders are scanned
+        directory = stack.pop()                       # next folder
+        try:                                          # tentative approach
+            with os.scandir(directory) as entries:    # single pass over the folder
+                for entry in entries:                 # iteration over the folder entries
+                    if entry.is_dir(follow_symlinks=False):  # case of sub-folder
+                        stack.append(entry.path)      # sub-folder will be scanned
+                    elif entry.name.endswith(f_types) and entry.is_file(follow_symlinks=False):  # case of wanted file
+                        st = entry.stat(follow_symlinks=False)  # size and mtime
+                        found.setdefault(directory, []).append((entry.name, st.st_size, st.st_mtime))
+        except OSError:                               # case the folder can't be read (i.e. removed meanwhile)
+            continue                                  # folder is skipped
+    return found                                      # files per folder are returned
+
+
+
+
+
+def select_files(found, keep_days=0, keep_movies=False, keep_unrendered=False, now=None, replicated=None):
+    """ Returns the files to be removed (dict: folder -> list of (name, size)) as per the retention policies,
+        and the quantity of files kept.
+        keep_days: files modified within the last keep_days days are kept (zero keeps none).
+        keep_movies: movies are kept.
+        keep_unrendered: pictures are kept until a movie of their folder (parent, for shards) is more recent than them.
+        replicated: when set ((path, size) of the replicated files), pictures and movies not replicated are kept.
+        Other files (i.e. the pictures manifest) are kept as long as pictures of their folder, or of its
+        subfolders (shards), are kept.
+    """
+    now = now if now is not None else time()          # reference time for the retention
+    remove, kept = {}, 0                              # files to be removed, and files kept quantity
+    others_of = {}                                    # other files per folder, decided after all the folders
+    kept_dirs = set()                                 # folders with kept pictures
+    last_movies = {}                                  # time of the latest movie per folder
+    for directory, files in found.items():            # iteration over the folders
+        movies = [m for n, _, m in files if n.endswith(movie_types) and '.partial.' not in n]  # movies mtime
+        last_movies[directory] = max(movies) if movies else 0  # time of the latest movie of the folder
+    for directory, files in found.items():            # iteration over the folders
+        parent, name = os.path.split(directory)       # parent folder and folder name
+        last_movie = last_movies[directory] or (last_movies.get(parent, 0) if name.isdigit() else 0)  # shards: parent movies
+        candidates, others, pics_kept = [], [], False # files to be removed, other files, and pictures kept flag
+        for name, size, mtime in files:               # iteration over the files of the folder
+            is_movie = name.endswith(movie_types)     # case of movie
+            is_picture = name.lower().endswith(picture_types)  # case of picture
+            if keep_days > 0 and now - mtime < keep_days * 86400:  # case of recent file
+                keep = True                           # file is kept
+            elif replicated is not None and (is_movie or is_picture) and (os.path.join(directory, name), size) not in replicated:
+                keep = True                           # file is kept until replicated
+            elif is_movie:                            # case of movie
+                keep = keep_movies                    # movie is kept as per policy
+            elif is_picture:                          # case of picture
+                keep = keep_unrendered and mtime >= last_movie  # picture is kept until rendered, as per policy
+            else:                                     # case of other file
+                others.append((name, size))           # decided after the pictures
+                continue                              # next file
+            if keep:                                  # case the file is kept
+                kept += 1                             # kept files counter
+                pics_kept = pics_kept or is_picture   # flag for pictures kept in the folder
+            else:                                     # case the file can be removed
+                candidates.append((name, size))       # file to be removed
+        if pics_kept:                                 # case pictures are kept in the folder
+            kept_dirs.add(directory)                  # folder with kept pictures
+        others_of[directory] = others                 # other files of the folder
+        if candidates:                                # case of files to be removed in the folder
+            remove[directory] = candidates            # files to be removed
+    for directory, others in others_of.items():       # iteration over the other files per folder
+        if any([d == directory or d.startswith(directory + os.sep) for d in kept_dirs]):  # case of pictures kept (or in shards)
+            kept += len(others)                       # other files are kept too
+        elif others:                                  # case no pictures are kept
+            remove.setdefault(directory, []).extend(others)  # other files can be removed
+    return remove, kept                               # files to be removed and kept quantity are returned
+
+
+
+
+
+def remove_batch(directory, names):
+    """ Removes the names files from directory (one directory descriptor, unlink relative to it); Files not
+        removable by this user are removed via a single 'sudo rm'. Returns the names not removed.
+    """
+    denied, failed = [], []                           # names not removable by this user, and names not removed
+    try:                                              # tentative approach
+        dir_fd = os.open(directory, os.O_RDONLY)      # folder descriptor (no path lookup per file)
+    except OSError:                                   # case the folder can't be opened
+        return list(names)                            # nothing removed
+    try:                                              # tentative approach
+        for name in names:                            # iteration over the files
+            try:                                      # tentative approach
+                os.unlink(name, dir_fd=dir_fd)        # file is removed
+            except FileNotFoundError:                 # case the file has already gone
+                pass                                  # do nothing
+            except PermissionError:                   # case the file can't be removed by this user
+                denied.append(name)                   # removal via sudo
+            except OSError:                           # case of other errors
+                failed.append(name)                   # file not removed
+    finally:                                          # in any case
+        os.close(dir_fd)                              # folder descriptor is closed
+
+    if denied:                                        # case of files not removable by this user
+        paths = [os.path.join(directory, name) for name in denied]  # full paths (no shell, no glob expansion)
+        if subprocess.run(['sudo', 'rm', '-f', '--'] + paths).returncode != 0:  # case sudo rm fails
+            failed += [name for name, path in zip(denied, paths) if os.path.exists(path)]
+    return failed                                     # names not removed are returned
+
+
+
+
+
+def cleanup(folder, f_types, keep_days=0, keep_movies=False, keep_unrendered=False, dry_run=False, batch=1000,
+            replicated=None):
+    """ Removes the files of f_types from folder and its sub-folders, as per the retention policies (replicated:
+        see select_files).
+        In dry run nothing is removed, the report still lists the files and bytes that would be freed.
+        Returns the report dict: files and bytes removed (or to be removed), files kept, files failed, seconds.
+    """
+    start = time()                                    # time reference for the cleanup
+    remove, kept = select_files(scan_tree(folder, f_types), keep_days, keep_movies, keep_unrendered, replicated=replicated)
+    report = {'files': 0, 'bytes': 0, 'kept': kept, 'failed': 0, 'dry_run': dry_run, 'removed': []}
+    for directory, files in remove.items():           # iteration over the folders
+        for i in range(0, len(files), batch):         # iteration over the batches of the folder
+            chunk = files[i:i+batch]                  # files of the batch
+            failed = set() if dry_run else set(remove_batch(directory, [name for name, _ in chunk]))  # removal
+            done = [(name, size) for name, size in chunk if name not in failed]  # files removed
+            report['files'] += len(done)              # files removed counter
+            report['bytes'] += sum([size for _, size in done])  # bytes freed counter
+            report['failed'] += len(failed)           # files not removed counter
+            if dry_run:                               # case of dry run
+                report['removed'] += [os.path.join(directory, name) for name, _ in done]  # files to be removed
+    report['seconds'] = time() - start                # cleanup time
+    return report                                     # report is returned
+
+
+
+
+
+def print_report(report, label=''):
+    """ Prints the cleanup report to the terminal.
+    """
+    action = 'to be removed (dry run)' if report['dry_run'] else 'removed'  # report action
+    for fname in sorted(report['removed']):           # iteration over the files to be removed (dry run)
+        print("  ", fname)                            # file name is printed
+    print(f"{label}{report['files']} files {action}, {report['bytes']/1048576:.1f} MB, {report['kept']} kept, "
+          f"{report['failed']} failed, in {report['seconds']:.2f} secs")
+
+
+
+
+
+class StorageGovernor:
+    """ Tracks the bytes per frame and the free space as frames arrive, and the watermark level reached.
+    """
+    
+    actions = ('none', 'lower JPEG quality', 'smaller resolution', 'prune rendered pictures', 'stop capture')
+
+    def __init__(self, folder, frame_bytes, interval_s, watermarks_mb=(2000, 1000, 500, 200), alpha=0.1):
+        self.folder = folder                          # folder on the monitored file system
+        self.frame_bytes = float(frame_bytes)         # bytes per frame (exponential moving average)
+        self.interval_s = interval_s                  # shooting interval, for the time to full
+        self.watermarks = sorted(watermarks_mb, reverse=True)[:len(self.actions) - 1]  # free MB per level
+        self.alpha = alpha                            # weight of the last frame in the moving average
+        self.free = self.free_bytes()                 # free bytes
+        self.level = 0                                # watermark level reached (actions taken at the first frame)
+
+
+    def free_bytes(self):
+        """ Returns the bytes available (to non-root users) on the file system of folder.
+        """
+        st = os.statvfs(self.folder)                  # file system status
+        return st.f_bavail * st.f_frsize              # free blocks available * fragment size
+
+
+    def watermark_level(self):
+        """ Returns the quantity of watermarks the free space is below.
+        """
+        return sum([self.free / 1048576 < mb for mb in self.watermarks])
+
+
+    def update(self, frame_bytes):
+        """ Accounts a new frame of frame_bytes; Returns the first watermark level newly reached (zero when none).
+        """
+        self.frame_bytes += self.alpha * (frame_bytes - self.frame_bytes)  # moving average of the frame bytes
+        return self.next_level()                      # first level newly reached, if any
+
+
+    def next_level(self):
+        """ Re-reads the free space, and returns the next watermark level to act on (zero when none); Called again
+            after each action, so an action freeing enough space (i.e. pruning) stops the sequence of the graded
+            actions. A level going back can be reached again later.
+        """
+        self.free = self.free_bytes()                 # free bytes
+        level = self.watermark_level()                # watermark level of the free space
+        if level <= self.level:                       # case no new level is reached
+            self.level = level                        # current level (lower, after freeing space)
+            return 0                                  # no action
+        self.level += 1                               # next level, acted on
+        return self.level                             # level is returned
+
+
+    def frames_left(self):
+        """ Returns the frames still fitting the free space, at the current bytes per frame.
+        """
+        return int(self.free / max(self.frame_bytes, 1))
+
+
+    def time_to_full(self):
+        """ Returns the projected secs to a full storage, at the current bytes per frame and interval.
+        """
+        return self.frames_left() * self.interval_s
+
+
+    def status(self):
+        """ Returns a one line status, for the terminal.
+        """
+        return (f"free {self.free/1048576:.0f} MB, {self.frame_bytes/1048576:.2f} MB/frame, "
+                f"{self.frames_left()} frames left, full in {self.time_to_full()/3600:.1f} h")
+
+
+
+
+
+class QualityBudget:
+    """ Adapts the JPEG quality in between frames, so the planned frames fit the bytes budget and the free space.
+    """
+
+    def __init__(self, folder, budget_bytes, planned_frames, frame_bytes, used_bytes=0, quality=90, q_min=40,
+                 q_max=95, alpha=0.2, hold=5, reserve_mb=200):
+        self.folder = folder                          # folder on the monitored file system
+        self.budget = budget_bytes                    # bytes budget of the run
+        self.frames_left = planned_frames             # frames still to be taken
+        self.frame_bytes = float(frame_bytes)         # bytes per frame (exponential moving average)
+        self.used = used_bytes                        # bytes used so far (i.e. pictures before a power outage)
+        self.quality = quality                        # current JPEG quality
+        self.q_min, self.q_max = q_min, q_max         # JPEG quality range
+        self.alpha = alpha                            # weight of the last frame in the moving average
+        self.hold = hold                              # frames in between quality changes (the average settles)
+        self.reserve = reserve_mb * 1048576           # free bytes never used
+        self.since_change = 0                         # frames since the last quality change
+
+
+    def free_bytes(self):
+        """ Returns the bytes available (to non-root users) on the file system of folder.
+        """
+        st = os.statvfs(self.folder)                  # file system status
+        return st.f_bavail * st.f_frsize              # free blocks available * fragment size
+
+
+    def target(self):
+        """ Returns the bytes per frame available for the frames left: budget left, limited by the free space.
+        """
+        available = min(self.budget - self.used, self.free_bytes() - self.reserve)  # bytes still available
+        return max(available, 0) / max(self.frames_left, 1)  # bytes per frame left
+
+
+    def update(self, frame_bytes):
+        """ Accounts the frame just saved (frame_bytes); Returns the JPEG quality for the next frame.
+            The quality moves by a step proportional to the log of the ratio between the average frame size and
+            the target, at most every hold frames, outside a small dead band.
+        """
+        self.used += frame_bytes                      # bytes used so far
+        self.frames_left = max(self.frames_left - 1, 0)  # frames still to be taken
+        self.frame_bytes += self.alpha * (frame_bytes - self.frame_bytes)  # moving average of the frame bytes
+        self.since_change += 1                        # frames since the last quality change
+        if self.since_change < self.hold:             # case the average hasn't settled yet
+            return self.quality                       # quality is unchanged
+        ratio = self.frame_bytes / max(self.target(), 1)  # average frame size over the target
+        if 0.9 <= ratio <= 1.03:                      # case within the dead band
+            return self.quality                       # quality is unchanged
+        step = max(-10, min(5, round(-10 * math.log2(ratio))))  # quality step (faster down than up)
+        step = step if step != 0 else (-1 if ratio > 1 else 1)  # at least one quality point
+        quality = max(self.q_min, min(self.q_max, self.quality + step))  # new quality, within the range
+        if quality != self.quality:                   # case the quality changes
+            self.quality = quality                    # current quality
+            self.since_change = 0                     # frames since the last quality change
+        return self.quality                           # quality for the next frame is returned
+
+
+    def status(self):
+        """ Returns a one line status, for the terminal.
+        """
+        return (f"budget {self.used/1048576:.0f} of {self.budget/1048576:.0f} MB, {self.frames_left} frames left "
+                f"at {self.target()/1048576:.2f} MB/frame, JPEG quality {self.quality}")
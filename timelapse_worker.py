@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# coding: utf-8
+
+"""
+#############################################################################################################
+#  Timelapse application, background render worker
+#
+#  Renders are handed to a separate process through a small job queue, so the main loop keeps shooting.
+#  The worker runs at low CPU (nice) and I/O (idle class) priority, and so does ffmpeg (inherited).
+#  Progress and results come back through a status queue, polled by the main loop for terminal and display.
+#  The worker is the leader of its own process group: pausing sends SIGSTOP to the whole group (worker and
+#  ffmpeg), resuming sends SIGCONT; This is used to keep the shooting windows free from render load.
+#
+#  Scheduling: jobs wait in a backlog, and are sent to the worker one at a time, only when their estimated
+#  render time fits the time left to the next shooting window; Long renders are queued as segments.
+#  Each job writes a partial file, renamed to its final name only when complete (crash safe checkpoints).
+#############################################################################################################
+"""
+
+
+from multiprocessing import Process, Queue
+from queue import Empty
+from time import time
+import os, signal
+
+from timelapse_render import run_ffmpeg, commit_partial
+
+
+
+
+def set_low_priority(niceness=19):
+    """ Lowers the CPU priority (nice) and, when psutil is available, the I/O priority (idle class)
+        of the calling process; Child processes (i.e. ffmpeg) inherit both.
+    """
+    try:                                              # tentative approach
+        os.nice(niceness)                             # CPU priority is lowered
+    except OSError:                                   # case the niceness can't be changed
+        pass                                          # do nothing
+
+    try:                                              # tentative approach
+        import psutil                                 # psutil is imported (already used by timelapse.py)
+        psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)  # I/O only when the disk is otherwise idle
+    except (ImportError, AttributeError, OSError):    # case psutil or ionice are not available
+        pass                                          # do nothing
+
+
+
+
+
+def render_worker(jobs, status, niceness):
+    """ Worker process loop: runs the render jobs (dicts) from the jobs queue, until None is received.
+        Each job has the ffmpeg 'command', the 'frames' quantity and the 'out_file'; Optional keys are 'offset'
+        and 'total' (progress of a segment over the whole render), 'commit' (partial file written by ffmpeg and
+        its final name, renamed when successful) and 'temp_files' (removed after the job).
+    """
+    os.setpgrp()                                      # worker becomes leader of a new process group
+    set_low_priority(niceness)                        # CPU and I/O priority are lowered
+
+    while True:                                       # infinite loop, until None is received
+        job = jobs.get()                              # next job, blocking until available
+        if job is None:                               # case of stop request
+            break                                     # while loop is interrupted
+
+        out_file = job['out_file']                    # output file of the job
+        status.put({'state': 'started', 'out_file': out_file})  # start feedback
+
+        offset = job.get('offset', 0)                 # frames rendered by the previous segments
+        total = job.get('total', job['frames'])       # frames of the whole render
+        
+        def progress_cb(progress):                    # progress is sent back to the main process
+            frame = progress['frame'] + offset        # frames done over the whole render
+            eta_s = (total - frame) / progress['fps'] if progress['fps'] > 0 else 0  # ETA of the whole render
+            status.put(dict(progress, frame=frame, total=total, percent=round(100*frame/max(total, 1), 1),
+                            eta_s=eta_s, state='progress', out_file=out_file))
+
+        start_time = time()                           # time reference for the render
+        try:                                          # tentative approach
+            ret = run_ffmpeg(job['command'], job['frames'], progress_cb)  # ffmpeg is run
+        except Exception:                             # case ffmpeg can't be run
+            ret = -1                                  # error return code
+        if 'commit' in job:                           # case the job writes a partial file
+            commit_partial(ret, *job['commit'])       # partial file renamed when complete, removed otherwise
+
+        for fname in job.get('temp_files', []):       # iteration over the temporary files of the job
+            if os.path.exists(fname):                 # case the file exists
+                os.remove(fname)                      # temporary file is removed
+        status.put({'state': 'done', 'out_file': out_file, 'ret': ret, 'frames': job['frames'],
+                    'size': job['size'], 'label': job.get('label', ''), 'final': job.get('final', True),
+                    'seconds': time() - start_time})  # result feedback
+
+
+
+
+
+class RenderWorker:
+    """ Main process side of the background render worker (started at the first job).
+    """
+
+    def __init__(self, niceness=19, margin_s=120):
+        self.niceness = niceness                      # niceness of the worker process
+        self.margin_s = margin_s                      # safety time (secs) before the next shooting window
+        self.backlog = []                             # jobs waiting for idle time
+        self.next_window = None                       # epoch time of the next shooting window (None if no more)
+        self.gap_s = 0                                # idle time (secs) in between shooting windows
+        self.jobs = Queue()                           # jobs queue, to the worker
+        self.status = Queue()                         # status queue, from the worker
+        self.process = None                           # worker process (started at the first job)
+        self.pending = 0                              # jobs submitted and not done yet
+        self.progress = None                          # last progress of the ongoing job
+        self.paused = False                           # flag for the worker being stopped (SIGSTOP)
+        self.pause_start = 0                          # time the worker has been paused
+        self.paused_s = 0                             # paused time (secs) of the ongoing job
+        self.render_s = {}                            # render time (secs) of the done jobs, per output file
+
+
+    def submit(self, job):
+        """ Sends a render job to the worker (started when needed).
+        """
+        if self.process is None or not self.process.is_alive():  # case the worker isn't running
+            self.process = Process(target=render_worker, args=(self.jobs, self.status, self.niceness), daemon=True)
+            self.process.start()                      # worker process is started
+        self.pending += 1                             # one more job to be done
+        self.jobs.put(job)                            # job is sent to the worker
+
+
+    def queue(self, jobs):
+        """ Adds the jobs (list) to the backlog; Each job has the 'est_s' key (estimated render time).
+        """
+        self.backlog.extend(jobs)                     # jobs are added to the backlog
+
+
+    def time_to_window(self):
+        """ Returns the secs to the next shooting window, or None when there are no more windows.
+        """
+        return None if self.next_window is None else self.next_window - time()
+
+
+    def dispatch(self):
+        """ Sends the next backlog job to the worker, when the worker is idle and the job fits the idle time.
+            A job is also sent at the start of an idle gap even if it doesn't fit (it gets paused at the window).
+            Returns True when a job has been sent.
+        """
+        if self.pending > 0 or len(self.backlog) == 0:  # case the worker is busy, or nothing to do
+            return False                              # no job sent
+        
+        time_left = self.time_to_window()             # secs to the next shooting window
+        est_s = self.backlog[0].get('est_s', 0)       # estimated render time of the next job
+        if time_left is None or est_s + self.margin_s <= time_left or time_left >= self.gap_s - self.margin_s > 0:
+            self.submit(self.backlog.pop(0))          # job is sent to the worker
+            return True                               # job sent
+        return False                                  # no job sent
+
+
+    def cancel(self, out_file):
+        """ Removes from the backlog the jobs of out_file (i.e. after a failed segment), and their temp files.
+        """
+        for job in [j for j in self.backlog if j['out_file'] == out_file]:  # iteration over the jobs of out_file
+            self.backlog.remove(job)                  # job is removed from the backlog
+            for fname in job.get('temp_files', []):   # iteration over the temporary files of the job
+                if os.path.exists(fname):             # case the file exists
+                    os.remove(fname)                  # temporary file is removed
+
+
+    def busy(self):
+        """ Returns True when there are renders queued or ongoing.
+        """
+        return self.pending > 0 or len(self.backlog) > 0
+
+
+    def _signal(self, sig):
+        """ Sends sig to the worker process group (worker and ffmpeg).
+        """
+        try:                                          # tentative approach
+            os.killpg(self.process.pid, sig)          # signal to the process group
+        except (ProcessLookupError, PermissionError, AttributeError):  # case the group doesn't exist (yet)
+            pass                                      # do nothing
+
+
+    def pause(self):
+        """ Stops the worker and ffmpeg (SIGSTOP), when there are jobs to be done.
+        """
+        if self.busy() and not self.paused:           # case jobs pending and not paused yet
+            self._signal(signal.SIGSTOP)              # worker group is stopped
+            self.paused = True                        # paused flag is set True
+            self.pause_start = time()                 # time reference of the pause
+
+
+    def resume(self):
+        """ Resumes the worker and ffmpeg (SIGCONT).
+        """
+        if self.paused:                               # case the worker is paused
+            self._signal(signal.SIGCONT)              # worker group is resumed
+            self.paused = False                       # paused flag is set False
+            self.paused_s += time() - self.pause_start  # paused time of the ongoing job
+
+
+    def poll(self):
+        """ Returns the list of status messages received from the worker (not blocking).
+            Done messages get the 'active_s' key: render time without the paused time; The final job of a render
+            also gets the 'render_s' key: active time of all the jobs (segments) of that render.
+        """
+        messages = []                                 # empty list to store the messages
+        while True:                                   # loop until the status queue is empty
+            try:                                      # tentative approach
+                msg = self.status.get_nowait()        # status message from the worker
+            except Empty:                             # case of no more messages
+                break                                 # while loop is interrupted
+
+            if msg['state'] == 'progress':            # case of progress message
+                self.progress = msg                   # last progress is stored
+            elif msg['state'] == 'done':              # case of job done
+                self.pending -= 1                     # one less job to be done
+                self.progress = None                  # no ongoing progress
+                msg['active_s'] = max(msg['seconds'] - self.paused_s, 0)  # render time without pauses
+                self.paused_s = 0                     # paused time is reset for the next job
+                out_file = msg['out_file']            # output file of the render
+                self.render_s[out_file] = self.render_s.get(out_file, 0) + msg['active_s']  # render time so far
+                if msg['final']:                      # case of last job of the render
+                    msg['render_s'] = self.render_s.pop(out_file)  # render time of all the jobs
+            messages.append(msg)                      # message is appended to the list
+        return messages                               # list of messages is returned
+
+
+    def stop(self, wait=False):
+        """ Stops the worker: after the queued jobs when wait is True, otherwise immediately.
+        """
+        if self.process is None:                      # case the worker has never been started
+            return                                    # nothing to do
+        if wait and self.process.is_alive():          # case the queued jobs have to be completed
+            self.resume()                             # worker is resumed, if paused
+            self.jobs.put(None)                       # stop request after the queued jobs
+            self.process.join()                       # waits for the worker to end
+        else:                                         # case of immediate stop
+            self._signal(signal.SIGCONT)              # stopped processes can't handle SIGTERM
+            self._signal(signal.SIGTERM)              # worker group (worker and ffmpeg) is terminated
+            self.process.join(timeout=5)              # waits for the worker to end
+        self.process = None                           # worker process reference is cleared
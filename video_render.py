@@ -10,12 +10,22 @@
 
 
 ################  libraries  ####################################################################
-from os import walk, system
-from time import time, sleep, localtime, strftime
-from datetime import datetime, timedelta
-from pathlib import Path
-import os.path, sys, collections
+from time import time, localtime, strftime
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+import os.path, collections, json, subprocess, glob
 from PIL import Image
+from timelapse_render import list_frames, proxy_size, drawtext_filter, pipe_render, frames_luma, deflicker_gains
+from timelapse_render import overlay_texts, overlay_filter, dark_frames, trim_cuts, fit_trimmed, frames_shifts, stabilize_boxes
+from timelapse_render import fit_to_time, image_input, select_filter, timing_filter
+from timelapse_render import frames_hash, mezzanine_files, valid_mezzanine, store_mezzanine
+from timelapse_render import rendition_plan, renditions_command, parse_benchmark
+from timelapse_render import run_ffmpeg, save_render_timing, print_progress
+from timelapse_render import rendered_unchanged, store_render_stamp, partial_file, commit_partial
+from timelapse_remote import serve, remote_render
+from timelapse_archive import archive_index, open_frame
+from timelapse_manifest import shard_folders
+from timelapse_integrity import verify_folder, print_verify_report
 # ###############################################################################################
 
 
@@ -26,7 +36,25 @@ folder = 'timelapse_pics'          # arbitrary folder, under parent_folder, wher
 fps = 24                           # initial fps value.
 movie_time_s = 10                  # arbitrary time to force the video render to
 movie_forced_to_fix_time = False   # boolean variable to force force the video render to a fix time lenght is set False
+max_fps = 30                       # max fps for a fix time movie, above it an evenly spaced subset of frames is rendered
 text = ''                          # empty string is assigned to text variable
+proxy = 0                          # proxy render scale (2, 4 or 8), zero for a full size render
+deflicker = False                  # boolean variable to flatten the luminance flicker is set False
+deflicker_window = 15              # frames quantity for the luminance smoothing, when deflicker
+stabilize = False                  # boolean variable to stabilize the camera shake is set False
+stabilize_window = 30              # frames quantity for the camera trajectory smoothing, when stabilize
+use_cache = False                  # boolean variable to render via the mezzanine cache is set False
+overlay = False                    # boolean variable to overlay capture time, lux and temperature of each frame is set False
+trim_lux = None                    # frames captured below this lux are dropped (None to keep the night frames)
+trim_luma = None                   # frames with mean luminance (0-255) below this value are dropped (None to keep them)
+fade = 0                           # crossfade frames at each night trim cut (zero for hard cuts)
+renditions = []                    # list of output renditions, from a single decode pass (empty for a single movie)
+batch = None                       # parent folder or glob of the folders to render in batch (None for a single folder)
+batch_workers = 2                  # max folders rendered at the same time, in batch mode
+force = False                      # boolean variable to re-render unchanged folders in batch mode is set False
+remote = ''                        # render workers 'host:port,host:port' (empty string for a local render)
+remote_chunk = 200                 # frames per chunk handed to a render worker
+serve_port = None                  # port of the render worker mode (None when not a worker)
 # ###############################################################################################
 
 
@@ -57,7 +85,75 @@ parser.add_argument("--time", type=int,
 parser.add_argument("--text", type=str, 
                     help="Input the text to overlay on video. If 'fps' the used value is overlaid")
 
+# --proxy argument is added to the parser
+parser.add_argument("--proxy", type=int, choices=[2, 4, 8],
+                    help="Quick proxy render at 1/2, 1/4 or 1/8 of the pictures size (JPEG DCT scaled decoding)")
+
+# --deflicker argument is added to the parser
+parser.add_argument("--deflicker", action='store_true',
+                    help="Flatten the luminance flicker, via per-frame gain")
+
+# --stabilize argument is added to the parser
+parser.add_argument("--stabilize", action='store_true',
+                    help="Stabilize the camera shake (wind, temperature), via phase correlation and crop")
+
+# --overlay argument is added to the parser
+parser.add_argument("--overlay", action='store_true',
+                    help="Overlay the capture time, lux and temperature of each frame (from the pictures manifest)")
+
+# --trim_lux argument is added to the parser
+parser.add_argument("--trim_lux", type=float,
+                    help="Drop the frames captured below this lux (from the pictures manifest)")
+
+# --trim_luma argument is added to the parser
+parser.add_argument("--trim_luma", type=float,
+                    help="Drop the frames with mean luminance (0-255) below this value (from the pictures manifest)")
+
+# --fade argument is added to the parser
+parser.add_argument("--fade", type=int,
+                    help="Input the crossfade frames at each night trim cut (i.e. 6)")
+
+# --cache argument is added to the parser
+parser.add_argument("--cache", action='store_true',
+                    help="Render via the mezzanine cache (made at the first render, a full decode plus a high quality encode; later re-renders skip the pictures decoding)")
+
+# --renditions argument is added to the parser
+parser.add_argument("--renditions", type=str,
+                    help="Input the json file listing the output renditions (keys: name, width, height, codec, crf, fps, "
+                         "time, text, format), i.e. [{\"name\": \"web\", \"width\": 1280, \"height\": 720, \"crf\": 26, \"time\": 20}, "
+                         "{\"name\": \"preview\", \"width\": 480, \"height\": 270, \"codec\": \"gif\", \"fps\": 10, \"time\": 10}]. "
+                         "Not combinable with --proxy, --deflicker, --stabilize, --overlay, --trim_lux and --trim_luma")
+
+# --batch argument is added to the parser
+parser.add_argument("--batch", type=str,
+                    help="Input a parent folder, or a glob (i.e. '/home/pi/shared/2024*'), to render all its picture folders")
+
+# --workers argument is added to the parser
+parser.add_argument("--workers", type=int,
+                    help="Input the max folders rendered at the same time, in batch mode")
+
+# --force argument is added to the parser
+parser.add_argument("--force", action='store_true',
+                    help="Re-render also the folders already rendered and unchanged, in batch mode")
+
+# --serve argument is added to the parser
+parser.add_argument("--serve", type=int,
+                    help="Run as render worker on this port; --parent is where the picture folders are (shared path)")
+
+# --remote argument is added to the parser
+parser.add_argument("--remote", type=str,
+                    help="Input the render workers as host:port,host:port (i.e. localhost:5001,localhost:5002)")
+
+# --chunk argument is added to the parser
+parser.add_argument("--chunk", type=int,
+                    help="Input the frames per chunk handed to a render worker")
+
 args = parser.parse_args()   # argument parsed assignement
+
+if args.renditions != None:  # case of renditions, rendered from the plain decoded frames only
+    not_applied = [a for a in ('proxy', 'deflicker', 'stabilize', 'overlay', 'trim_lux', 'trim_luma') if getattr(args, a) not in (None, False)]
+    if len(not_applied) > 0: # case of options the renditions don't apply
+        parser.error("argument --renditions: not combinable with " + ', '.join(['--' + a for a in not_applied]))
 # ###############################################################################################
 
 
@@ -82,126 +178,479 @@ if args.text != None:              # case the video_render.py has been launched
     text = args.text               # the arg text is assigned to the text variable
     text = text.strip()
     add_text = True                # boolean variable to overlay text is set True
-# ###############################################################################################    
 
+if args.proxy != None:             # case the video_render.py has been launched with 'proxy' argument
+    proxy = int(args.proxy)        # the proxy integer is assigned to the proxy variable
+
+if args.deflicker:                 # case the video_render.py has been launched with 'deflicker' argument
+    deflicker = True               # boolean variable to flatten the luminance flicker is set True
+
+if args.stabilize:                 # case the video_render.py has been launched with 'stabilize' argument
+    stabilize = True               # boolean variable to stabilize the camera shake is set True
+
+if args.overlay:                   # case the video_render.py has been launched with 'overlay' argument
+    overlay = True                 # boolean variable to overlay the per-frame capture info is set True
+
+if args.trim_lux != None:          # case the video_render.py has been launched with 'trim_lux' argument
+    trim_lux = float(args.trim_lux)  # the trim_lux float is assigned to the trim_lux variable
+
+if args.trim_luma != None:         # case the video_render.py has been launched with 'trim_luma' argument
+    trim_luma = float(args.trim_luma)  # the trim_luma float is assigned to the trim_luma variable
 
+if args.fade != None:              # case the video_render.py has been launched with 'fade' argument
+    fade = max(0, int(args.fade))  # the fade integer is assigned to the fade variable
 
-################  testing if the folder exists  #################################################
-folder = os.path.join(parent_folder, folder)     # folder will be appended to the parent_folder
-if not os.path.exists(folder):                   # case the folder does not exist
-    print("\nFolder does not exist")
-    print("Change the folder name at argument --folder")
-    print("or change it at video_render.py\n")
-    exit()                                       # script is terminated
+if args.cache:                     # case the video_render.py has been launched with 'cache' argument
+    use_cache = True               # boolean variable to render via the mezzanine cache is set True
+
+if args.renditions != None:        # case the video_render.py has been launched with 'renditions' argument
+    with open(args.renditions, 'r') as f:  # renditions file is opened in reading mode
+        renditions = json.load(f)  # json file is parsed to a list of renditions
+
+if args.batch != None:             # case the video_render.py has been launched with 'batch' argument
+    batch = args.batch.strip()     # the batch string arg is assigned to the batch variable
+
+if args.workers != None:           # case the video_render.py has been launched with 'workers' argument
+    batch_workers = max(1, int(args.workers))  # the workers integer is assigned to the batch_workers variable
+
+if args.force:                     # case the video_render.py has been launched with 'force' argument
+    force = True                   # boolean variable to re-render unchanged folders is set True
+
+if args.serve != None:             # case the video_render.py has been launched with 'serve' argument
+    serve_port = int(args.serve)   # the serve integer is assigned to the serve_port variable
+
+if args.remote != None:            # case the video_render.py has been launched with 'remote' argument
+    remote = args.remote.strip()   # the remote string arg is assigned to the remote variable
+
+if args.chunk != None:             # case the video_render.py has been launched with 'chunk' argument
+    remote_chunk = max(1, int(args.chunk))  # the chunk integer is assigned to the remote_chunk variable
 # ###############################################################################################    
 
 
 
-################  check the pictures format  ####################################################
 f_types = ['.jpg', '.jpeg', '.png', '.bmp', '.gif']   # list of picture formats the picamera2 can save to
-dir_path = Path(folder)                        # complete path of the folder
-
-# get a list of all extensions from the folder
-file_exts = [''.join(file_path.suffixes) for file_path in dir_path.iterdir()
-             if file_path.is_file() and file_path.suffix]
-
-ext_counts = collections.Counter(file_exts)    # count the occurrence of each extension in list
-
-pics_dict = {}                                 # empty dict to store extesnsion and image:quantity
-for ext in f_types:                            # iteration through the image extensions
-    if ext in file_exts:                       # case the extension found in folder exists in images extension list
-        pics_dict.update({ext:ext_counts[ext]})  # key value are added to the image:quantity dict
-
-if len(pics_dict) == 0:                        # case the dict is empty
-    print("\nNo pictures in folder")
-    print("Files in folder are: ", *list(ext_counts.keys()))
-    print("Change the folder name at argument --folder, or change it at video_render.py\n")
-    exit()                                     # script is terminated
-else:
-    pic_format = max(pics_dict, key=pics_dict.get)  # file extension with higher occurence
-    for root, dirs, files in os.walk(folder):  # iteration in the folder
-        for filename in files:                 # iteration through the files in folder
-            if filename.endswith(pic_format[1:]):  # case the file has the more recurring image extension
-                break                          # loop is interrupted
-    im = Image.open(os.path.join(folder, filename))  # image file info are retrieved
-    width = im.width                           # image width is assigned to width variable
-    height = im.height                         # image width is assigned to height variable
-# ###############################################################################################
+f_types += ['.webp', '.avif']                         # formats of the compacted pictures (timelapse_compact.py)
 
 
 
-################  calculates fps when forced video time  ########################################
-if movie_forced_to_fix_time:                   # case this variable is True (via settings or argument)
-    fps = int(round(int(ext_counts[pic_format])/movie_time_s))  # fps is calculated
-# ###############################################################################################
 
+def scan_folder(folder):
+    """ Scans folder once (scandir): returns the most recurring picture format, its pictures quantity and one
+        of these pictures (or None when there are no pictures), and the counter of all the file extensions.
+        Pictures packed in the day archives of folder, and in its shard subfolders, are counted as the loose ones.
+    """
+    ext_counts = collections.Counter()
+    samples = {}
+    for f in [folder] + [d.rstrip(os.sep) for d in shard_folders(folder)]:
+        with os.scandir(f) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                ext = os.path.splitext(entry.name)[1]
+                if ext == '':
+                    continue
+                ext_counts[ext] += 1
+                if ext in f_types:
+                    samples.setdefault(ext, entry.path)
+        for name in archive_index(f):
+            ext = os.path.splitext(name)[1]
+            ext_counts[ext] += 1
+            if ext in f_types:
+                samples.setdefault(ext, os.path.join(f, name))
+    
+    if len(samples) == 0:
+        return None, ext_counts
+    pic_format = max(samples, key=lambda ext: ext_counts[ext])
+    return {'pic_format': pic_format, 'pictures': ext_counts[pic_format], 'sample': samples[pic_format]}, ext_counts
 
 
-################  print to terminal #############################################################
-print()
-print("Folder:", folder)
-print("Picture format:", pic_format)
-print(f"Pictures in folder:", pics_dict[pic_format])
 
-if add_text:                         # case add_text is True (via settings or argument)
-    if text == 'fps':                # case text equals to 'fps'
-        text = f"{fps}X"             # string of the set (or calculated) fps is used 
-    print("Text overlaid to video:", text)
 
-if movie_forced_to_fix_time:         # case this variable is True (via settings or argument)
-    print('Video render forced to:', movie_time_s, 'seconds')
-else:
-    print('Video rendering at:', fps, 'fps')
+def render_options(fps, text, add_text):
+    """ Returns the render options (dict) recorded in the render stamp; A change of any of these re-renders.
+    """
+    return {'fps': fps, 'time': movie_time_s if movie_forced_to_fix_time else 0, 'text': text if add_text else '',
+            'proxy': proxy, 'deflicker': deflicker, 'stabilize': stabilize, 'overlay': overlay, 'renditions': renditions,
+            'trim': [trim_lux, trim_luma, fade]}
 
-# ###############################################################################################
 
 
 
+def render_folder(folder, scan=None, progress_cb=print_progress, verbose=True, skip_unchanged=False):
+    """ Renders the pictures of folder (movie, or renditions); scan is the scan_folder result, when available.
+        When skip_unchanged is set True, folders already rendered from the same pictures and options are skipped.
+        Returns a dict with the result, for the batch summary.
+    """
+    result = {'folder': folder, 'frames': 0, 'status': 'no pictures', 'seconds': 0, 'movies': []}
+    if scan is None:
+        scan, ext_counts = scan_folder(folder)
+        if scan is None:
+            print("\nNo pictures in folder")
+            print("Files in folder are: ", *list(ext_counts.keys()))
+            print("Change the folder name at argument --folder, or change it at video_render.py\n")
+            return result
+    
+    pic_format = scan['pic_format']
+    with Image.open(open_frame(scan['sample'])) as im:
+        width, height = im.size
+    
+    report = verify_folder(folder, pic_format.lstrip('.'), mark=False)   # read-only, the manifest isn't touched
+    if len(report['bad']) > 0:
+        print_verify_report(report, label='Integrity check (bad pictures left out): ')
+    
+    
+    ################  calculates fps when forced video time  ####################################
+    all_frames = [frame for frame in list_frames(folder, pic_format) if frame not in report['bad']]
+    frames = all_frames
+    dark = set()
+    if trim_lux is not None or trim_luma is not None:
+        dark = dark_frames(all_frames, trim_lux, trim_luma)
+        frames = [frame for frame in all_frames if frame not in dark]
+        if len(frames) == 0:
+            print(f"\nAll the {len(all_frames)} pictures in {folder} are below the night trim threshold")
+            result['status'] = 'all dark'
+            return result
+    framerate, decimated, folder_fps = fps, len(dark) > 0, fps
+    cuts = trim_cuts(frames, all_frames, dark) if fade > 0 and dark else set()
+    if movie_forced_to_fix_time:
+        frames, framerate, fit_decimated, cuts = fit_trimmed(frames, all_frames, dark, movie_time_s, fps, max_fps, fade)
+        decimated = decimated or fit_decimated
+        folder_fps = int(round(framerate))
+    result['frames'] = len(frames)
+    
+    folder_text = f"{folder_fps}X" if add_text and text == 'fps' else text
+    options = render_options(folder_fps, folder_text, add_text)
+    frames_id = frames_hash(all_frames)
+    if skip_unchanged:
+        movies = rendered_unchanged(folder, frames_id, options)
+        if movies:
+            result.update({'status': 'unchanged', 'movies': movies})
+            return result
+    
+    
+    ################  print to terminal #########################################################
+    if verbose:
+        print()
+        print("Folder:", folder)
+        print("Picture format:", pic_format)
+        print(f"Pictures in folder:", scan['pictures'])
+        
+        if add_text:
+            print("Text overlaid to video:", folder_text)
+        
+        if movie_forced_to_fix_time:
+            print('Video render forced to:', movie_time_s, 'seconds')
+            if decimated:
+                print(f'Frames rendered: {len(frames)} evenly spaced, at {folder_fps} fps')
+            else:
+                print(f'Video rendering at: {float(framerate):.3f} fps')
+        else:
+            print('Video rendering at:', folder_fps, 'fps')
+        
+        if proxy:
+            print('Proxy render at: 1/{} size ({}x{})'.format(proxy, *proxy_size(width, height, proxy)))
+        
+        if deflicker:
+            print('Deflicker over:', deflicker_window, 'frames')
+        
+        if stabilize:
+            print('Stabilization over:', stabilize_window, 'frames')
+        
+        if overlay:
+            print('Overlay of capture time, lux and temperature per frame')
+        
+        if trim_lux is not None or trim_luma is not None:
+            print(f'Night trim: {len(dark)} of {len(all_frames)} pictures dropped', end='')
+            print(f', {len(cuts)} cuts crossfaded over {fade} frames' if cuts else '')
+    
+    
+    ################  render  ###################################################################
+    render_start = time()
+    if len(renditions) > 0:
+        ret, movies = renditions_render(folder, pic_format, all_frames, width, height, renditions, use_cache)
+    else:
+        cache = use_cache and not dark and not report['bad']  # the mezzanine holds all the pictures of folder
+        ret, movies = video_render(folder, pic_format, frames, width, height, framerate, folder_text, add_text,
+                                   proxy, deflicker, decimated, cache, progress_cb, remote, overlay,
+                                   cuts, fade, stabilize)
+    result['seconds'] = time() - render_start
+    result['movies'] = movies
+    if ret == 0:
+        result['status'] = 'rendered'
+        store_render_stamp(folder, frames_id, options, movies)
+    else:
+        result['status'] = 'error'
+    return result
+
+
+
+
+def batch_folders(batch):
+    """ Returns the picture folders of batch (parent folder or glob), with their scan_folder result.
+        Each folder is scanned once; Folders without pictures are skipped.
+    """
+    if glob.has_magic(batch):
+        candidates = sorted([d for d in glob.glob(batch) if os.path.isdir(d)])
+    else:
+        with os.scandir(batch) as entries:
+            candidates = sorted([e.path for e in entries if e.is_dir() and not e.name.startswith('.')])
+    
+    folders = []
+    for folder in candidates:
+        scan, _ = scan_folder(folder)
+        if scan is not None:
+            folders.append((folder, scan))
+    return folders
+
+
+
+
+def render_batch(batch, workers, force=False):
+    """ Renders all the picture folders of batch (parent folder or glob), via a pool of at most workers renders
+        at the same time. Folders already rendered, and unchanged, are skipped unless force is set True.
+        Ends with a summary table.
+    """
+    batch_start = time()
+    folders = batch_folders(batch)
+    if len(folders) == 0:
+        print(f"\nNo picture folders found at {batch}\n")
+        return
+    print(f"\nBatch render of {len(folders)} folders, {workers} at the time\n")
+    
+    def render_job(folder_scan):
+        folder, scan = folder_scan
+        try:
+            return render_folder(folder, scan, progress_cb=None, verbose=False, skip_unchanged=not force)
+        except Exception as e:
+            print(f"Render error at {folder}: {e}")
+            return {'folder': folder, 'frames': 0, 'status': 'error', 'seconds': 0, 'movies': []}
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(render_job, folders))
+    
+    print(f"\n{'Folder':<30}{'Frames':>8}{'Status':>12}{'Time':>10}  Movie")
+    for r in results:
+        movie = os.path.basename(r['movies'][0]) if r['movies'] else ''
+        print(f"{os.path.basename(r['folder'])[:29]:<30}{r['frames']:>8}{r['status']:>12}"
+              f"{str(timedelta(seconds=round(r['seconds']))):>10}  {movie}")
+    counts = collections.Counter([r['status'] for r in results])
+    print(f"\n{', '.join([f'{v} {k}' for k, v in counts.items()])}, in {timedelta(seconds=round(time() - batch_start))}\n")
+
 
-def video_render(folder, pic_format, width, height, fps, text, add_text):
-    """ Renders all pictures in folder to a movie.
+
+
+def video_render(folder, pic_format, frames, width, height, fps, text, add_text, proxy=0, deflicker=False, decimated=False,
+                 use_cache=False, progress_cb=print_progress, remote='', overlay=False, cuts=(), fade=0,
+                 stabilize=False):
+    """ Renders the frames (pictures in folder) to a movie.
         Saves the video in folder with proper file datetime file name.
-        When the setting constrains the video to a fix time, the fps are adapted.
+        When the setting constrains the video to a fix time, the fps are adapted (fps can be a fraction)
+        and, if decimated, only the frames subset is read via an ffconcat list.
+        When proxy is set (2, 4 or 8), pictures are decoded at reduced size and piped to ffmpeg.
+        When deflicker is set True, each frame gets a gain flattening the luminance curve.
+        When stabilize is set True, the shift of each frame is estimated on thumbnails, and each frame is
+        cropped at its offset from the smoothed camera trajectory, while piping the frames.
+        When use_cache is set True, the render starts from the mezzanine (all the frames as a high quality
+        video stream) if still valid for the pictures, otherwise the mezzanine is made in the same ffmpeg run.
+        When remote workers are set ('host:port,host:port'), the frames are rendered in chunks by the workers.
+        When overlay is set True, each frame gets its capture time, lux and temperature (manifest) burned in, in
+        the same encode pass: as ffconcat frame metadata printed by drawtext, or drawn while decoding (proxy).
+        When cuts are set (frames indexes after dropped night frames), fade blended frames are added at each cut,
+        while piping the frames.
+        Frames of mixed formats (a compaction not completed) are piped, as ffmpeg reads a list with a single decoder.
+        The movie is written as partial file, renamed to its final name once complete.
+        Returns the ffmpeg return code and the list of the rendered movies.
     """
     render_start = time()
     print(f"\n  Video rendering started\n")
     
     render_warnings = False   # flag to printout the rendering ffmpeg error 
-    render_progress = False   # flag to printout the rendering progress (statistics)
     loglevel = '' if render_warnings else '-loglevel error'
-    if render_progress:
-        stats = '-stats'
-        stats_period = 20
-    else:
-        stats = '-nostats'
+    stats = '-nostats'        # progress is parsed from the ffmpeg -progress output
     
     pic_files = os.path.join(folder, '*' + pic_format)
-    out_file = os.path.join(folder, strftime("%Y%m%d_%H%M%S", localtime())+'.mp4')
+    suffix = f'_proxy{proxy}' if proxy else ''
+    out_file = os.path.join(folder, strftime("%Y%m%d_%H%M%S", localtime())+suffix+'.mp4')
+    partial = partial_file(out_file)
+    list_file = os.path.join(folder, 'frames.ffconcat')
     size = str(width)+'x'+str(height)
     
-    if add_text:
-        font = '/usr/share/fonts/truetype/freefont/dejavu/DejaVuSans.ttf'
-        fcol = 'white'                   # font color
-        fsize = '48'                     # font size
-        bcol = 'black@0.5'               # box color with % of transparency
-        pad = str(round(int(fsize)/5))   # 20% of the font size
-        pos_x = '70'                     # reference from the left
-        pos_y = str(height - 70)       # reference from the bottom
-        v_f = (f"drawtext=fontfile={font}:text={text}:fontcolor={fcol}:fontsize={fsize}:box=1:boxcolor={bcol}:boxborderw={pad}:x={pos_x}:y={pos_y}")
+    overlays = overlay_texts(frames) if overlay else None
+    mixed = len(set([os.path.splitext(frame)[1] for frame in frames])) > 1
+    piped = proxy or deflicker or stabilize or len(cuts) > 0 or mixed
+    if remote and (piped or overlay):
+        print("Proxy, deflicker, stabilized, overlay and crossfade renders are made locally")
+    
+    if remote and not (piped or overlay):
+        v_f = drawtext_filter(text, height) if add_text else ''
+        kind, decoded = 'remote', len(frames)
+        ret = remote_render(folder, frames, fps, size, v_f, remote, partial, remote_chunk, progress_cb)
+    
+    elif piped:
+        scale = proxy if proxy else 1
+        out_w, out_h = proxy_size(width, height, scale)
+        v_f = drawtext_filter(text, out_h, scale) if add_text else ''
+        gains = None
+        if deflicker:
+            luma, source = frames_luma(frames)
+            gains = deflicker_gains(luma, deflicker_window)
+            print(f"Deflicker from {source}, gains from {gains.min():.2f} to {gains.max():.2f}")
+        boxes = None
+        if stabilize:
+            shifts_start = time()
+            boxes, margin = stabilize_boxes(frames_shifts(frames), stabilize_window)
+            print(f"Stabilization crop {100*margin:.1f}% per side, shifts estimated in {time() - shifts_start:.1f} secs")
+        kind = 'proxy' if proxy else 'deflicker' if deflicker else 'stabilize' if stabilize else 'pipe'
+        decoded, out_size = len(frames), f'{out_w}x{out_h}'
+        ret = pipe_render(frames, partial, (out_w, out_h), fps, v_f,
+                          loglevel = 'warning' if render_warnings else 'error', gains=gains, progress_cb=progress_cb,
+                          overlays=overlays, cuts=cuts, fade=fade, boxes=boxes)
+    
+    elif use_cache and not overlay:
+        all_frames = list_frames(folder, pic_format)
+        frames_id = frames_hash(all_frames)
+        mezzanine = valid_mezzanine(folder, frames_id, len(all_frames), size)
+        v_f = [select_filter(len(all_frames), len(frames))] if decimated else []
+        v_f.append(timing_filter(fps))
+        if add_text:
+            v_f.append(drawtext_filter(text, height))
+        v_f = ','.join(v_f)
+        
+        if mezzanine:
+            print("Rendering from the mezzanine cache")
+            kind, decoded, total = 'mezzanine', len(all_frames), len(frames)
+            render_command = f"ffmpeg {stats} {loglevel} -i '{mezzanine}' -vf \"{v_f}\" -r {fps} '{partial}' -y"
+        else:
+            print("Rendering, and making the mezzanine cache")
+            kind, decoded, total = 'cache', len(all_frames), len(all_frames)
+            _, mezz_tmp, _ = mezzanine_files(folder)
+            os.makedirs(os.path.dirname(mezz_tmp), exist_ok=True)
+            f_c = f"[0:v]scale={width}:{height},split=2[mz][v];[v]{v_f}[out]"
+            mezz_codec = '-c:v libx264 -preset veryfast -crf 12 -pix_fmt yuv420p'
+            pic_input = image_input(all_frames, 25, pic_files, list_file, False)
+            render_command = (f"ffmpeg {stats} {loglevel} {pic_input} "
+                              f"-filter_complex \"{f_c}\" -map '[mz]' {mezz_codec} '{mezz_tmp}' "
+                              f"-map '[out]' -r {fps} '{partial}' -y")
+        ret = run_ffmpeg(render_command, total, progress_cb)
+        if ret == 0 and not mezzanine:
+            store_mezzanine(folder, frames_id, len(all_frames), size)
+    
+    elif add_text or overlay:
+        v_f = [drawtext_filter(text, height)] if add_text else []
+        if overlay:
+            v_f.append(overlay_filter(height))
+        v_f = ','.join(v_f)
 #         print(v_f)
-        render_command = f"ffmpeg {stats} {loglevel} -f image2 -framerate {fps} -pattern_type glob -i '{pic_files}' -s '{size}'  -vf '{v_f}' '{out_file}' -y"
+        pic_input = image_input(frames, fps, pic_files, list_file, decimated, overlays)
+        render_command = f"ffmpeg {stats} {loglevel} {pic_input} -s '{size}'  -vf '{v_f}' '{partial}' -y"
 #         print(render_command)
+        kind, decoded = 'pictures', len(frames)
+        ret = run_ffmpeg(render_command, len(frames), progress_cb)
     else:
-        render_command = f"ffmpeg {stats} {loglevel} -f image2 -framerate {fps} -pattern_type glob -i '{pic_files}' -s '{size}' {out_file} -y"
+        pic_input = image_input(frames, fps, pic_files, list_file, decimated)
+        render_command = f"ffmpeg {stats} {loglevel} {pic_input} -s '{size}' '{partial}' -y"
+        kind, decoded = 'pictures', len(frames)
+        ret = run_ffmpeg(render_command, len(frames), progress_cb)
     
-    ret = system(render_command)
+    commit_partial(ret, partial, out_file)
+    if os.path.exists(list_file):
+        os.remove(list_file)
 
     if ret==0:
+        save_render_timing(kind, decoded, out_size if piped else size, time() - render_start)
         render_time = timedelta(seconds=round(time() - render_start))
         print(f"Timelapse successfully rendered, in {render_time}")
         print(f"Timelase saved as {out_file} \n\n")
+        return ret, [out_file]
     else:
         print("Timelapse render error\n")
+        return ret, []
+
+
 
 
-video_render(folder, pic_format, width, height, fps, text, add_text)
\ No newline at end of file
+def renditions_render(folder, pic_format, all_frames, width, height, renditions, use_cache):
+    """ Renders all the renditions (size, codec, quality, fps or time, overlay) from a single decode pass.
+        all_frames are the pictures of folder (bad pictures left out).
+        Pictures are decoded once (or the mezzanine, if valid), and split to one filter chain per output.
+        Prints the encode time per output, and the decode time saved against separate runs.
+        Returns the ffmpeg return code and the list of the rendered movies.
+    """
+    render_start = time()
+    print(f"\n  Renditions rendering started\n")
+    
+    stamp = strftime("%Y%m%d_%H%M%S", localtime())
+    pic_files = os.path.join(folder, '*' + pic_format)
+    list_file = os.path.join(folder, 'frames.ffconcat')
+    size = str(width)+'x'+str(height)
+    if len(set([os.path.splitext(frame)[1] for frame in all_frames])) > 1:
+        print("Pictures of mixed formats (compaction not completed): complete the compaction, then render again\n")
+        return 1, []
+    plan = rendition_plan(renditions, len(all_frames), width, height)
+    
+    mezzanine, mezz_tmp = None, ''
+    if use_cache:
+        frames_id = frames_hash(all_frames)
+        mezzanine = valid_mezzanine(folder, frames_id, len(all_frames), size)
+        if not mezzanine:
+            _, mezz_tmp, _ = mezzanine_files(folder)
+            os.makedirs(os.path.dirname(mezz_tmp), exist_ok=True)
+    
+    if mezzanine:
+        print("Decoding from the mezzanine cache")
+        pic_input = f"-i '{mezzanine}'"
+    else:
+        pic_input = image_input(all_frames, 25, pic_files, list_file, False)
+    
+    render_command = renditions_command(pic_input, plan, len(all_frames), height, stamp, folder, mezz_tmp, width)
+    ret = subprocess.run(render_command, shell=True, stderr=subprocess.PIPE, text=True)
+    total_s = time() - render_start
+    if os.path.exists(list_file):
+        os.remove(list_file)
+    
+    if ret.returncode != 0:
+        print(*[line for line in ret.stderr.splitlines() if not line.startswith('bench:')][-10:], sep='\n')
+        print("Renditions render error\n")
+        return ret.returncode, []
+    
+    if mezz_tmp:
+        store_mezzanine(folder, frames_id, len(all_frames), size)
+    save_render_timing('renditions', len(all_frames), size, total_s)
+    
+    decode_s, encode_s = parse_benchmark(ret.stderr)
+    print(f"{'Rendition':<14}{'Size':>11}{'fps':>8}{'Frames':>8}{'Encode s':>10}{'File Mb':>9}")
+    for i, r in enumerate(plan):
+        file_mb = os.path.getsize(r['out_file'])/1024/1024
+        print(f"{r['name']:<14}{str(r['width'])+'x'+str(r['height']):>11}{float(r['framerate']):>8.2f}"
+              f"{r['frames']:>8}{encode_s.get(i, 0):>10.1f}{file_mb:>9.1f}")
+    source = 'mezzanine' if mezzanine else 'pictures'
+    print(f"\nDecode of {len(all_frames)} frames ({source}), done once: {decode_s:.1f} s")
+    print(f"Total render time: {timedelta(seconds=round(total_s))}")
+    print(f"Saved against {len(plan)} separate runs: about {timedelta(seconds=round(decode_s*(len(plan)-1)))}")
+    for r in plan:
+        print(f"Rendition saved as {r['out_file']}")
+    print()
+    return 0, [r['out_file'] for r in plan]
+
+
+
+
+################  render worker, batch render, or single folder render  ########################
+if serve_port != None:                           # case of render worker mode
+    serve(serve_port, parent_folder)             # render requests are served, until Ctrl+C
+
+elif batch != None:                              # case of batch render
+    if not glob.has_magic(batch) and not os.path.isdir(batch):  # case the batch parent folder does not exist
+        print("\nBatch folder does not exist\n")
+        exit()                                   # script is terminated
+    render_batch(batch, batch_workers, force)    # all the picture folders are rendered
+
+else:                                            # case of single folder render
+    folder = os.path.join(parent_folder, folder) # folder will be appended to the parent_folder
+    if not os.path.exists(folder):               # case the folder does not exist
+        print("\nFolder does not exist")
+        print("Change the folder name at argument --folder")
+        print("or change it at video_render.py\n")
+        exit()                                   # script is terminated
+    render_folder(folder)                        # pictures in folder are rendered
+# ###############################################################################################
\ No newline at end of file